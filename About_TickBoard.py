@@ -1,14 +1,14 @@
 import streamlit as st
-from pathlib import Path
-import pandas as pd
-import geopandas as gpd
-from utils.data_loader import load_all_data
+from utils.tracing import begin_rerun, end_rerun
+from utils.warmup import start_warm_up
 
 st.set_page_config(
     page_title="TickBoard",
     page_icon="🕷️",
     layout="wide"
 )
+start_warm_up()
+begin_rerun("About")
 
 st.title("🕷️ TickBoard: Predictive Analysis of Tick Abundance in Europe")
 st.divider()
@@ -84,6 +84,4 @@ st.markdown("""
 ---
 © TickBoard | Developed in Python using [Streamlit](https://streamlit.io/)
 """)
-
-if "nuts_geojson_data" not in st.session_state:
-    st.session_state["nuts_geojson_data"] = load_all_data()
\ No newline at end of file
+end_rerun()
@@ -1,16 +1,20 @@
 import streamlit as st
-import pydeck as pdk
-import time
-import importlib
 import utils.data_loader as data_loader
-importlib.reload(data_loader)
 from branca.colormap import linear
 from utils.data_loader import load_all_data
+from utils.coloring import fill_colors
+from utils.columnar_map import columnar_map
+from utils.region_panel import region_detail_panel
+from utils.tiles import get_tile_builds, nuts_tileset, tile_layer
+from utils.tracing import begin_rerun, end_rerun, span
+from utils.warmup import start_warm_up
 
 st.set_page_config(
     page_title="Data Overview | TickBoard",
     page_icon="🕷️",
     layout="wide")
+start_warm_up()
+begin_rerun("Data overview")
 
 st.title("🌍 Data Overview")
 st.divider()
@@ -49,47 +53,8 @@ with col1:
     """)
 
 with col2:
-    start = time.time()
-    if "nuts_geojson_data" not in st.session_state:
-        st.session_state["nuts_geojson_data"] = load_all_data()
-    if 'nuts_layers' not in st.session_state:
-        layer_NUTS3 = pdk.Layer(
-            "GeoJsonLayer",
-            data=st.session_state["nuts_geojson_data"]["NUTS3"]["features"],
-            get_polygon="geometry.coordinates[0]",
-            get_fill_color="properties['VALUE']",
-            get_line_color=[250,240,230],
-            line_width_min_pixels=0.5,
-            pickable=True,
-        )
-
-        layer_NUTS2 = pdk.Layer(
-            "GeoJsonLayer",
-            data=st.session_state["nuts_geojson_data"]["NUTS2"]["features"],
-            get_polygon="geometry.coordinates[0]",
-            get_fill_color="properties['VALUE']",
-            get_line_color=[250,240,230],
-            line_width_min_pixels=1,
-            pickable=True,
-        )
-
-        layer_NUTS1 = pdk.Layer(
-            "GeoJsonLayer",
-            data=st.session_state["nuts_geojson_data"]["NUTS1"]["features"],
-            get_polygon="geometry.coordinates[0]",
-            get_fill_color="properties['VALUE']",
-            get_line_color=[250,240,230],
-            line_width_min_pixels=1,
-            pickable=True,
-        )
-
-        st.session_state['nuts_layers'] = {
-            'NUTS3': layer_NUTS3,
-            'NUTS2': layer_NUTS2,
-            'NUTS1': layer_NUTS1,
-        }
-    end = time.time()
-    print(f"All layers created in {end - start:.2f}s")
+    with span("data.load_store"):
+        nuts_data = load_all_data()
 
     def change_active_map():
         st.rerun()
@@ -98,8 +63,12 @@ with col2:
         st.pills("Select NUTS level:", ["NUTS3", "NUTS2", "NUTS1"], selection_mode="single", default ="NUTS3",
                         key = "active_nuts_level")
     with sub_col_2:
-        st.selectbox("Select environmental variable", ["EEAmedian","EEAminorit", "EEAmajorit","EEAvariety","TCDmedian","TCDvarianc","TMAX1","TMAX2","TMAX3","TMIN1","TMIN2","TMIN3","VPD1","VPD2","VPD3","BufferFTY","BufferGras", "BufferImpe","TCDcount","TCDsum","Impervious"],
+        # every level carries every variable of the store, uploaded ones included
+        st.selectbox("Select environmental variable", nuts_data["NUTS3"].columns,
                  key = "current_environmental_variable")
+    st.radio("Map rendering", ["Streamed values", "Vector tiles", "GeoJSON"], horizontal=True, key="map_mode",
+             help="Streamed values: the region shapes are sent to the browser once per session and each change only sends the new values. "
+                  "Vector tiles: the browser only fetches the detail needed for the current view and zoom.")
     if "last_env_var" not in st.session_state:
         st.session_state["last_env_var"] = None
     if "last_nuts_level" not in st.session_state:
@@ -110,51 +79,66 @@ with col2:
         st.session_state["last_env_var"] = st.session_state["current_environmental_variable"]
         st.session_state["last_nuts_level"] = st.session_state["active_nuts_level"]
         st.rerun()
-    with st.spinner("Generating the map..."):
-        start = time.time()
+    with st.spinner("Generating the map..."), span("map.render", mode=st.session_state["map_mode"]):
         var = st.session_state["current_environmental_variable"]
         level = st.session_state["active_nuts_level"]
-        features = st.session_state["nuts_geojson_data"][level]["features"]
-        values = [f["properties"].get(var) for f in features if f["properties"].get(var) is not None]
-        vmin, vmax = round(min(values),2), round(max(values),2)
+        nuts_level = nuts_data[level]
+        with span("map.coloring"):
+            colors, vmin, vmax = fill_colors(nuts_level.key, var, nuts_level.column(var))
         colormap = linear.viridis.scale(vmin, vmax)
         colormap.caption = var
         colormap.format = "{:.2f}"
-        for f in features:
-            val = f["properties"].get(var)
-            if val is None:
-                f["properties"]["VALUE"] = [180, 180, 180, 140]
-            else:
-                rgb = colormap(round(val,2)).lstrip("#")
-                r, g, b = tuple(int(rgb[i:i + 2], 16) for i in (0, 2, 4))
-                f["properties"]["VALUE"] = [r, g, b, 250]
-        st.session_state["nuts_layers"][level].data = features
-
-        first = features[0]["properties"]
-
-        st.pydeck_chart(
-            pdk.Deck(
-                map_style="mapbox://styles/mapbox/light-v10",
-                initial_view_state=pdk.ViewState(
-                    latitude=48.3, longitude=11.2, zoom=3.5),
-                layers=[st.session_state['nuts_layers'][level]],
-                tooltip={"text": f"{var}: {{{var}}}\nNUTS_ID: {{NUTS_ID}}"}
-            )
-        )
+        if st.session_state["map_mode"] == "Streamed values":
+            with span("map.columnar"):
+                columnar_map(nuts_level, var, vmin, vmax)
+        else:
+            import pydeck as pdk
+            meta = None
+            if st.session_state["map_mode"] == "Vector tiles":
+                # built in the background on first use, GeoJSON until then
+                meta = get_tile_builds().get(nuts_tileset, level)
+                if meta is None:
+                    error = get_tile_builds().error(nuts_tileset, level)
+                    if error:
+                        st.warning(f"The vector tiles could not be built ({error}), the map is drawn from GeoJSON.")
+                    else:
+                        st.caption("The vector tiles are being built in the background, the map is drawn from "
+                                   "GeoJSON until they are ready.")
+            with span("map.layer"):
+                if meta is not None:
+                    layer = tile_layer(meta, get_fill_color=f"properties['C_{var}']",
+                                       get_line_color=[250,240,230], line_width_min_pixels=0.5)
+                else:
+                    layer = pdk.Layer(
+                        "GeoJsonLayer",
+                        data=nuts_level.features({var: nuts_level.column(var), "VALUE": colors}),
+                        get_fill_color="properties['VALUE']",
+                        get_line_color=[250,240,230],
+                        line_width_min_pixels=0.5 if level == "NUTS3" else 1,
+                        pickable=True,
+                    )
+
+            with span("map.pydeck_serialize"):
+                st.pydeck_chart(
+                    pdk.Deck(
+                        map_style="mapbox://styles/mapbox/light-v10",
+                        initial_view_state=pdk.ViewState(
+                            latitude=48.3, longitude=11.2, zoom=3.5),
+                        layers=[layer],
+                        tooltip={"text": f"{var}: {{{var}}}\nNUTS_ID: {{NUTS_ID}}"}
+                    )
+                )
         #st.markdown("##### Legend")
         sub_col1, sub_col2, sub_col3 = st.columns([0.5, 1.5, 0.5])
         with sub_col2:
             st.markdown(colormap._repr_html_(), unsafe_allow_html=True)
-        end = time.time()
-    print(f"Map rendered in {end - start:.2f}s")
 
-    st.markdown("#### Sample of the Environmental Dataset")
+    st.markdown("#### Region detail")
+    region_detail_panel(key="overview_region")
 
-    if "nuts_geojson_data" not in st.session_state:
-        with st.spinner("Data is still loading..."):
-            st.session_state["nuts_geojson_data"] = data_loader.load_all_data()
+    st.markdown("#### Sample of the Environmental Dataset")
 
-    st.dataframe(st.session_state["nuts_geojson_data"]["PREVIEW_NUTS3"])
+    st.dataframe(nuts_data["PREVIEW_NUTS3"])
 
 st.divider()
 sub_col1, sub_col2 = st.columns([1, 1.5])
@@ -187,4 +171,5 @@ st.markdown("""
 ---
 © TickBoard | Developed in Python using [Streamlit](https://streamlit.io/)
 """)
+end_rerun()
 
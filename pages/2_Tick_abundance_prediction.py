@@ -1,11 +1,16 @@
 import streamlit as st
-import pandas as pd
-import importlib
+import numpy as np
 import pydeck as pdk
-import time
 import utils.data_loader as data_loader
-importlib.reload(data_loader)
-st.cache_data.clear()
+import utils.tiles as tiles
+from utils.coloring import DIVERGING_LUT, color_values
+from utils.columnar_map import columnar_map
+from utils.models import training_data_available
+from utils.prediction_cache import get_prediction_cache
+from utils.region_panel import region_detail_panel
+from utils.tracing import begin_rerun, end_rerun, span
+from utils.training_jobs import get_training_jobs
+from utils.warmup import start_warm_up
 
 
 st.set_page_config(
@@ -13,6 +18,8 @@ st.set_page_config(
     page_icon="🕷️",
     layout="wide"
 )
+start_warm_up()
+begin_rerun("Tick abundance prediction")
 
 if 'selected_second_id' not in st.session_state:
     st.session_state['selected_second_id'] = 2
@@ -24,56 +31,160 @@ st.title("Tick Abundance Prediction")
 st.divider()
 
 def get_available_models():
-    try:
-        df = pd.read_csv("data/MODELS.csv", sep=";")
-        df = df.iloc[1:] # exclude the main model with id 1
-        return list(zip(df['model_id'], df['model_name'], df['creation_date']))
-    except (FileNotFoundError, pd.errors.EmptyDataError):
-        return []
+    return data_loader.load_model_options()
+
+@st.fragment
+def map_yearly_predictions(target_id, slot):
+    # moving the slider only reruns this map: a year is a slice of the memory-mapped prediction cube and the browser
+    # keeps the region shapes; the animation sends all years once and the browser plays them
+    cube = data_loader.load_prediction_cube()
+    years = cube.model_years(target_id)
+    vmin, vmax = cube.value_range(target_id)
+    nuts3 = data_loader.load_all_data()["NUTS3"]
+    if st.toggle("Animate the years", key=f"animate_{slot}"):
+        with span("map.cube_frames", model=target_id):
+            columnar_map(nuts3, "y_pred", vmin, vmax, frames=cube.frames(target_id),
+                         frame_labels=[str(year) for year in years], key=f"cube_map_{slot}")
+    else:
+        year = st.select_slider("Year", years, value=years[-1], key=f"year_{slot}_{target_id}")
+        with span("map.cube_slice", model=target_id, year=year):
+            columnar_map(nuts3, "y_pred", vmin, vmax, values=cube.slice(target_id, year), key=f"cube_map_{slot}")
+    st.caption(f"The colors span {vmin:.2f} to {vmax:.2f} over all years of the model.")
 
 def map_model_predictions(id='main', title=""):
     target_id = 1 if id == 'main' else id
+    if len(data_loader.load_prediction_cube().model_years(target_id)) > 1:
+        return map_yearly_predictions(target_id, "main" if id == 'main' else "comparison")
     
-    with st.spinner(f"Loading predictions..."):
-        gdf, min_v, max_v = data_loader.load_model_predictions(id=target_id)
+    with st.spinner(f"Loading predictions..."), span("map.render", model=target_id):
+        with span("data.predictions"):
+            meta = None
+            if st.session_state['prediction_tiles']:
+                # built in the background on first use, GeoJSON until then
+                meta = tiles.get_tile_builds().get(tiles.prediction_tileset, target_id)
+                if meta is None:
+                    error = tiles.get_tile_builds().error(tiles.prediction_tileset, target_id)
+                    if error:
+                        st.warning(f"The tiles could not be built ({error}), the map is drawn from GeoJSON.")
+                    else:
+                        st.caption("The tiles are being built in the background, the map is drawn from GeoJSON "
+                                   "until they are ready.")
+            if meta is not None:
+                min_v, max_v = meta["ranges"]["y_pred"]
+            else:
+                values, min_v, max_v = data_loader.load_model_predictions(id=target_id)
+        if meta is None:
+            with span("map.features"):
+                features = data_loader.load_all_data()["NUTS3"].features({"y_pred": values}, mask=~np.isnan(values))
         denom = (max_v - min_v) if max_v != min_v else 1
-        
-        layer = pdk.Layer(
-            "GeoJsonLayer",
-            data=gdf,
-            get_fill_color=f"""
+        fill_color = f"""
             [
                 128 + ( (properties.y_pred - {min_v}) / {denom} * 127 ), 
                 0 + ( (properties.y_pred - {min_v}) / {denom} * 255 ), 
                 128 - ( (properties.y_pred - {min_v}) / {denom} * 128 ), 
                 160
             ]
-            """,
-            get_line_color=[0, 20, 0],
-            line_width_min_pixels=1,
-            pickable=True,
-        )
+            """
 
-        st.pydeck_chart(
-            pdk.Deck(
-                map_style="mapbox://styles/mapbox/light-v10",
-                initial_view_state=pdk.ViewState(
-                    latitude=48.3, longitude=11.2, zoom=3.5
-                ),
-                layers=[layer],
-                tooltip={"html": "<b>Value:</b> {y_pred}"}
+        with span("map.layer"):
+            if meta is not None:
+                layer = tiles.tile_layer(meta, get_fill_color=fill_color, get_line_color=[0, 20, 0],
+                                         line_width_min_pixels=1)
+            else:
+                layer = pdk.Layer(
+                    "GeoJsonLayer",
+                    data=features,
+                    get_fill_color=fill_color,
+                    get_line_color=[0, 20, 0],
+                    line_width_min_pixels=1,
+                    pickable=True,
+                )
+
+        with span("map.pydeck_serialize"):
+            st.pydeck_chart(
+                pdk.Deck(
+                    map_style="mapbox://styles/mapbox/light-v10",
+                    initial_view_state=pdk.ViewState(
+                        latitude=48.3, longitude=11.2, zoom=3.5
+                    ),
+                    layers=[layer],
+                    tooltip={"html": "<b>Value:</b> {y_pred}"}
+                )
             )
-        )
+
+def map_prediction_difference(main_id, other_id):
+    with st.spinner(f"Loading predictions..."), span("map.render", model=other_id, difference=True):
+        with span("data.difference"):
+            difference = data_loader.load_prediction_difference(main_id, other_id)
+        # symmetric range so that equal predictions are always white
+        bound = max(float(np.nanmax(np.abs(difference))), 1e-9) if np.isfinite(difference).any() else 1
+        with span("map.coloring"):
+            colors = color_values(difference, -bound, bound, lut=DIVERGING_LUT)
+        nuts3 = data_loader.load_all_data()["NUTS3"]
+        with span("map.layer"):
+            layer = pdk.Layer(
+                "GeoJsonLayer",
+                data=nuts3.features({"difference": difference, "VALUE": colors}, mask=~np.isnan(difference)),
+                get_fill_color="properties.VALUE",
+                get_line_color=[0, 20, 0],
+                line_width_min_pixels=1,
+                pickable=True,
+            )
+        with span("map.pydeck_serialize"):
+            st.pydeck_chart(
+                pdk.Deck(
+                    map_style="mapbox://styles/mapbox/light-v10",
+                    initial_view_state=pdk.ViewState(
+                        latitude=48.3, longitude=11.2, zoom=3.5
+                    ),
+                    layers=[layer],
+                    tooltip={"html": "<b>Difference:</b> {difference}"}
+                )
+            )
+    st.caption(f"Red: the main model predicts more ticks than model {other_id}, blue: fewer. "
+               f"The color scale spans ±{bound:.2f}.")
 
 @st.fragment
 def training_section():
-    if st.button("Train model",width="stretch", disabled=True,
-                     help="This functionality is not available in the public version of TickBoard dashboard, since training data is confidential"):
-        with st.spinner("Training in progress..."):
-            #model_training.train_model()
-            st.cache_data.clear()
-        st.success("Trained!")
+    available = training_data_available()
+    if st.button("Train model",width="stretch", disabled=not available or "training_job_id" in st.session_state,
+                     help=None if available else "This functionality is not available in the public version of TickBoard dashboard, since training data is confidential"):
+        # the training runs in its own process, this page only polls the job
+        st.session_state["training_job_id"] = get_training_jobs().submit("STRF")
+        st.session_state.pop("training_result", None)
+        st.rerun()
+
+@st.fragment(run_every=1)
+def training_progress():
+    jobs = get_training_jobs()
+    job = jobs.status(st.session_state["training_job_id"])
+    if job is None or job["state"] in ("done", "failed", "cancelled"):
+        st.session_state["training_result"] = job
+        del st.session_state["training_job_id"]
+        if job is not None and job["state"] == "done":
+            # only the new model changed: its cache entry is dropped and it becomes the comparison model
+            get_prediction_cache().invalidate(job["model_id"])
+            st.session_state['selected_second_id'] = job["model_id"]
         st.rerun()
+    st.progress(job["progress"], text=job["stage"])
+    if job["timings"]:
+        st.caption(" · ".join(f"{stage}: {seconds:.1f}s" for stage, seconds in job["timings"].items()))
+    if st.button("Cancel training", width="stretch", disabled=job["committing"],
+                 help="The model is being saved" if job["committing"] else None):
+        jobs.cancel(st.session_state["training_job_id"])
+
+def training_status():
+    if "training_job_id" in st.session_state:
+        training_progress()
+    elif st.session_state.get("training_result") is not None:
+        result = st.session_state["training_result"]
+        if result["state"] == "done":
+            st.success(result["message"])
+            st.caption(" · ".join(f"{stage}: {seconds:.1f}s" for stage, seconds in result["timings"].items()))
+        elif result["state"] == "cancelled":
+            st.info(result["message"])
+        else:
+            st.error(result["message"])
 
 col1, col2 = st.columns([1, 1])
 
@@ -81,6 +192,8 @@ with col1:
     st.markdown("#### Main model predictions")
     st.markdown("##### Spatiotemporal Random Forest, ID = 1")
     st.markdown("Model specification described below the maps")
+    st.toggle("Level-of-detail tiles", key="prediction_tiles",
+              help="The maps only fetch the detail needed for the current view and zoom")
 with col2:
     st.markdown("#### Comparison model predictions")
     
@@ -88,6 +201,7 @@ with col2:
     
     with ctrl_col1:
         training_section()
+        training_status()
 
     with ctrl_col2:
         models_options = get_available_models()
@@ -118,6 +232,13 @@ with col1:
 with col2:
     map_model_predictions(id=st.session_state['selected_second_id'])
 
+st.markdown("#### Difference between the main and the comparison model")
+map_prediction_difference(1, st.session_state['selected_second_id'])
+
+st.markdown("#### Region detail")
+st.markdown("Every model's prediction and every environmental variable of one region")
+region_detail_panel(key="prediction_region")
+
 st.divider()
 col1, col_divider, col2 = st.columns([1, 0.1, 1])
 with col1:
@@ -171,4 +292,5 @@ with col2:
 st.markdown("""
 ---
 © TickBoard | Developed in Python using [Streamlit](https://streamlit.io/)
-""")
\ No newline at end of file
+""")
+end_rerun()
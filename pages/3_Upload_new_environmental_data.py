@@ -1,12 +1,15 @@
 import streamlit as st
-import pandas as pd
-from utils.data_upload_validation import validate_env_data
+from utils.upload_jobs import get_upload_jobs
 from utils.data_loader import load_all_data
+from utils.tracing import begin_rerun, end_rerun, span
+from utils.warmup import start_warm_up
 
 st.set_page_config(
     page_title="Upload New Data | TickBoard",
     page_icon="🕷️",
     layout="wide")
+start_warm_up()
+begin_rerun("Upload new environmental data")
 
 
 #image_path = os.path.join(os.path.dirname(__file__), "..", "TickBoard.png")
@@ -27,6 +30,7 @@ with col1:
     - all variable values have to be numerical,
     - no NUTS3 code can appear more than once in the file,
     - the variable name the user declared in the textbox in the dashboard is not the same as any of the variables already included in the environmental dataset.
+    - the variable name can only contain letters, digits and underscores, starts with a letter or an underscore and is at most 64 characters long,
     - the file has to contain values for each European NUTS3 code.
                 """)
 
@@ -34,28 +38,41 @@ with col1:
     env_file = st.file_uploader(label = "Environmental data file", type = "csv",
                      accept_multiple_files = False, key = "env_data_uploader",
                      help = "Input your file with new environmental variables here")
-    if col1.button("Upload Environmental Data"):
+    if col1.button("Upload Environmental Data", disabled="upload_job_id" in st.session_state):
         if env_file is not None:
-            env_df = pd.read_csv(env_file, header=None, sep = ";")
-            passed, message = validate_env_data(env_df, variable_name) #passed = T => the file has passed all validation steps
-            if passed:
-                st.success("Thank you for uploading your environmental data and improving our database!", icon="✅")
-            else:
-                st.error(message, icon="🚨")
+            # validation and saving run in the background, this page only polls the job
+            st.session_state["upload_job_id"] = get_upload_jobs().submit(env_file.getvalue(), variable_name)
+            st.session_state.pop("upload_result", None)
+
+    @st.fragment(run_every=1)
+    def upload_progress():
+        job = get_upload_jobs().status(st.session_state["upload_job_id"])
+        if job is None or job["state"] in ("done", "failed"):
+            st.session_state["upload_result"] = job
+            del st.session_state["upload_job_id"]
+            st.rerun()
+        st.progress(job["progress"], text=job["stage"])
+
+    if "upload_job_id" in st.session_state:
+        upload_progress()
+    elif st.session_state.get("upload_result") is not None:
+        result = st.session_state["upload_result"]
+        if result["state"] == "done": #the file has passed all validation steps
+            st.success("Thank you for uploading your environmental data and improving our database!", icon="✅")
+        else:
+            st.error(result["message"], icon="🚨")
 
 
 with col2:
     st.markdown("#### Sample of the current environmental dataset")
 
-    if "nuts_geojson_data" not in st.session_state:
-        with st.spinner("Data is still loading..."):
-            st.session_state["nuts_geojson_data"] = load_all_data()
-
-    st.dataframe(st.session_state["nuts_geojson_data"]["PREVIEW_NUTS3"])
+    with st.spinner("Data is still loading..."), span("data.preview"):
+        st.dataframe(load_all_data()["PREVIEW_NUTS3"])
 
 
 
 st.markdown("""
 ---
 © TickBoard | Developed in Python using [Streamlit](https://streamlit.io/)
-""")
\ No newline at end of file
+""")
+end_rerun()
@@ -0,0 +1,65 @@
+import streamlit as st
+from utils.tracing import ADMIN, TRACE_FILE, TRACE_SAMPLE, TRACER, stage_summary
+
+st.set_page_config(
+    page_title="Performance Traces | TickBoard",
+    page_icon="🕷️",
+    layout="wide")
+
+st.title("Performance Traces")
+
+if not ADMIN:
+    st.info("This page is only available to administrators (TICKBOARD_ADMIN=1).")
+    st.stop()
+
+st.caption(f"Tracing {TRACE_SAMPLE:.0%} of the reruns of this server process"
+           + (f", also written to {TRACE_FILE}" if TRACE_FILE else ""))
+
+col1, col2, col3 = st.columns([2, 2, 1], vertical_alignment="bottom")
+spans = TRACER.spans()
+pages = sorted(spans["page"].dropna().unique()) if not spans.empty else []
+page_filter = col1.multiselect("Pages", pages, placeholder="All pages")
+session_filter = col2.text_input("Session id", placeholder="All sessions")
+auto_refresh = col3.toggle("Auto refresh", value=False)
+
+
+@st.fragment(run_every=5 if auto_refresh else None)
+def traces():
+    spans = TRACER.spans()
+    if not spans.empty and page_filter:
+        # spans outside of a page's rerun (warm-up, builds) have no page and are kept
+        spans = spans[spans["page"].isin(page_filter) | spans["page"].isna()]
+    if not spans.empty and session_filter:
+        spans = spans[spans["session"].str.startswith(session_filter.strip())]
+    if spans.empty:
+        st.info("No spans have been recorded yet.")
+        return
+
+    reruns = spans[spans["stage"] == "rerun"]
+    st.markdown(f"**{len(spans)}** spans of **{spans['rerun'].nunique()}** reruns in "
+                f"**{spans['session'].nunique()}** sessions")
+
+    summary = stage_summary(spans)
+    st.markdown("#### Duration per stage")
+    st.bar_chart(summary.set_index("stage")[["p50_ms", "p95_ms"]], horizontal=True, stack=False)
+    st.dataframe(summary, hide_index=True, width="stretch",
+                 column_config={c: st.column_config.NumberColumn(format="%.1f")
+                                for c in ["p50_ms", "p95_ms", "max_ms", "total_s"]})
+
+    st.markdown("#### Latest reruns")
+    latest = reruns.sort_values("start", ascending=False).head(20)
+    st.dataframe(latest[["page", "session", "rerun", "ms"]], hide_index=True, width="stretch")
+    rerun = st.selectbox("Stages of the rerun", latest["rerun"], index=None)
+    if rerun is not None:
+        st.dataframe(spans[spans["rerun"] == rerun].sort_values("start").drop(columns=["session", "rerun", "page"]),
+                     hide_index=True, width="stretch")
+
+
+traces()
+
+col1, col2, _ = st.columns([1, 1, 4])
+col1.download_button("Download spans (JSON lines)", TRACER.export(), file_name="tickboard_traces.jsonl",
+                     mime="application/jsonl")
+if col2.button("Clear spans"):
+    TRACER.clear()
+    st.rerun()
@@ -0,0 +1,172 @@
+from pathlib import Path
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from utils.synthetic_data import SCALES, generate
+
+# time and peak memory of the hot paths on synthetic data (utils/synthetic_data.py) at every scale. Every case runs
+# in a fresh process inside the generated data directory: the setup brings it to the state a running server would be
+# in (on-disk artifacts built, the data a case works on loaded), then the case is timed REPEATS times and run once
+# more under tracemalloc, whose peak counts the Python and NumPy allocations (Arrow buffers and memory-mapped files
+# are not included). python -m utils.benchmark [--record] [scales...] compares against the baseline of this machine
+# in benchmarks/baseline.json (--record updates it) and exits with 1 when a case got slower than TOLERANCE times its
+# baseline plus SLACK_S, or its peak memory grew by more than MEMORY_TOLERANCE times plus MEMORY_SLACK_MB
+
+APP_ROOT = Path(__file__).resolve().parent.parent
+# wall-clock timings only compare on the machine that recorded them: every machine records its own baseline (run
+# with --record before changing the code), the file is not tracked
+BASELINE_PATH = APP_ROOT / "benchmarks" / "baseline.json"
+# add_env_data adds variables to the store, it runs last
+CASES = ["load_all_data", "load_model_predictions", "color_values", "validate_env_data", "calculate_metrics",
+         "locate_regions", "add_env_data"]
+# points per run of the bulk region lookup
+LOOKUP_POINTS = 100_000
+REPEATS = 5
+TOLERANCE = 1.5
+SLACK_S = 0.005
+MEMORY_TOLERANCE = 1.25
+MEMORY_SLACK_MB = 1
+
+
+def _upload(snapshot):
+    # a complete upload in the layout of the upload page: NUTS3 code and value, no header
+    return pd.DataFrame({0: snapshot["NUTS_ID"], 1: np.random.default_rng(0).normal(size=len(snapshot))})
+
+
+def _case(name):
+    # runs in the child process; returns the measured call, which gets the number of the repetition
+    import utils.data_loader as data_loader
+    if name == "load_all_data":
+        data_loader.load_all_data()
+
+        def run(i):
+            data_loader._load_geometry_store.clear()
+            data_loader.load_all_data()
+        return run
+
+    if name == "load_model_predictions":
+        from utils.prediction_cache import get_prediction_cache
+        data_loader.load_model_predictions(1)
+
+        def run(i):
+            get_prediction_cache().invalidate(1)
+            data_loader.load_model_predictions(1)
+        return run
+
+    if name == "color_values":
+        from utils.coloring import color_values, value_range
+        values = data_loader.load_all_data()["NUTS3"].column("TMAX1")
+        return lambda i: color_values(values, *value_range(values))
+
+    if name == "locate_regions":
+        import shapely
+        lookup = data_loader.load_region_lookup()
+        xmin, ymin, xmax, ymax = shapely.total_bounds(lookup.levels["NUTS3"].shapes)
+        rng = np.random.default_rng(0)
+        lats, lons = rng.uniform(ymin, ymax, LOOKUP_POINTS), rng.uniform(xmin, xmax, LOOKUP_POINTS)
+        return lambda i: lookup.locate_many(lats, lons)
+
+    from utils.env_store import read_snapshot
+    if name == "validate_env_data":
+        from utils.data_upload_validation import validation_report
+        upload = _upload(read_snapshot())
+        return lambda i: validation_report(upload.copy(), f"BENCHMARK{i}")
+
+    if name == "add_env_data":
+        from utils.data_upload_validation import add_env_data
+        upload = _upload(read_snapshot())
+        return lambda i: add_env_data(upload.copy(), f"BENCHMARK{i}")
+
+    if name == "calculate_metrics":
+        from utils.metrics import calculate_metrics
+        rng = np.random.default_rng(0)
+        y_true = rng.gamma(2, 35, len(read_snapshot()))
+        y_pred = y_true * rng.lognormal(0, 0.5, len(y_true))
+        return lambda i: calculate_metrics(y_true, y_pred)
+
+    raise ValueError(f"unknown benchmark case {name}")
+
+
+def _measure(name, repeats):
+    run = _case(name)
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        run(i)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run(repeats)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": statistics.median(seconds), "min_seconds": min(seconds), "peak_mb": peak / 2 ** 20}
+
+
+def measure(root, name, repeats=REPEATS):
+    env = {**os.environ, "TICKBOARD_WARMUP": "0",
+           "PYTHONPATH": os.pathsep.join(filter(None, [str(APP_ROOT), os.environ.get("PYTHONPATH")]))}
+    command = [sys.executable, "-m", "utils.benchmark", "--child", name, str(repeats)]
+    result = subprocess.run(command, cwd=root, env=env, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        return {"seconds": float("nan"), "peak_mb": float("nan"), "error": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(lines[-1])
+
+
+def _regressions(key, result, baseline):
+    if "error" in result:
+        return [f"{key}: {result['error']}"]
+    regressions = []
+    if key in baseline:
+        seconds, peak = baseline[key]["seconds"], baseline[key]["peak_mb"]
+        if not result["seconds"] <= seconds * TOLERANCE + SLACK_S:
+            regressions.append(f"{key}: {result['seconds'] * 1000:.1f}ms, baseline {seconds * 1000:.1f}ms")
+        if not result["peak_mb"] <= peak * MEMORY_TOLERANCE + MEMORY_SLACK_MB:
+            regressions.append(f"{key}: peak {result['peak_mb']:.1f}MB, baseline {peak:.1f}MB")
+    return regressions
+
+
+def benchmark(scales=("nuts3",), cases=CASES, record=False, repeats=REPEATS):
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if not baseline and not record:
+        print(f"no baseline on this machine, record one with --record ({BASELINE_PATH})")
+    results, regressions = {}, []
+    with tempfile.TemporaryDirectory() as root:
+        for scale in scales:
+            start = time.time()
+            n_regions = generate(Path(root) / scale, scale)
+            print(f"{scale}: {n_regions} regions generated in {time.time() - start:.2f}s")
+            for name in cases:
+                key = f"{scale}/{name}"
+                results[key] = result = measure(Path(root) / scale, name, repeats)
+                reference = baseline.get(key)
+                print(f"  {name:24} {result['seconds'] * 1000:10.2f}ms {result['peak_mb']:9.1f}MB"
+                      + (f"  baseline {reference['seconds'] * 1000:10.2f}ms {reference['peak_mb']:9.1f}MB"
+                         if reference else "") + (f"  error: {result['error']}" if "error" in result else ""))
+                regressions += _regressions(key, result, baseline)
+
+    if record:
+        BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        baseline.update({key: result for key, result in results.items() if "error" not in result})
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2))
+        print(f"baseline recorded in {BASELINE_PATH}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return not regressions
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        print(json.dumps(_measure(sys.argv[2], int(sys.argv[3]))))
+    else:
+        arguments = [arg for arg in sys.argv[1:] if arg != "--record"]
+        unknown = set(arguments) - set(SCALES)
+        if unknown:
+            sys.exit(f"unknown scales {sorted(unknown)}, choose from {list(SCALES)}")
+        sys.exit(0 if benchmark(arguments or ["nuts3"], record="--record" in sys.argv) else 1)
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import streamlit as st
+from branca.colormap import linear
+
+LUT_SIZE = 256
+FILL_ALPHA = 250
+MISSING_COLOR = [180, 180, 180, 140]
+# color arrays kept by fill_colors, one per (NUTS level version, variable); the oldest is dropped beyond this,
+# can be overridden with the TICKBOARD_FILL_COLOR_ENTRIES variable
+FILL_COLOR_ENTRIES = int(os.environ.get("TICKBOARD_FILL_COLOR_ENTRIES", 256))
+
+
+def _lut(colormap):
+    # sample a branca colormap's stops once, so coloring is a table lookup instead of a colormap call per feature
+    stops = np.array(colormap.colors)
+    index = np.linspace(0, 1, len(stops))
+    positions = np.linspace(0, 1, LUT_SIZE)
+    lut = np.column_stack([np.interp(positions, index, stops[:, channel]) for channel in range(3)])
+    return (lut * 255.9999).astype(np.uint8)
+
+
+VIRIDIS_LUT = _lut(linear.viridis)
+# red where the first of two values is larger, blue where it is smaller, white around zero
+DIVERGING_LUT = _lut(linear.RdBu_11)[::-1].copy()
+
+
+def value_range(values):
+    return round(float(np.nanmin(values)), 2), round(float(np.nanmax(values)), 2)
+
+
+def color_values(values, vmin, vmax, lut=VIRIDIS_LUT):
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    denom = (vmax - vmin) if vmax != vmin else 1
+    position = np.clip((np.nan_to_num(values, nan=vmin) - vmin) / denom, 0, 1)
+
+    colors = np.empty((len(values), 4), dtype=np.uint8)
+    colors[:, :3] = lut[np.rint(position * (LUT_SIZE - 1)).astype(np.intp)]
+    colors[:, 3] = FILL_ALPHA
+    colors[missing] = MISSING_COLOR
+    return colors
+
+
+@st.cache_data(max_entries=FILL_COLOR_ENTRIES)
+def fill_colors(level_key, var, _values):
+    # memoized per (NUTS level version, variable); the values themselves are not hashed
+    vmin, vmax = value_range(_values)
+    return color_values(_values, vmin, vmax), vmin, vmax
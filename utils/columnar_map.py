@@ -0,0 +1,77 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import shapely
+import streamlit as st
+import streamlit.components.v1 as components
+from utils.coloring import VIRIDIS_LUT
+
+# pause between two frames of an animation
+FRAME_INTERVAL_MS = 700
+
+# the frontend loads the dist build of deck.gl 9.1.14 (MIT) from its vendor directory, not from a CDN
+_component = components.declare_component(
+    "columnar_map", path=str(Path(__file__).parent / "columnar_map_frontend")
+)
+
+
+@st.cache_resource
+def columnar_geometry(level_key, _level):
+    # every polygon part with its holes, largest first so enclaves are drawn on top of the region around them. The
+    # parts are triangulated here (constrained Delaunay of all their rings), the browser draws the triangles as they
+    # are and every ring as an outline
+    parts, part_feature = shapely.get_parts(_level.shapes, return_index=True)
+    order = np.argsort(-shapely.area(parts), kind="stable")
+    parts, part_feature = parts[order], part_feature[order]
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    positions, vertex_ring = shapely.get_coordinates(rings, return_index=True)
+    ring_starts = np.concatenate([[0], np.cumsum(np.bincount(vertex_ring, minlength=len(rings)))])
+    # the first ring of a part is its exterior
+    part_starts = ring_starts[np.searchsorted(ring_part, np.arange(len(parts) + 1))]
+
+    # the triangles only have the vertices of the rings, found again by part and coordinates
+    triangles, triangle_part = shapely.get_parts(shapely.constrained_delaunay_triangles(parts), return_index=True)
+    corners = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3].reshape(-1, 2)
+    vertices = pd.DataFrame({"part": ring_part[vertex_ring], "x": positions[:, 0], "y": positions[:, 1],
+                             "vertex": np.arange(len(positions))}).drop_duplicates(["part", "x", "y"])
+    indices = pd.DataFrame({"part": np.repeat(triangle_part, 3), "x": corners[:, 0], "y": corners[:, 1]}).merge(
+        vertices, on=["part", "x", "y"], how="left")["vertex"].to_numpy(dtype=np.float64).reshape(-1, 3)
+    indices = indices[~np.isnan(indices).any(axis=1)]
+
+    return {
+        "key": level_key,
+        "ids": _level.ids.tolist(),
+        "positions": positions.astype(np.float32).tobytes(),
+        "start_indices": part_starts.astype(np.uint32).tobytes(),
+        "ring_indices": ring_starts.astype(np.uint32).tobytes(),
+        "indices": indices.astype(np.uint32).tobytes(),
+        "part_feature": part_feature.astype(np.uint32).tobytes(),
+        "lut": VIRIDIS_LUT.tobytes(),
+    }
+
+
+def columnar_map(level, var, vmin, vmax, height=500, values=None, frames=None, frame_labels=None,
+                 frame_interval_ms=FRAME_INTERVAL_MS, key="columnar_map"):
+    # polygons are sent once per session and kept in the browser, every other rerun only sends the values (by default
+    # the column var of the level). frames is a (frames x regions) array the browser colors once and then plays in a
+    # loop, one frame every frame_interval_ms, without reruns
+    geometry = columnar_geometry(level.key, level)
+    loaded = st.session_state.get(key) or []
+
+    args = {
+        "geometry_key": geometry["key"],
+        "vmin": vmin,
+        "vmax": vmax,
+        "variable": var,
+        "height": height,
+    }
+    if frames is not None:
+        args.update(frames=np.ascontiguousarray(frames, dtype=np.float32).tobytes(), frame_labels=frame_labels,
+                    frame_interval_ms=frame_interval_ms)
+    else:
+        args["values"] = np.asarray(level.column(var) if values is None else values, dtype=np.float32).tobytes()
+    if geometry["key"] not in loaded:
+        args.update({name: value for name, value in geometry.items() if name != "key"})
+
+    return _component(**args, key=key, default=[])
+
@@ -1,61 +1,131 @@
 from pathlib import Path
-import geopandas as gpd
 import streamlit as st
-import pandas as pd
+import numpy as np
+from utils.geometry_cache import file_hash, read_geometry_cache
+from utils.env_store import GEOMETRY_PATH, geometry_key, read_snapshot, store_key
+from utils.geometry_store import NutsLevel
+from utils.model_registry import read_models, registry_key
+from utils.nuts_rollup import read_areas, read_parent_geometry, rollup
+from utils.prediction_cache import get_prediction_cache
+from utils.prediction_cube import cube_key, read_cube
+from utils.predictions import prediction_source, read_predictions
+from utils.tracing import span, traced
+
 
-@st.cache_data
 def load_all_data():
+    # one read-only store per version of the column store, shared by all sessions instead of copied into each one
+    return _load_geometry_store(store_key())
 
-    GPKG_PATH_NUTS3 = Path("data") / "weighted_aggr_nuts_3.gpkg"
-    GPKG_PATH_NUTS2 = Path("data") / "weighted_aggr_nuts_2.gpkg"
-    GPKG_PATH_NUTS1 = Path("data") / "weighted_aggr_nuts_1.gpkg"
 
-    gdf_nuts3 = gpd.read_file(GPKG_PATH_NUTS3).to_crs(epsg=4326)
-    gdf_nuts2 = gpd.read_file(GPKG_PATH_NUTS2).to_crs(epsg=4326)
-    gdf_nuts1 = gpd.read_file(GPKG_PATH_NUTS1).to_crs(epsg=4326)
+@st.cache_resource(max_entries=1)
+def _load_geometry_store(source_hash):
+
+    # precompiled artifacts are already in EPSG:4326 and simplified, see utils/geometry_cache.py
+    # NUTS3 attributes come from the latest snapshot of the column store, see utils/env_store.py; NUTS2 and NUTS1
+    # are rolled up from it, see utils/nuts_rollup.py
+    with span("data.read_snapshot"):
+        snapshot = read_snapshot()
+    with span("data.read_geometry"):
+        gdf_nuts3 = read_geometry_cache(GEOMETRY_PATH).merge(snapshot, on="NUTS_ID", how="left")
+    with span("data.rollup"):
+        areas = read_areas()
+        gdf_nuts2 = read_parent_geometry("NUTS2").merge(rollup(snapshot, areas, "NUTS2"), on="NUTS_ID", how="left")
+        gdf_nuts1 = read_parent_geometry("NUTS1").merge(rollup(snapshot, areas, "NUTS1"), on="NUTS_ID", how="left")
 
-    # simplify the geometries for faster rendering
-    gdf_nuts3['geometry'] = gdf_nuts3['geometry'].simplify(tolerance=0.01)
-    gdf_nuts2['geometry'] = gdf_nuts2['geometry'].simplify(tolerance=0.01)
-    gdf_nuts1['geometry'] = gdf_nuts1['geometry'].simplify(tolerance=0.01)
-    
     preview_nuts3 = gdf_nuts3.drop(columns=["geometry", "CENTER_X", "CENTER_Y", "CENTER_LAT", "CENTER_LON"],
                                     errors="ignore").head(6)
-    
-    gdf_nuts3 = gdf_nuts3.__geo_interface__
-    gdf_nuts2 = gdf_nuts2.__geo_interface__
-    gdf_nuts1 = gdf_nuts1.__geo_interface__
 
     return {
-        "NUTS3": gdf_nuts3,
-        "NUTS2": gdf_nuts2,
-        "NUTS1": gdf_nuts1,
+        "NUTS3": NutsLevel("NUTS3", source_hash, gdf_nuts3),
+        "NUTS2": NutsLevel("NUTS2", source_hash, gdf_nuts2),
+        "NUTS1": NutsLevel("NUTS1", source_hash, gdf_nuts1),
         "PREVIEW_NUTS3": preview_nuts3
     }
 
 
-@st.cache_data
 def load_model_predictions(id = 1):
-    GPKG_PATH = Path("data/predictions") / f"{id}_MODEL_PREDICTIONS.gpkg"
+    # y_pred aligned to the shared NUTS3 geometry, cached per model and file version; a new predictions file
+    # only replaces the entry of its own model
+    return get_prediction_cache().get(id, _prediction_version(id), lambda: _read_model_predictions(id))
+
+
+def load_prediction_difference(main_id, other_id):
+    # main minus comparison model per region, kept in the same cache as the predictions it is derived from
+    version = f"{_prediction_version(main_id)}.{_prediction_version(other_id)}"
+    return get_prediction_cache().get(("difference", main_id, other_id), version,
+                                      lambda: _difference(main_id, other_id))
+
+
+def _prediction_version(id):
+    return f"{file_hash(prediction_source(id))}.{geometry_key()}"
+
+
+@traced("data.read_predictions")
+def _read_model_predictions(id):
+    values = read_predictions(id, load_all_data()["NUTS3"].ids)
+    values.flags.writeable = False
+    return (values, np.nanmin(values), np.nanmax(values)), values.nbytes
+
+
+def _difference(main_id, other_id):
+    main, _, _ = load_model_predictions(main_id)
+    other, _, _ = load_model_predictions(other_id)
+    difference = main - other
+    difference.flags.writeable = False
+    return difference, difference.nbytes
+
 
-    gdf_model = gpd.read_file(GPKG_PATH).to_crs(epsg=4326)
-    gdf_model['geometry'] = gdf_model['geometry'].simplify(tolerance=0.01)
-    min_val = gdf_model['y_pred'].min()
-    max_val = gdf_model['y_pred'].max()
+def load_prediction_cube():
+    # every year of every model's predictions, memory-mapped and shared by all sessions, see utils/prediction_cube.py
+    return _load_prediction_cube(cube_key())
 
-    gdf = gdf_model.__geo_interface__
 
-    return (gdf, min_val, max_val)
+@st.cache_resource(max_entries=1)
+def _load_prediction_cube(key):
+    return read_cube(key)
+
+
+def load_region_lookup():
+    # point, code and detail lookups of every NUTS level, rebuilt with the data, the predictions or the registry
+    return _load_region_lookup(f"{store_key()}.{cube_key()}.{registry_key()}")
+
+
+@st.cache_resource(max_entries=1)
+@traced("data.region_lookup")
+def _load_region_lookup(key):
+    from utils.region_lookup import RegionLookup
+    data = load_all_data()
+    models = read_models()
+    return RegionLookup({level: data[level] for level in ("NUTS3", "NUTS2", "NUTS1")}, load_prediction_cube(),
+                        dict(zip(models["model_id"].astype(int), models["model_name"])))
+
 
 @st.cache_data
 def load_data_coverage_image():
     IMAGE_PATH = Path("data/images") / "data_coverage.svg"
     with open(IMAGE_PATH, "r", encoding="utf-8") as f:
         return f.read()
-    
+
+
 def load_model_results():
-    CSV_PATH = Path("data") / "MODELS.csv"
-    df = pd.read_csv(CSV_PATH, sep=";")
-    return df
+    # registry reads are cached per version of MODELS.csv, so a newly written model is picked up on the next rerun
+    return _model_results(registry_key())
+
+
+@st.cache_data(max_entries=1)
+def _model_results(registry_version):
+    return read_models()
+
+
+def load_model_options():
+    # (model_id, model_name, creation_date) of every model except the main one (id 1), in id order
+    return _model_options(registry_key())
+
+
+@st.cache_data(max_entries=1)
+def _model_options(registry_version):
+    models = read_models()
+    models = models[models["model_id"] != 1]
+    return list(zip(models["model_id"].tolist(), models["model_name"], models["creation_date"]))
 
 
@@ -1,8 +1,8 @@
 import pandas as pd
-from collections import Counter
-import geopandas as gpd
-import csv
 from pathlib import Path
+from utils.env_store import VariableExistsError, add_variable, valid_variable_name
+from utils.tracing import span
+from utils.nuts_index import load_nuts3_index
 
 #table paths
 env_versions = Path("data") / "ENV_VARIABLES_VERSIONS.csv"
@@ -12,66 +12,94 @@ env_data = Path("data") / "weighted_aggr_nuts_3.gpkg"
 nuts_country_codes = Path("data") / "NUTS_COUNTRY_CODES.csv" #two first characters of nuts codes for each country
 
 
-def validate_env_data(df, variable_name):
+def _region_list(codes, limit=20):
+    codes = sorted(str(code) for code in codes)
+    shown = ", ".join(codes[:limit])
+    return shown + (f" and {len(codes) - limit} more" if len(codes) > limit else "")
+
+
+def validation_report(df, variable_name):
+    # every check runs on whole columns and every failure is reported, not only the first one
     if not isinstance(df, pd.DataFrame):
-        return False, "This data is in the wrong format."
+        return [("format", "This data is in the wrong format.")], None
     if df.empty:
-        return False, "This data is empty."
+        return [("empty", "This data is empty.")], None
     if len(df.columns) !=2:
-        return False, "The file has to contain exactly two columns."
+        return [("columns", "The file has to contain exactly two columns.")], None
+
+    nuts3_set, nuts3, env_variables = load_nuts3_index()
+    failures = []
 
+    df = df.copy()
     df.columns = ["RegionCode", variable_name]
-    uploaded_nuts = list(df["RegionCode"])
+    codes = df["RegionCode"].astype(str).str.strip()
+    df["RegionCode"] = codes
 
     #checking if a variable with the same name already exists
-    env_df = gpd.read_file(env_data)
-    env_variables = env_df.columns
-    if df.columns[1] in env_variables:
-        return False, "The environmental data already contains a variable with this name."
+    if not variable_name or not variable_name.strip():
+        failures.append(("name", "The name of the variable cannot be empty."))
+    elif not valid_variable_name(variable_name):
+        failures.append(("name", "The name of the variable can only contain letters, digits and underscores, has "
+                                 "to start with a letter or an underscore and can be at most 64 characters long."))
+    elif variable_name in env_variables:
+        failures.append(("name", "The environmental data already contains a variable with this name."))
 
     #checking for non-numerical values
-    if not all(isinstance(x, (int, float)) for x in df[df.columns[1]]):
-        return False, "This data contains non-numerical values."
+    raw = df[variable_name]
+    values = pd.to_numeric(raw, errors="coerce")
+    non_numeric = raw.notna() & values.isna()
+    if non_numeric.any():
+        failures.append(("numeric", "This data contains non-numerical values for the following regions: "
+                         + _region_list(codes[non_numeric])))
+    df[variable_name] = values.astype("float64")
 
     # checking for duplicates
-    duplicated_nuts = [x for x, count in Counter(uploaded_nuts).items() if count > 1]
+    duplicated_nuts = codes[codes.duplicated()].unique()
     if len(duplicated_nuts) > 0:
-        return False, "This data contains more than one value for the following regions: " + str(duplicated_nuts)
+        failures.append(("duplicates", "This data contains more than one value for the following regions: "
+                         + _region_list(duplicated_nuts)))
 
-    #checking if file has too many nuts
-    nuts3 = list(env_df["NUTS_ID"])  # list of all NUTS3 codes in our data
-    if len(set(uploaded_nuts)) > len(set(nuts3)):
-        fake_nuts = set(uploaded_nuts) - set(nuts3)
-        return False, "This data contains these fake NUTS3 codes:" + str(fake_nuts)
+    #checking if file has fake nuts
+    fake_nuts = codes[~codes.isin(nuts3_set)].unique()
+    if len(fake_nuts) > 0:
+        failures.append(("unknown", "This data contains these fake NUTS3 codes: " + _region_list(fake_nuts)))
 
     #checking if any nuts are missing
-    if set(uploaded_nuts) != set(nuts3):
-        missing_nuts = set(nuts3) - set(uploaded_nuts)
-        return False, "This data lacks values for " + str(missing_nuts)
+    missing_nuts = pd.Index(nuts3).difference(codes.unique())
+    if len(missing_nuts) > 0:
+        failures.append(("missing", "This data lacks values for " + _region_list(missing_nuts)))
+
+    return failures, df
+
+
+def validate_env_data(df, variable_name, progress=None):
+    # progress(fraction, stage) is called between the steps when the upload runs as a background job
+    progress = progress or (lambda fraction, stage: None)
+    progress(0.2, "Validating the data")
+    with span("upload.validate", rows=len(df)):
+        failures, df = validation_report(df, variable_name)
+    if failures:
+        return False, "\n".join(f"- {message}" for _, message in failures)
 
     #add function adding this data to the database
-    env_version_table = pd.read_csv(env_versions, sep=";")
-    env_version_table_max_version = env_version_table["version"].max()
-    if add_env_data(df, env_version_table_max_version, variable_name):
+    progress(0.6, "Adding the variable to the dataset")
+    try:
+        with span("upload.write"):
+            added = add_env_data(df, variable_name)
+    except VariableExistsError:
+        # another upload registered the same name after this one was validated
+        return False, "The environmental data already contains a variable with this name."
+    if added:
         return True, "The data has been uploaded successfully."
     else:
         return False, "Something went wrong during adding the uploaded data to our dataset. Please try again."
 
-def add_env_data(df, version, variable_name):
-    version+=1
+def add_env_data(df, variable_name):
     try:
-        #update env_variables_version table by adding the name of the new variable and inserting version value one bigger than the latest
-        with open(env_versions, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f, delimiter=";")
-            writer.writerow([df.columns[1], version])
-        # add the new variable as a new column in the environmental dataset
-        gdf_nuts3 = gpd.read_file(env_data).to_crs(epsg=4326)
-        # print(gdf_nuts3.columns)
+        # the new variable is stored as its own column file, the geometry and the other variables are not rewritten;
+        # the version number is allocated by the store while it holds the ingest lock
         df.columns = ["NUTS_ID", variable_name]
-        # print(df.columns)
-        gdf_nuts3_merged = gdf_nuts3.merge(df, on="NUTS_ID", how="left")
-        # print(gdf_nuts3_merged.columns)
-        gdf_nuts3_merged.to_file(env_data, driver="GPKG")
+        add_variable(df, variable_name)
         return True
     except FileNotFoundError:
         return False
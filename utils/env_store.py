@@ -0,0 +1,210 @@
+from pathlib import Path
+import os
+import re
+import tempfile
+from filelock import FileLock
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from utils.geometry_cache import NUTS_SOURCES, file_hash
+
+# every variable version lives in its own small file next to one shared geometry file; the version table
+# (variable_name;version) is the manifest, and a snapshot for env_data_version N holds every variable with version <= N
+STORE_DIR = Path("data") / "env_store"
+GEOMETRY_PATH = STORE_DIR / "geometry.feather"
+COLUMNS_DIR = STORE_DIR / "columns"
+SNAPSHOTS_DIR = STORE_DIR / "snapshots"
+VERSION_TABLE = Path("data") / "ENV_VARIABLES_VERSIONS.csv"
+LOCK_PATH = STORE_DIR / "ingest.lock"
+LOCK_TIMEOUT = 120
+GEOMETRY_COLUMNS = ["NUTS_ID", "CENTER_X", "CENTER_Y", "CENTER_LAT", "CENTER_LON", "geometry"]
+# a variable name becomes part of a file name and a column name
+VARIABLE_NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]{0,63}")
+
+
+def column_path(variable_name, version):
+    return COLUMNS_DIR / f"{variable_name}.v{version}.feather"
+
+
+class VariableExistsError(ValueError):
+    pass
+
+
+class InvalidVariableNameError(ValueError):
+    pass
+
+
+def valid_variable_name(variable_name):
+    return isinstance(variable_name, str) and VARIABLE_NAME_PATTERN.fullmatch(variable_name) is not None
+
+
+def commit_file(target, write):
+    # write to a private temporary file, flush it to disk and rename it over the target: readers see either
+    # the old or the complete new file, and a crash leaves only a *.tmp file behind
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=target.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _write_atomic(table, target):
+    commit_file(target, lambda f: feather.write_feather(table, f, compression="uncompressed"))
+
+
+def _write_column(nuts_ids, values, variable_name, version):
+    target = column_path(variable_name, version)
+    if not target.resolve().is_relative_to(COLUMNS_DIR.resolve()):
+        raise InvalidVariableNameError(variable_name)
+    table = pa.table({"NUTS_ID": pa.array(nuts_ids, pa.string()),
+                      variable_name: pa.array(values, pa.float64())})
+    _write_atomic(table, target)
+
+
+def initialize_store(source=NUTS_SOURCES["NUTS3"]):
+    # one-off migration from the NUTS3 GeoPackage: geometry is written once, every variable to its own file
+    import geopandas as gpd
+    gdf = gpd.read_file(source).to_crs(epsg=4326)
+    table = read_version_table()
+    versions = table.set_index("variable_name")["version"]
+
+    unregistered = []
+    for variable_name in gdf.columns.difference(GEOMETRY_COLUMNS):
+        version = int(versions.get(variable_name, 1))
+        _write_column(gdf["NUTS_ID"], gdf[variable_name], variable_name, version)
+        if variable_name not in versions.index:
+            unregistered.append({"variable_name": variable_name, "version": version})
+    if unregistered:
+        _write_version_table(pd.concat([table, pd.DataFrame(unregistered)], ignore_index=True))
+
+    geometry = gdf[[c for c in GEOMETRY_COLUMNS if c in gdf.columns]]
+    commit_file(GEOMETRY_PATH, lambda f: geometry.to_feather(f, compression="uncompressed"))
+
+
+def ingest_lock():
+    # one writer at a time across all processes; the lock is released by the OS if the holder crashes
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    return FileLock(LOCK_PATH, timeout=LOCK_TIMEOUT)
+
+
+def _ensure_store():
+    if not GEOMETRY_PATH.exists():
+        with ingest_lock():
+            if not GEOMETRY_PATH.exists():
+                initialize_store()
+
+
+def read_version_table():
+    return pd.read_csv(VERSION_TABLE, sep=";")
+
+
+def latest_version():
+    return int(read_version_table()["version"].max())
+
+
+def store_key():
+    # changes whenever the geometry or the set of variable versions changes
+    _ensure_store()
+    return f"{file_hash(GEOMETRY_PATH)}.{file_hash(VERSION_TABLE)}"
+
+
+def geometry_key():
+    # content hash of the region geometry, for caches of anything drawn on it
+    _ensure_store()
+    return file_hash(GEOMETRY_PATH)
+
+
+def read_geometry():
+    _ensure_store()
+    import geopandas as gpd
+    return gpd.read_feather(GEOMETRY_PATH, memory_map=True)
+
+
+def read_nuts_ids():
+    _ensure_store()
+    return feather.read_table(GEOMETRY_PATH, columns=["NUTS_ID"], memory_map=True).column("NUTS_ID").to_pylist()
+
+
+def variables(version=None):
+    table = read_version_table()
+    if version is not None:
+        table = table[table["version"] <= version]
+    return list(table["variable_name"])
+
+
+def read_snapshot(version=None):
+    # attributes of one env_data_version in geometry order; materialized once, snapshots never change afterwards
+    _ensure_store()
+    table = read_version_table()
+    version = int(table["version"].max()) if version is None else int(version)
+    target = SNAPSHOTS_DIR / f"v{version}.feather"
+    if target.exists():
+        return feather.read_feather(target, memory_map=True)
+
+    nuts_ids = pd.Index(read_nuts_ids(), name="NUTS_ID")
+    snapshot = pd.DataFrame(index=nuts_ids)
+    for row in table[table["version"] <= version].itertuples(index=False):
+        column = feather.read_feather(column_path(row.variable_name, row.version), memory_map=True)
+        snapshot[row.variable_name] = column.set_index("NUTS_ID")[row.variable_name].reindex(nuts_ids)
+    snapshot = snapshot.reset_index()
+    _write_atomic(pa.Table.from_pandas(snapshot, preserve_index=False), target)
+    return snapshot
+
+
+def read_dataset(version=None):
+    # full NUTS3 dataset as a model trained on env_data_version saw it
+    return read_geometry().merge(read_snapshot(version), on="NUTS_ID", how="left")
+
+
+def add_variable(df, variable_name):
+    # O(one column). Under the ingest lock the version is allocated as max + 1, the value file is committed first
+    # and the version table is replaced atomically last; that rename is the commit point of the whole upload
+    if not valid_variable_name(variable_name):
+        raise InvalidVariableNameError(variable_name)
+    _ensure_store()
+    values = df.set_index(df.columns[0])[df.columns[1]]
+    nuts_ids = read_nuts_ids()
+    values = values.reindex(nuts_ids).to_numpy(dtype=float)
+
+    with ingest_lock():
+        recover()
+        table = read_version_table()
+        if variable_name in set(table["variable_name"]):
+            raise VariableExistsError(variable_name)
+        version = int(table["version"].max()) + 1
+
+        _write_column(nuts_ids, values, variable_name, version)
+        table = pd.concat([table, pd.DataFrame({"variable_name": [variable_name], "version": [version]})],
+                          ignore_index=True)
+        _write_version_table(table)
+    return version
+
+
+def _write_version_table(table):
+    commit_file(VERSION_TABLE, lambda f: f.write(table.to_csv(sep=";", index=False).encode("utf-8")))
+
+
+def recover():
+    # removes what an interrupted upload can leave behind: temporary files and value files that never reached
+    # the version table; has to be called while holding the ingest lock
+    leftovers = list(COLUMNS_DIR.glob("*.tmp")) + list(STORE_DIR.glob(GEOMETRY_PATH.name + ".*.tmp")) \
+        + list(VERSION_TABLE.parent.glob(VERSION_TABLE.name + ".*.tmp"))
+    for tmp in leftovers:
+        tmp.unlink(missing_ok=True)
+    registered = {column_path(row.variable_name, row.version).name
+                  for row in read_version_table().itertuples(index=False)}
+    for path in COLUMNS_DIR.glob("*.feather"):
+        if path.name not in registered:
+            path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    # migration step: python -m utils.env_store
+    initialize_store()
+    print(f"{len(variables())} variables in {STORE_DIR}, latest version {latest_version()}")
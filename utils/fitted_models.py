@@ -0,0 +1,44 @@
+from pathlib import Path
+from utils.env_store import commit_file
+from utils.geometry_cache import file_hash
+
+# what a trained model needs to predict again, one joblib file per model id next to its predictions: the model code
+# and parameters, the env_data_version and feature columns it was trained on, its training data and, for the global
+# models, the fitted estimator. The weighted models fit a local model per predicted region from their training data,
+# they are not stored fitted. Models trained before this file existed (the published models 1-4) have none until
+# python -m utils.model_training refit writes theirs
+FITTED_DIR = Path("data") / "models"
+
+
+class FittedModelNotFoundError(FileNotFoundError):
+    pass
+
+
+def fitted_path(model_id):
+    return FITTED_DIR / f"{model_id}_MODEL.joblib"
+
+
+def write_fitted(model_id, model, params, env_data_version, columns, X, y, coords, estimator=None):
+    import joblib
+    artifact = {"model": model, "params": dict(params), "env_data_version": int(env_data_version),
+                "columns": list(columns), "X": X, "y": y, "coords": coords, "estimator": estimator}
+    target = fitted_path(model_id)
+    commit_file(target, lambda f: joblib.dump(artifact, f))
+    return target
+
+
+def _existing_path(model_id):
+    path = fitted_path(model_id)
+    if not path.exists():
+        raise FittedModelNotFoundError(f"Model {model_id} has no stored fitted model")
+    return path
+
+
+def fitted_version(model_id):
+    # content hash of the stored model, changes when a model id is trained again (a recovered registry)
+    return file_hash(_existing_path(model_id))
+
+
+def read_fitted(model_id):
+    import joblib
+    return joblib.load(_existing_path(model_id))
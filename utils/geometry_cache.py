@@ -0,0 +1,75 @@
+from pathlib import Path
+import hashlib
+from functools import lru_cache
+from utils.tracing import span
+
+CACHE_DIR = Path("data") / "cache"
+SIMPLIFY_TOLERANCE = 0.01
+
+# NUTS2 and NUTS1 are derived from NUTS3, see utils/nuts_rollup.py
+NUTS_SOURCES = {
+    "NUTS3": Path("data") / "weighted_aggr_nuts_3.gpkg",
+}
+
+
+def file_hash(path):
+    stat = Path(path).stat()
+    return _content_hash(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=64)
+def _content_hash(path, mtime_ns, size):
+    # mtime and size are part of the memo key, so an unchanged file is hashed only once per process
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def cache_path(source):
+    # the hash of the source file is part of the name, so a changed source never matches an old artifact
+    return CACHE_DIR / f"{source.stem}.{file_hash(source)}.feather"
+
+
+def _read_source(source):
+    import geopandas as gpd
+    if source.suffix == ".feather":
+        return gpd.read_feather(source)
+    return gpd.read_file(source)
+
+
+def build_geometry_cache(source):
+    # env_store imports this module
+    from utils.env_store import commit_file
+    target = cache_path(source)
+    with span("geometry.read", source=source.name):
+        gdf = _read_source(source)
+    with span("geometry.reproject_simplify", source=source.name):
+        gdf = gdf.to_crs(epsg=4326)
+        gdf["geometry"] = gdf["geometry"].simplify(tolerance=SIMPLIFY_TOLERANCE)
+
+    # uncompressed feather can be memory-mapped on read; concurrent cold starts each write a private file and the
+    # last rename wins
+    with span("geometry.write", source=source.name):
+        commit_file(target, lambda f: gdf.to_feather(f, compression="uncompressed"))
+
+    # remove artifacts built from older versions of the same source
+    for old in CACHE_DIR.glob(f"{source.stem}.*.feather"):
+        if old != target:
+            old.unlink(missing_ok=True)
+    return target
+
+
+def read_geometry_cache(source):
+    import geopandas as gpd
+    target = cache_path(source)
+    if not target.exists():
+        build_geometry_cache(source)
+    return gpd.read_feather(target, memory_map=True)
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.geometry_cache
+    for level, source in NUTS_SOURCES.items():
+        print(f"{level}: {build_geometry_cache(source)}")
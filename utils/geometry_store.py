@@ -0,0 +1,61 @@
+import threading
+import numpy as np
+import pandas as pd
+
+NON_ATTRIBUTE_COLUMNS = ["NUTS_ID", "geometry", "CENTER_X", "CENTER_Y", "CENTER_LAT", "CENTER_LON"]
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+class NutsLevel:
+    # read-only view of one NUTS level shared by every session: region ids, a (region x variable) value
+    # matrix and the geometries; sessions only keep their own colors next to it
+
+    def __init__(self, name, source_hash, gdf):
+        self.name = name
+        self.key = f"{name}.{source_hash}"
+        self.ids = _frozen(gdf["NUTS_ID"].to_numpy(dtype=str))
+        self.columns = tuple(c for c in gdf.columns
+                             if c not in NON_ATTRIBUTE_COLUMNS and pd.api.types.is_numeric_dtype(gdf[c]))
+        self.values = _frozen(gdf[list(self.columns)].to_numpy(dtype=np.float64))
+        self.shapes = _frozen(np.asarray(gdf.geometry.values))
+        self._geojson = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def column(self, var):
+        return self.values[:, self.columns.index(var)]
+
+    def geojson_geometry(self):
+        # built once per process, only needed by the GeoJSON rendering path
+        with self._lock:
+            if self._geojson is None:
+                self._geojson = tuple(shape.__geo_interface__ for shape in self.shapes)
+        return self._geojson
+
+    def features(self, properties, mask=None):
+        # fresh feature dicts per call that reference the shared geometry, so the store itself is never written to;
+        # properties maps a name to an array aligned with the regions of this level
+        names = list(properties)
+        columns = [_json_values(properties[name]) for name in names]
+        keep = [True] * len(self) if mask is None else mask.tolist()
+        return [
+            {
+                "type": "Feature",
+                "geometry": geometry,
+                "properties": {"NUTS_ID": nuts_id, **dict(zip(names, values))},
+            }
+            for nuts_id, geometry, kept, *values in zip(self.ids.tolist(), self.geojson_geometry(), keep, *columns)
+            if kept
+        ]
+
+
+def _json_values(array):
+    if array.ndim == 1 and array.dtype.kind == "f":
+        return [None if np.isnan(value) else value for value in array.tolist()]
+    return array.tolist()
@@ -0,0 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+import sys
+import time
+import pandas as pd
+from utils import shared_arrays
+from utils.metrics import calculate_metrics
+from utils.models import MODEL_NAMES, WEIGHTED_MODELS, held_out_predictions, weight_config
+from utils.spatial_weights import WeightCache
+
+# hyperparameter search for the models of MODELS.csv. Weight matrices are built once per (kernel, neighbour count,
+# distance measure) and put into shared memory together with X and y; worker processes only receive the
+# parameters of a combination and the name of its weight matrix:
+# python -m utils.grid_search [model] [processes] runs the search on a synthetic dataset
+
+GRIDS = {
+    "STRF": {"distance_measure": ["euclidean"], "kernel_type": ["bisquare"], "neighbour_count": [0.4, 0.8],
+             "n_estimators": [10, 50], "min_samples_leaf": [6, 8], "max_features": [4, 8],
+             "criterion": ["absolute_error"]},
+    "RF": {"n_estimators": [50, 100], "min_samples_leaf": [6, 8], "max_features": [4, 11],
+           "criterion": ["absolute_error"]},
+    "GWR": {"distance_measure": ["euclidean"], "kernel_type": ["gaussian", "bisquare"],
+            "neighbour_count": [0.08, 0.12, 0.2]},
+    "LR": {},
+}
+
+
+def expand_grid(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _weight_key(config):
+    return "W." + ".".join(str(value) for value in config)
+
+
+def _evaluate(model, params, weight_key, n_jobs):
+    X, y = shared_arrays.array("X"), shared_arrays.array("y")
+    weights = shared_arrays.matrix(weight_key) if weight_key else None
+    start = time.time()
+    predictions = held_out_predictions(model, params, X, y, weights, n_jobs)
+    return {**params, **calculate_metrics(y, predictions), "fit_time": time.time() - start}
+
+
+def grid_search(model, grid, X, y, coords=None, processes=None, n_jobs=1):
+    # every combination runs in its own task with n_jobs threads/processes for the fit itself; returns one row per
+    # combination sorted by MAE and a dict with the timings of the search
+    combinations = expand_grid(grid)
+    processes = processes or min(len(combinations), os.cpu_count())
+    start = time.time()
+
+    with shared_arrays.SharedArrays() as shared:
+        shared.put("X", X)
+        shared.put("y", y)
+        weight_keys = [None] * len(combinations)
+        cache = WeightCache(coords) if model in WEIGHTED_MODELS else None
+        if cache is not None:
+            weight_keys = [_weight_key(weight_config(params)) for params in combinations]
+            for params, key in zip(combinations, weight_keys):
+                if key not in shared.specs:
+                    shared.put_matrix(key, cache.weights(*weight_config(params)))
+        weight_time = time.time() - start
+
+        with ProcessPoolExecutor(processes, initializer=shared_arrays.attach, initargs=(shared.specs,)) as pool:
+            futures = [pool.submit(_evaluate, model, params, key, n_jobs)
+                       for params, key in zip(combinations, weight_keys)]
+            rows = [future.result() for future in futures]
+
+    timings = {
+        "total": time.time() - start,
+        "weights": weight_time,
+        "weight_matrices": len(cache.build_times) if cache else 0,
+        # what building the weights in every fit would have cost, as the models do without a shared matrix
+        "weights_saved": sum(cache.build_times[weight_config(params)] for params in combinations)
+        - sum(cache.build_times.values()) if cache else 0.0,
+        "combinations": len(combinations),
+    }
+    return pd.DataFrame(rows).sort_values("mae", ignore_index=True), timings
+
+
+def report(model, results, timings):
+    print(f"{MODEL_NAMES[model]}: {timings['combinations']} combinations in {timings['total']:.2f}s, "
+          f"{timings['weight_matrices']} weight matrices built in {timings['weights']:.2f}s "
+          f"(~{timings['weights_saved']:.2f}s saved by reusing them)")
+    print(results.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+
+
+if __name__ == "__main__":
+    from utils.models import synthetic_dataset
+    model = sys.argv[1] if len(sys.argv) > 1 else "STRF"
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    X, y, coords = synthetic_dataset()
+    report(model, *grid_search(model, GRIDS[model], X, y, coords, processes))
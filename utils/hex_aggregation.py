@@ -0,0 +1,178 @@
+from pathlib import Path
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy import sparse
+from utils.geometry_cache import NUTS_SOURCES
+from utils.nuts_rollup import AREA_CRS, NUTS_LEVELS, weighted_means
+from utils.tracing import span
+
+# the hexagon environmental grid mapped onto NUTS3 regions: every region gets the mean of the hexagons it
+# intersects, weighted by the area of the intersection. Candidate pairs come from an STRtree over the hexagons;
+# hexagons lying entirely inside a region count with their own area and only those on a border are intersected.
+# Regions are processed in chunks whose number of candidate pairs fits the memory budget. The output is the NUTS3
+# GeoPackage the environmental store is initialized from (python -m utils.env_store), see utils/env_store.py:
+# python -m utils.hex_aggregation HEXAGONS NUTS [OUTPUT] aggregates a hexagon GeoPackage onto a NUTS boundary file,
+# python -m utils.hex_aggregation benchmark [hexagon diameter km] runs it on a synthetic grid
+
+MEMORY_BUDGET_MB = 512
+# rough peak footprint of one candidate pair: indices, the intersection geometry and its area
+PAIR_BYTES = 4096
+# columns of the hexagon file that are not environmental variables
+HEXAGON_ID_COLUMNS = ["id", "ID", "fid", "hex_id", "GRID_ID"]
+
+
+def read_nuts3(path):
+    # NUTS3 regions of a boundary file; GISCO files hold every level, distinguished by LEVL_CODE
+    nuts = gpd.read_file(path)
+    if "LEVL_CODE" in nuts.columns:
+        nuts = nuts[nuts["LEVL_CODE"] == 3]
+    else:
+        nuts = nuts[nuts["NUTS_ID"].str.len() == NUTS_LEVELS["NUTS3"]]
+    return nuts[["NUTS_ID", "geometry"]].to_crs(epsg=AREA_CRS).reset_index(drop=True)
+
+
+def hexagon_variables(hexagons):
+    return [c for c in hexagons.columns
+            if c not in HEXAGON_ID_COLUMNS and c != "geometry" and pd.api.types.is_numeric_dtype(hexagons[c])]
+
+
+def _chunks(candidates, n_regions, budget_pairs):
+    # consecutive region ranges whose candidate pairs stay within the budget; a region with more candidates than
+    # the budget forms a chunk on its own
+    per_region = np.bincount(candidates, minlength=n_regions)
+    start, pairs = 0, 0
+    for region, count in enumerate(per_region):
+        if pairs and pairs + count > budget_pairs:
+            yield start, region
+            start, pairs = region, 0
+        pairs += count
+    if start < n_regions:
+        yield start, n_regions
+
+
+def overlap_weights(regions, hexagons, memory_budget_mb=MEMORY_BUDGET_MB):
+    # sparse (regions x hexagons) matrix of intersection areas in m²
+    regions, hexagons = np.asarray(regions), np.asarray(hexagons)
+    shapely.prepare(regions)
+    tree = shapely.STRtree(hexagons)
+    hexagon_areas = shapely.area(hexagons)
+    # bounding box candidates are cheap (two index arrays) and size the chunks
+    region_index, _ = tree.query(regions)
+    budget_pairs = max(1, memory_budget_mb * 2 ** 20 // PAIR_BYTES)
+
+    rows, columns, areas = [], [], []
+    for start, end in _chunks(region_index, len(regions), budget_pairs):
+        chunk = regions[start:end]
+        pair_region, pair_hexagon = tree.query(chunk, predicate="intersects")
+        # a hexagon inside its region counts with its own area, only border pairs are intersected
+        inside = shapely.contains(chunk[pair_region], hexagons[pair_hexagon])
+        pair_areas = hexagon_areas[pair_hexagon]
+        border = ~inside
+        pair_areas[border] = shapely.area(shapely.intersection(chunk[pair_region[border]],
+                                                               hexagons[pair_hexagon[border]]))
+        rows.append(pair_region + start)
+        columns.append(pair_hexagon)
+        areas.append(pair_areas)
+
+    rows, columns, areas = np.concatenate(rows), np.concatenate(columns), np.concatenate(areas)
+    keep = areas > 0
+    return sparse.csr_array((areas[keep], (rows[keep], columns[keep])), shape=(len(regions), len(hexagons)))
+
+
+def aggregate(hexagons, nuts, memory_budget_mb=MEMORY_BUDGET_MB):
+    # NUTS3 GeoDataFrame in the layout of weighted_aggr_nuts_3.gpkg: NUTS_ID, the variables, the centroid in
+    # EPSG:3035 and in lat/lon, and the geometry in EPSG:3035
+    with span("aggregation.reproject", hexagons=len(hexagons)):
+        hexagons = hexagons.to_crs(epsg=AREA_CRS)
+    variables = hexagon_variables(hexagons)
+    with span("aggregation.overlap_weights", regions=len(nuts), hexagons=len(hexagons)):
+        weights = overlap_weights(nuts.geometry.values, hexagons.geometry.values, memory_budget_mb)
+    with span("aggregation.weighted_means", variables=len(variables)):
+        means = weighted_means(weights, hexagons[variables].to_numpy(dtype=np.float64))
+
+    centers = nuts.geometry.centroid
+    centers_lonlat = centers.to_crs(epsg=4326)
+    result = pd.concat([nuts[["NUTS_ID"]], pd.DataFrame(means, columns=variables, index=nuts.index)], axis=1)
+    result["CENTER_X"], result["CENTER_Y"] = centers.x, centers.y
+    result["CENTER_LAT"], result["CENTER_LON"] = centers_lonlat.y, centers_lonlat.x
+    return gpd.GeoDataFrame(result, geometry=nuts.geometry.values, crs=nuts.crs)
+
+
+def write_aggregation(gdf, output=NUTS_SOURCES["NUTS3"]):
+    output = Path(output)
+    # GDAL picks the format by extension, so the temporary file keeps it
+    tmp = output.with_name(f"{output.stem}.tmp{output.suffix}")
+    tmp.unlink(missing_ok=True)
+    with span("aggregation.write"):
+        gdf.to_file(tmp, driver="GPKG", layer=output.stem)
+        os.replace(tmp, output)
+    return output
+
+
+def run(hexagons_path, nuts_path, output=NUTS_SOURCES["NUTS3"], memory_budget_mb=MEMORY_BUDGET_MB):
+    return write_aggregation(aggregate(gpd.read_file(hexagons_path), read_nuts3(nuts_path), memory_budget_mb), output)
+
+
+def hexagon_grid(bounds, diameter, seed=0):
+    # flat-topped hexagons of the given corner-to-corner diameter covering bounds (EPSG:3035 metres), with
+    # smooth synthetic variables
+    radius = diameter / 2
+    x0, y0, x1, y1 = bounds
+    columns = np.arange(x0, x1 + 1.5 * radius, 1.5 * radius)
+    rows = np.arange(y0, y1 + np.sqrt(3) * radius, np.sqrt(3) * radius)
+    cx, cy = np.meshgrid(columns, rows)
+    cy = cy + (np.arange(len(columns)) % 2) * np.sqrt(3) / 2 * radius
+    cx, cy = cx.ravel(), cy.ravel()
+    angles = np.arange(6) * np.pi / 3
+    rings = np.stack([cx[:, None] + radius * np.cos(angles), cy[:, None] + radius * np.sin(angles)], axis=-1)
+    rng = np.random.default_rng(seed)
+    u, v = (cx - x0) / (x1 - x0), (cy - y0) / (y1 - y0)
+    return gpd.GeoDataFrame({
+        "TMAX1": 25 - 12 * v + rng.normal(0, 0.5, len(cx)),
+        "VPD1": 0.3 + 0.8 * u * (1 - v) + rng.normal(0, 0.05, len(cx)),
+        "Impervious": rng.gamma(1.5, 2, len(cx)),
+    }, geometry=shapely.polygons(rings), crs=AREA_CRS)
+
+
+def synthetic_nuts(bounds, n_regions, seed=0):
+    # irregular regions: Voronoi cells of random seeds, clipped to bounds and coded like NUTS3
+    rng = np.random.default_rng(seed)
+    x0, y0, x1, y1 = bounds
+    points = shapely.points(rng.uniform([x0, y0], [x1, y1], (n_regions, 2)))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=shapely.box(*bounds)))
+    cells = shapely.intersection(cells, shapely.box(*bounds))
+    ids = [f"{chr(65 + i // 26000)}{chr(65 + i // 1000 % 26)}{i % 1000:03d}" for i in range(len(cells))]
+    return gpd.GeoDataFrame({"NUTS_ID": ids}, geometry=cells, crs=AREA_CRS)
+
+
+def benchmark(diameter_km=20, n_regions=1500, bounds=(2.6e6, 1.4e6, 6.5e6, 5.4e6)):
+    # the grid of the real data over a Europe-sized extent; checks the result against a geopandas overlay of a sample
+    start = time.time()
+    hexagons = hexagon_grid(bounds, diameter_km * 1000)
+    nuts = synthetic_nuts(bounds, n_regions)
+    print(f"{len(hexagons)} hexagons, {len(nuts)} regions generated in {time.time() - start:.2f}s")
+
+    for budget in (MEMORY_BUDGET_MB, 16):
+        start = time.time()
+        result = aggregate(hexagons, nuts, budget)
+        print(f"aggregated with a {budget} MB budget in {time.time() - start:.2f}s")
+
+    sample = nuts.iloc[:: max(1, len(nuts) // 20)]
+    overlay = gpd.overlay(sample, hexagons, how="intersection", keep_geom_type=True)
+    overlay["w"] = overlay.area
+    expected = overlay.groupby("NUTS_ID").apply(lambda g: np.average(g["TMAX1"], weights=g["w"]), include_groups=False)
+    error = np.abs(result.set_index("NUTS_ID").loc[expected.index, "TMAX1"] - expected).max()
+    print(f"max difference to a geopandas overlay of {len(sample)} regions: {error:.2e}")
+    assert error < 1e-9
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(*[float(arg) for arg in sys.argv[2:3]])
+    else:
+        print(run(*sys.argv[1:4]))
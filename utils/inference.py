@@ -0,0 +1,321 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import numpy as np
+from scipy import sparse
+import streamlit as st
+from utils.env_store import commit_file, geometry_key, read_dataset
+from utils.fitted_models import FittedModelNotFoundError, fitted_version, read_fitted
+from utils.geometry_cache import CACHE_DIR
+from utils.models import WEIGHTED_MODELS, build_estimator
+from utils.prediction_cache import PredictionCache
+from utils.tracing import span
+
+# what-if predictions: a scenario perturbs the environmental variables a stored model (utils/fitted_models.py) was
+# trained on and the model predicts every NUTS3 region under it. A scenario is a list of perturbations applied in
+# order, {"variable": "TMAX1", "add": 1.0, "regions": ["DE", "AT3"]} ("add", "multiply" or "set"; "regions" are NUTS
+# code prefixes of any level, all regions without it). The empty scenario reproduces the model's own predictions.
+# Scenarios are predicted in batches: the global models predict the regions of every scenario of a batch in one call,
+# the weighted models fit each region's local model once per batch and predict all scenarios of the region with it.
+# Results are cached in memory and on disk under a hash of the model file, the geometry and the scenario.
+# In-process: get_inference_service().predict(model_id, scenario); over HTTP: python -m utils.inference serve [port]
+# starts a local endpoint, POST /predict {"model_id": 5, "scenarios": [[...], ...]}; python -m utils.inference check
+# runs it on a synthetic store with a freshly trained model
+
+SCENARIO_DIR = CACHE_DIR / "scenarios"
+SCENARIO_CACHE_MB = int(os.environ.get("TICKBOARD_SCENARIO_CACHE_MB", 64))
+INFERENCE_N_JOBS = int(os.environ.get("TICKBOARD_INFERENCE_N_JOBS", -1))
+INFERENCE_PORT = int(os.environ.get("TICKBOARD_INFERENCE_PORT", 8765))
+OPERATIONS = ("add", "multiply", "set")
+
+
+def normalize_scenario(scenario, columns):
+    # the canonical form of a scenario, which is also its cache identity; raises ValueError on anything invalid
+    normalized = []
+    for perturbation in scenario or []:
+        perturbation = dict(perturbation)
+        variable = perturbation.pop("variable", None)
+        if variable not in columns:
+            raise ValueError(f"Unknown environmental variable: {variable}")
+        regions = perturbation.pop("regions", None) or []
+        if not isinstance(regions, list):
+            raise ValueError(f"regions has to be a list of NUTS codes: {regions!r}")
+        regions = sorted(set(regions))
+        if len(perturbation) != 1 or next(iter(perturbation)) not in OPERATIONS:
+            raise ValueError(f"A perturbation needs exactly one of {', '.join(OPERATIONS)}: {perturbation}")
+        (operation, value), = perturbation.items()
+        normalized.append({"variable": variable, operation: float(value), "regions": [str(r) for r in regions]})
+    return normalized
+
+
+def apply_scenario(X, nuts_ids, columns, scenario):
+    # a perturbed copy of the (regions x features) matrix
+    X = X.copy()
+    for perturbation in scenario:
+        column = columns.index(perturbation["variable"])
+        rows = slice(None)
+        if perturbation["regions"]:
+            rows = np.array([nuts_id.startswith(tuple(perturbation["regions"])) for nuts_id in nuts_ids], dtype=bool)
+        if "add" in perturbation:
+            X[rows, column] += perturbation["add"]
+        elif "multiply" in perturbation:
+            X[rows, column] *= perturbation["multiply"]
+        else:
+            X[rows, column] = perturbation["set"]
+    return X
+
+
+class StoredModel:
+    # a stored model with the inputs of every region, loaded once per process
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.version = fitted_version(model_id)
+        artifact = read_fitted(model_id)
+        self.model, self.params, self.columns = artifact["model"], artifact["params"], artifact["columns"]
+        self.variables = [c for c in self.columns if c not in ("CENTER_X", "CENTER_Y")]
+        dataset = read_dataset(artifact["env_data_version"])
+        self.nuts_ids = dataset["NUTS_ID"].to_numpy(dtype=str)
+        self.X = dataset[self.columns].to_numpy(dtype=float)
+        self.predictable = ~np.isnan(self.X).any(axis=1)
+        self.estimator = artifact["estimator"]
+        if self.model in WEIGHTED_MODELS:
+            # the weights between every region and the training points, as WeightModel.predict_by_fit computes them
+            from georegression.weight_matrix import weight_matrix_from_points
+            template = build_estimator(self.model, self.params)
+            self.local_estimator = template.local_estimator
+            self.X_train, self.y_train = artifact["X"], artifact["y"]
+            coords = dataset[["CENTER_X", "CENTER_Y"]].to_numpy(dtype=float)[self.predictable]
+            weights = weight_matrix_from_points([artifact["coords"]], [coords], template.distance_measure,
+                                                template.kernel_type, template.distance_ratio, template.bandwidth,
+                                                template.neighbour_count, template.distance_args)
+            self.weights = sparse.csr_array(weights.T)
+
+    def predict(self, batch):
+        # (scenarios x regions x features) inputs to (scenarios x regions) predictions, NaN where a region has none
+        n_scenarios = len(batch)
+        predictions = np.full((n_scenarios, len(self.nuts_ids)), np.nan)
+        inputs = batch[:, self.predictable]
+        if self.model in WEIGHTED_MODELS:
+            predictions[:, self.predictable] = self._predict_local(inputs)
+        else:
+            n_regions, n_features = inputs.shape[1:]
+            predictions[:, self.predictable] = self.estimator.predict(inputs.reshape(-1, n_features)) \
+                .reshape(n_scenarios, n_regions)
+        return predictions
+
+    def _predict_local(self, inputs):
+        from joblib import Parallel, delayed
+        chunks = np.array_split(np.arange(inputs.shape[1]), max(1, min(inputs.shape[1], 4 * (os.cpu_count() or 1))))
+        results = Parallel(n_jobs=INFERENCE_N_JOBS)(
+            delayed(_fit_predict_regions)(self.local_estimator, self.X_train, self.y_train,
+                                          self.weights[chunk[0]:chunk[-1] + 1], inputs[:, chunk])
+            for chunk in chunks if len(chunk))
+        return np.concatenate(results, axis=1)
+
+
+def _fit_predict_regions(local_estimator, X, y, weights, inputs):
+    # one local model per region, fitted on the training points it has a weight for and predicting every scenario
+    from sklearn.base import clone
+    predictions = np.empty(inputs.shape[:2])
+    for region in range(weights.shape[0]):
+        start, end = weights.indptr[region], weights.indptr[region + 1]
+        neighbours, weight = weights.indices[start:end], weights.data[start:end]
+        estimator = clone(local_estimator).fit(X[neighbours], y[neighbours], sample_weight=weight)
+        predictions[:, region] = estimator.predict(inputs[:, region])
+    return predictions
+
+
+class InferenceService:
+
+    def __init__(self, cache_mb=SCENARIO_CACHE_MB):
+        self._models = {}
+        self._cache = PredictionCache(cache_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+
+    def model(self, model_id):
+        # loaded once per version of the model file; raises FittedModelNotFoundError for models without one
+        with self._lock:
+            model = self._models.get(model_id)
+            if model is None or model.version != fitted_version(model_id):
+                with span("inference.load_model", model=model_id):
+                    model = self._models[model_id] = StoredModel(model_id)
+            return model
+
+    def scenario_key(self, model_id, scenario):
+        model = self.model(model_id)
+        normalized = normalize_scenario(scenario, model.variables)
+        identity = json.dumps([model_id, model.version, geometry_key(), normalized], sort_keys=True)
+        return hashlib.sha256(identity.encode()).hexdigest()[:24], normalized
+
+    def predict(self, model_id, scenario=None):
+        return self.predict_batch(model_id, [scenario])[0]
+
+    def predict_batch(self, model_id, scenarios):
+        # y_pred per scenario, aligned to model(model_id).nuts_ids; only the scenarios found in neither cache are
+        # predicted, all of them in one batch
+        model = self.model(model_id)
+        keys = [self.scenario_key(model_id, scenario) for scenario in scenarios]
+        results = {key: self._cached(key) for key, _ in keys}
+        missing = {key: normalized for key, normalized in keys if results[key] is None}
+        if missing:
+            with span("inference.predict", model=model_id, scenarios=len(missing)):
+                batch = np.stack([apply_scenario(model.X, model.nuts_ids, model.columns, normalized)
+                                  for normalized in missing.values()])
+                for key, values in zip(missing, model.predict(batch)):
+                    results[key] = self._store(key, values)
+        return [results[key] for key, _ in keys]
+
+    def _cached(self, key):
+        # the disk cache is the complete one, the memory cache holds the recently used part of it
+        path = SCENARIO_DIR / f"{key}.npy"
+        if not path.exists():
+            return None
+        return self._cache.get(key, key, lambda: _frozen_entry(np.load(path)))
+
+    def _store(self, key, values):
+        buffer = io.BytesIO()
+        np.save(buffer, values)
+        commit_file(SCENARIO_DIR / f"{key}.npy", lambda f: f.write(buffer.getvalue()))
+        return self._cache.get(key, key, lambda: _frozen_entry(values))
+
+
+def _frozen_entry(values):
+    values.flags.writeable = False
+    return values, values.nbytes
+
+
+@st.cache_resource
+def get_inference_service():
+    # one service per server process, shared by all sessions
+    return InferenceService()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self._reply(404, {"error": "not found"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model_id = int(request["model_id"])
+            scenarios = request.get("scenarios", [[]])
+            predictions = self.service.predict_batch(model_id, scenarios)
+        except FittedModelNotFoundError as e:
+            return self._reply(404, {"error": str(e)})
+        except (KeyError, TypeError, ValueError) as e:
+            return self._reply(400, {"error": f"Invalid request: {e}"})
+        # NaN (regions without data) is null in JSON
+        self._reply(200, {"nuts_ids": self.service.model(model_id).nuts_ids.tolist(),
+                          "predictions": [[None if np.isnan(v) else v for v in values.tolist()]
+                                          for values in predictions]})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(service=None, port=INFERENCE_PORT):
+    # local only, the endpoint has no authentication
+    handler = type("Handler", (_Handler,), {"service": service or InferenceService()})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def check(n_regions=300):
+    # end-to-end run in a scratch directory with a synthetic store: python -m utils.inference check
+    import tempfile
+    import time
+    from urllib.request import Request, urlopen
+    from utils.ingest_stress import synthetic_store
+    from utils.model_training import synthetic_training_data, train_model
+    from utils.models import DEFAULT_PARAMETERS
+    from utils.predictions import read_predictions
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        try:
+            nuts_ids = synthetic_store(root, n_regions, n_variables=8)
+            data = synthetic_training_data(n=150)
+            service = InferenceService()
+            warmer = {"variable": "BASE", "add": 25.0}
+            for model in ("RF", "GWR"):
+                model_id, _, _ = train_model(model, DEFAULT_PARAMETERS[model], data, n_jobs=2)
+                stored = read_predictions(model_id, nuts_ids)
+
+                start = time.perf_counter()
+                baseline = service.predict(model_id)
+                assert np.allclose(baseline, stored, equal_nan=True), "the empty scenario has to reproduce the model"
+                changed = service.predict(model_id, [warmer])
+                assert not np.allclose(changed, baseline, equal_nan=True), "the scenario changed nothing"
+                first = time.perf_counter() - start
+
+                start = time.perf_counter()
+                assert service.predict(model_id, [{**warmer, "regions": []}]) is changed, "not served from the cache"
+                cached = time.perf_counter() - start
+
+                scenarios = [[{"variable": "BASE", "multiply": factor}] for factor in (0.5, 1.5, 2.0)] \
+                    + [[{**warmer, "regions": ["XX1"]}]]
+                start = time.perf_counter()
+                batch = service.predict_batch(model_id, scenarios)
+                batched = time.perf_counter() - start
+                fresh = InferenceService()
+                fresh_batch = fresh.predict_batch(model_id, scenarios)
+                assert all(np.allclose(a, b, equal_nan=True) for a, b in zip(batch, fresh_batch))
+                inside = np.char.startswith(nuts_ids, "XX1")
+                assert np.allclose(batch[3][~inside], baseline[~inside], equal_nan=True), "perturbed outside its regions"
+                print(f"{model} model {model_id}: 2 scenarios {first * 1000:.0f}ms, cached {cached * 1000:.2f}ms, "
+                      f"batch of {len(scenarios)} {batched * 1000:.0f}ms")
+
+            for invalid in ([{"variable": "CENTER_X", "add": 1}], [{"variable": "BASE", "add": 1, "set": 2}],
+                            [{"variable": "BASE", "add": 1, "regions": "DE"}]):
+                try:
+                    service.predict(model_id, invalid)
+                    raise AssertionError(f"invalid scenario accepted: {invalid}")
+                except ValueError:
+                    pass
+            try:
+                service.predict(model_id + 1)
+                raise AssertionError("a model without a stored fitted model has to be refused")
+            except FittedModelNotFoundError:
+                pass
+
+            server = make_server(service, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            request = Request(f"http://127.0.0.1:{server.server_address[1]}/predict", method="POST",
+                              data=json.dumps({"model_id": model_id, "scenarios": [[], [warmer]]}).encode())
+            with urlopen(request) as response:
+                body = json.loads(response.read())
+            server.shutdown()
+            assert body["nuts_ids"] == nuts_ids and len(body["predictions"]) == 2
+            assert np.allclose(np.array(body["predictions"][1], dtype=float), changed, equal_nan=True)
+            assert not list(Path("data").rglob("*.tmp")) and not list(SCENARIO_DIR.rglob("*.tmp"))
+            print("HTTP endpoint ok")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else INFERENCE_PORT
+        print(f"serving what-if predictions on http://127.0.0.1:{port}/predict")
+        make_server(port=port).serve_forever()
+    else:
+        check()
@@ -0,0 +1,130 @@
+from pathlib import Path
+from multiprocessing import Event, Pool, Process
+import os
+import sys
+import tempfile
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+from utils import env_store
+
+# multi-process stress test of the ingest path, followed by writers killed in the middle of an upload; runs in a
+# scratch directory with a synthetic store: python -m utils.ingest_stress [uploads] [processes]
+
+N_REGIONS = 200
+
+
+def synthetic_store(root, n_regions=N_REGIONS, n_variables=1):
+    # changes into root and creates a NUTS3 store of n_regions unit squares with BASE and VAR1..VARn-1 variables
+    os.chdir(root)
+    Path("data").mkdir()
+    names = ["BASE"] + [f"VAR{i}" for i in range(1, n_variables)]
+    pd.DataFrame({"variable_name": names, "version": [1] * n_variables}).to_csv(env_store.VERSION_TABLE, sep=";",
+                                                                                 index=False)
+    nuts_ids = [f"XX{i:03d}" for i in range(n_regions)]
+    rng = np.random.default_rng(0)
+    gdf = gpd.GeoDataFrame({"NUTS_ID": nuts_ids, "BASE": range(n_regions),
+                            **{name: rng.normal(size=n_regions) for name in names[1:]}},
+                           geometry=[box(i % 20, i // 20, i % 20 + 1, i // 20 + 1) for i in range(n_regions)],
+                           crs=4326)
+    centers = gdf.geometry.to_crs(3035).centroid
+    gdf["CENTER_X"], gdf["CENTER_Y"] = centers.x, centers.y
+    gdf["CENTER_LON"], gdf["CENTER_LAT"] = centers.to_crs(4326).x, centers.to_crs(4326).y
+    source = Path("data") / "weighted_aggr_nuts_3.gpkg"
+    gdf.to_file(source, driver="GPKG")
+    env_store.initialize_store(source)
+    return nuts_ids
+
+
+def _upload(args):
+    variable_name, nuts_ids = args
+    df = pd.DataFrame({"NUTS_ID": nuts_ids, variable_name: range(len(nuts_ids))})
+    try:
+        return variable_name, env_store.add_variable(df, variable_name)
+    except env_store.VariableExistsError:
+        return variable_name, None
+
+
+def stress_test(uploads=32, processes=8):
+    with tempfile.TemporaryDirectory() as root:
+        cwd = os.getcwd()
+        try:
+            nuts_ids = synthetic_store(root)
+            # every name is uploaded twice, exactly one of the two has to win
+            names = [f"VAR{i % (uploads // 2)}" for i in range(uploads)]
+            start = time.time()
+            with Pool(processes) as pool:
+                results = pool.map(_upload, [(name, nuts_ids) for name in names])
+            elapsed = time.time() - start
+
+            table = env_store.read_version_table()
+            accepted = [version for _, version in results if version is not None]
+            assert sorted(accepted) == list(range(2, uploads // 2 + 2)), "versions are not unique and contiguous"
+            assert table["variable_name"].is_unique, "a variable was registered twice"
+            assert len(table) == uploads // 2 + 1, "lost or extra rows in the version table"
+            for row in table.itertuples(index=False):
+                column = pd.read_feather(env_store.column_path(row.variable_name, row.version))
+                assert len(column) == N_REGIONS, f"partial value file for {row.variable_name}"
+            assert not list(Path("data").rglob("*.tmp")), "temporary files left behind"
+            assert env_store.read_snapshot().shape == (N_REGIONS, uploads // 2 + 2)
+        finally:
+            os.chdir(cwd)
+    print(f"{uploads} uploads in {processes} processes: OK in {elapsed:.2f}s")
+
+
+def _stalled_upload(variable_name, nuts_ids, stage, reached):
+    # an upload that stops for good halfway through writing the value file ("column") or, with the value file
+    # committed, the version table ("commit"); reached is set once it got there, the writer is then killed
+    commit_file = env_store.commit_file
+
+    def partial(f):
+        f.write(b"partial")
+        f.flush()
+        reached.set()
+        time.sleep(600)
+
+    def stalling_commit_file(target, write):
+        stalls = target == env_store.VERSION_TABLE if stage == "commit" else target.parent == env_store.COLUMNS_DIR
+        return commit_file(target, partial if stalls else write)
+
+    env_store.commit_file = stalling_commit_file
+    env_store.add_variable(pd.DataFrame({"NUTS_ID": nuts_ids, variable_name: range(len(nuts_ids))}), variable_name)
+
+
+def crash_test():
+    # a writer killed in either stage leaves the previous version visible to readers, does not hold the ingest lock
+    # any more and whatever it wrote is removed by the recovery of the next upload
+    with tempfile.TemporaryDirectory() as root:
+        cwd = os.getcwd()
+        try:
+            nuts_ids = synthetic_store(root)
+            for stage in ("column", "commit"):
+                table, snapshot = env_store.read_version_table(), env_store.read_snapshot()
+                reached = Event()
+                writer = Process(target=_stalled_upload, args=(f"CRASHED_{stage.upper()}", nuts_ids, stage, reached))
+                writer.start()
+                assert reached.wait(60), f"the writer never reached the {stage} write"
+                assert env_store.read_version_table().equals(table), "a reader saw an uncommitted version"
+                writer.kill()
+                writer.join()
+
+                assert list(Path("data").rglob("*.tmp")), f"the writer killed at the {stage} write left nothing behind"
+                assert env_store.read_version_table().equals(table), f"killed at the {stage} write, a version changed"
+                assert env_store.read_snapshot().equals(snapshot), f"killed at the {stage} write, the snapshot changed"
+                if stage == "commit":
+                    assert list(env_store.COLUMNS_DIR.glob("CRASHED_*")), "the value file was not committed"
+                name = f"AFTER_{stage.upper()}"
+                version = env_store.add_variable(pd.DataFrame({"NUTS_ID": nuts_ids, name: range(len(nuts_ids))}), name)
+                assert version == table["version"].max() + 1, "the killed upload used up a version"
+                assert not list(Path("data").rglob("*.tmp")), "recovery left temporary files behind"
+                assert not list(env_store.COLUMNS_DIR.glob("CRASHED_*")), "recovery left an unregistered value file"
+        finally:
+            os.chdir(cwd)
+    print("writers killed while writing the value file and the version table: OK")
+
+
+if __name__ == "__main__":
+    stress_test(*(int(arg) for arg in sys.argv[1:3]))
+    crash_test()
@@ -0,0 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+from utils import shared_arrays
+from utils.env_store import commit_file
+from utils.geometry_cache import CACHE_DIR
+from utils.metrics import calculate_metrics
+from utils.models import DEFAULT_PARAMETERS, MODEL_NAMES, WEIGHTED_MODELS, build_estimator, held_out_predictions, \
+    weight_config
+from utils.spatial_weights import WeightCache
+from utils.tracing import span
+
+# Leave-One-Out Cross-Validation on a process pool. X, y and the leave-one-out weight matrix are put into shared
+# memory once, the workers get chunks of fold indices. Completed folds are checkpointed, an interrupted evaluation
+# with the same model, parameters and data resumes where it stopped:
+# python -m utils.loocv [model] [exact|approximate] [processes] runs it on a synthetic dataset
+#
+# "exact" refits per fold. For the weighted models only the local model of the left-out point depends on it, so a
+# fold is one local fit with the weights of that point among the n - 1 others.
+# "approximate" needs a single fit: out-of-bag predictions for RF, the leave-local-out predictions of one fit
+# for STRF/GWR (bandwidths computed with the point itself among the data), and the closed-form
+# (hat matrix) leave-one-out residuals for LR, which are exact.
+
+CHECKPOINT_DIR = CACHE_DIR / "loocv"
+MODES = ("exact", "approximate")
+FOLDS_PER_TASK = 8
+
+
+def run_key(model, params, mode, X, y, coords=None):
+    digest = hashlib.sha256(f"{model}|{sorted(params.items())}|{mode}".encode())
+    for array in (X, y) + ((coords,) if coords is not None else ()):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _read_checkpoint(path, n):
+    predictions = np.full(n, np.nan)
+    if path.exists():
+        table = feather.read_table(path)
+        predictions[table.column("fold").to_numpy()] = table.column("y_pred").to_numpy()
+    return predictions
+
+
+def _write_checkpoint(path, predictions):
+    done = np.flatnonzero(~np.isnan(predictions))
+    table = pa.table({"fold": pa.array(done, pa.int64()), "y_pred": pa.array(predictions[done], pa.float64())})
+    commit_file(path, lambda f: feather.write_feather(table, f, compression="uncompressed"))
+
+
+def _weight_row(weights, i):
+    if isinstance(weights, np.ndarray):
+        columns = np.flatnonzero(weights[i])
+        return columns, weights[i, columns]
+    start, end = weights.indptr[i], weights.indptr[i + 1]
+    return weights.indices[start:end], weights.data[start:end]
+
+
+def _folds(model, params, folds):
+    from sklearn.base import clone
+    X, y = shared_arrays.array("X"), shared_arrays.array("y")
+    predictions = np.empty(len(folds))
+    if model in WEIGHTED_MODELS:
+        weights = shared_arrays.matrix("W")
+        local_estimator = build_estimator(model, params).local_estimator
+        for position, i in enumerate(folds):
+            columns, row_weights = _weight_row(weights, i)
+            estimator = clone(local_estimator).fit(X[columns], y[columns], sample_weight=row_weights)
+            predictions[position] = estimator.predict(X[i:i + 1])[0]
+    else:
+        estimator = build_estimator(model, params, n_jobs=1)
+        train = np.ones(len(y), dtype=bool)
+        for position, i in enumerate(folds):
+            train[i] = False
+            predictions[position] = clone(estimator).fit(X[train], y[train]).predict(X[i:i + 1])[0]
+            train[i] = True
+    return folds, predictions
+
+
+def _approximate(model, params, X, y, coords, n_jobs, weight_cache):
+    if model == "LR":
+        # leave-one-out residual of ordinary least squares: e_i / (1 - h_ii)
+        design = np.column_stack([np.ones(len(X)), X])
+        q, _ = np.linalg.qr(design)
+        leverage = np.sum(q ** 2, axis=1)
+        residuals = y - build_estimator(model, params).fit(X, y).predict(X)
+        return y - residuals / (1 - leverage)
+    if model == "RF":
+        estimator = build_estimator(model, {**params, "oob_score": True}, n_jobs=n_jobs or -1)
+        return estimator.fit(X, y).oob_prediction_
+    weights = weight_cache.weights(*weight_config(params))
+    return held_out_predictions(model, params, X, y, weights, n_jobs=n_jobs or -1)
+
+
+def loocv(model, params, X, y, coords=None, mode="exact", processes=None, checkpoint=True, progress=None,
+          weight_cache=None):
+    # held-out prediction for every point; progress(done, total) is called as folds complete. In the approximate
+    # mode processes is the n_jobs of the single fit. weight_cache is an optional WeightCache of coords the caller
+    # already built the weights of the fit with
+    if mode not in MODES:
+        raise ValueError(f"Unknown LOOCV mode: {mode}")
+    X, y = np.asarray(X, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if mode == "approximate":
+        return _approximate(model, params, X, y, coords, processes, weight_cache or WeightCache(coords))
+
+    n = len(y)
+    path = CHECKPOINT_DIR / f"{model}.{run_key(model, params, mode, X, y, coords)}.feather"
+    predictions = _read_checkpoint(path, n) if checkpoint else np.full(n, np.nan)
+    remaining = np.flatnonzero(np.isnan(predictions))
+    if progress:
+        progress(n - len(remaining), n)
+    if len(remaining) == 0:
+        return predictions
+
+    with shared_arrays.SharedArrays() as shared:
+        shared.put("X", X)
+        shared.put("y", y)
+        if model in WEIGHTED_MODELS:
+            weight_cache = weight_cache or WeightCache(coords)
+            shared.put_matrix("W", weight_cache.weights(*weight_config(params), leave_one_out=True))
+
+        processes = processes or os.cpu_count()
+        chunks = np.array_split(remaining, max(1, len(remaining) // FOLDS_PER_TASK))
+        with span("loocv.parallel_folds", model=model, folds=len(remaining), processes=processes), \
+                ProcessPoolExecutor(processes, initializer=shared_arrays.attach, initargs=(shared.specs,)) as pool:
+            futures = [pool.submit(_folds, model, params, chunk) for chunk in chunks]
+            try:
+                for future in as_completed(futures):
+                    folds, values = future.result()
+                    predictions[folds] = values
+                    if checkpoint:
+                        _write_checkpoint(path, predictions)
+                    if progress:
+                        progress(int(np.count_nonzero(~np.isnan(predictions))), n)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    # a finished evaluation does not need its checkpoint any more
+    path.unlink(missing_ok=True)
+    return predictions
+
+
+def evaluate(model, params, X, y, coords=None, mode="exact", processes=None, checkpoint=True, progress=None,
+             weight_cache=None):
+    start = time.time()
+    predictions = loocv(model, params, X, y, coords, mode, processes, checkpoint, progress, weight_cache)
+    return {**calculate_metrics(np.asarray(y, dtype=np.float64), predictions), "time": time.time() - start}, \
+        predictions
+
+
+if __name__ == "__main__":
+    from utils.models import synthetic_dataset
+    model = sys.argv[1] if len(sys.argv) > 1 else "RF"
+    mode = sys.argv[2] if len(sys.argv) > 2 else "exact"
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    X, y, coords = synthetic_dataset()
+    metrics, _ = evaluate(model, DEFAULT_PARAMETERS[model], X, y, coords, mode, processes,
+                          progress=lambda done, total: print(f"\r{done}/{total} folds", end="", flush=True))
+    print(f"\n{MODEL_NAMES[model]} ({mode} LOOCV): " + ", ".join(f"{name} {value:.3f}"
+                                                                 for name, value in metrics.items()))
@@ -1,21 +1,138 @@
+import sys
 import numpy as np
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+import pandas as pd
 
-def calculate_metrics(y_true, y_pred):
-    if hasattr(y_true, 'values'):
-        y_true = y_true.values.flatten()
-    if hasattr(y_pred, 'values'):
-        y_pred = y_pred.values.flatten()
-    mae = mean_absolute_error(y_true, y_pred)
-    mse = mean_squared_error(y_true, y_pred)
-    rmse = np.sqrt(mse)
-    r2 = r2_score(y_true, y_pred)
+# metrics of held-out predictions, vectorized over models: predictions of m models for the same n targets are an
+# (m, n) matrix and every metric is computed for all of them from the same residual matrix. Bootstrap intervals
+# resample the regions once per replicate and score every model on the same replicates (a paired bootstrap), so
+# the intervals of metric differences between models are meaningful:
+# python -m utils.metrics [models] compares approximate-LOOCV predictions of the models on a synthetic dataset
+
+METRICS = ("mae", "rmse", "r2", "mean_true", "mean_pred", "std_true", "std_pred")
+N_RESAMPLES = 2000
+CONFIDENCE = 0.95
+# bootstrap replicates scored per matrix product, bounds the (batch, n) weight matrix
+RESAMPLE_BATCH = 250
+
+
+def _as_vector(values):
+    return np.asarray(values.values if hasattr(values, "values") else values, dtype=np.float64).ravel()
+
+
+def _as_matrix(y_pred):
+    return np.atleast_2d(np.asarray(y_pred.values if hasattr(y_pred, "values") else y_pred, dtype=np.float64))
+
+
+def _r2(sse, sst):
+    # sklearn's convention for a constant target: 1 for a perfect fit, 0 otherwise
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(sst > 0, 1 - sse / np.where(sst > 0, sst, 1), np.where(sse == 0, 1.0, 0.0))
+
+
+def score_models(y_true, y_pred):
+    # every metric of METRICS for each row of y_pred (m, n), as arrays of length m
+    y_true, y_pred = _as_vector(y_true), _as_matrix(y_pred)
+    n = len(y_true)
+    residuals = y_pred - y_true
+    sse = np.einsum("ij,ij->i", residuals, residuals)
+    mean_pred = y_pred.mean(axis=1)
+    mean_true = y_true.mean()
+    sst = float(np.dot(y_true - mean_true, y_true - mean_true))
     return {
-        'mae': mae,
-        'rmse': rmse,
-        'r2': r2,
-        'mean_true': np.mean(y_true),
-        'mean_pred': np.mean(y_pred),
-        'std_true': np.std(y_true),
-        'std_pred': np.std(y_pred)
-    }
\ No newline at end of file
+        "mae": np.abs(residuals).sum(axis=1) / n,
+        "rmse": np.sqrt(sse / n),
+        "r2": _r2(sse, sst),
+        "mean_true": np.full(len(y_pred), mean_true),
+        "mean_pred": mean_pred,
+        "std_true": np.full(len(y_pred), np.sqrt(sst / n)),
+        "std_pred": y_pred.std(axis=1),
+    }
+
+
+def calculate_metrics(y_true, y_pred):
+    # point estimates for a single model, the row format of MODELS.csv
+    return {name: float(values[0]) for name, values in score_models(y_true, _as_vector(y_pred)).items()}
+
+
+def bootstrap_metrics(y_true, y_pred, n_resamples=N_RESAMPLES, seed=0):
+    # MAE and R² of every model on n_resamples bootstrap replicates, as two (n_resamples, m) arrays. A replicate is a
+    # vector of multinomial counts, so a batch of replicates is scored with matrix products instead of
+    # materialized resamples
+    y_true, y_pred = _as_vector(y_true), _as_matrix(y_pred)
+    n = len(y_true)
+    absolute, squared = np.abs(y_pred - y_true).T, ((y_pred - y_true) ** 2).T
+    # the sum of squares of a replicate from its sums, around the overall mean so that large values do not cancel
+    centered = y_true - y_true.mean()
+    rng = np.random.default_rng(seed)
+    mae, r2 = np.empty((n_resamples, len(y_pred))), np.empty((n_resamples, len(y_pred)))
+    for start in range(0, n_resamples, RESAMPLE_BATCH):
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=min(RESAMPLE_BATCH, n_resamples - start)).astype(float)
+        replicates = slice(start, start + len(counts))
+        mae[replicates] = counts @ absolute / n
+        sst = np.maximum(counts @ centered ** 2 - (counts @ centered) ** 2 / n, 0)
+        r2[replicates] = _r2(counts @ squared, sst[:, None])
+    return mae, r2
+
+
+def _interval(samples, confidence):
+    return np.quantile(samples, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+
+
+def compare_models(y_true, predictions, reference=None, n_resamples=N_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    # one row per model of predictions (name -> y_pred): point metrics, percentile intervals of MAE and R², and the
+    # interval of each model's MAE and R² difference to the reference model (by default the one with the lowest MAE)
+    names = list(predictions)
+    y_pred = np.vstack([_as_vector(predictions[name]) for name in names])
+    table = pd.DataFrame(score_models(y_true, y_pred), index=pd.Index(names, name="model"))
+    reference = table["mae"].idxmin() if reference is None else reference
+    mae, r2 = bootstrap_metrics(y_true, y_pred, n_resamples, seed)
+    column = names.index(reference)
+    for metric, samples in (("mae", mae), ("r2", r2)):
+        table[f"{metric}_low"], table[f"{metric}_high"] = _interval(samples, confidence)
+        differences = samples - samples[:, [column]]
+        table[f"{metric}_diff"] = table[metric] - table.loc[reference, metric]
+        table[f"{metric}_diff_low"], table[f"{metric}_diff_high"] = _interval(differences, confidence)
+    return table
+
+
+def region_groups(nuts_ids, level="country"):
+    # NUTS ids truncated to a coarser level: "country" is the two-letter prefix, 0-3 the NUTS level
+    length = 2 if level in ("country", 0) else 2 + int(level)
+    return np.array([nuts_id[:length] for nuts_id in nuts_ids])
+
+
+def grouped_errors(y_true, predictions, nuts_ids, level="country"):
+    # per model and region group: number of regions, MAE, RMSE and bias (mean residual), long format
+    y_true = _as_vector(y_true)
+    names = list(predictions)
+    residuals = np.vstack([_as_vector(predictions[name]) for name in names]) - y_true
+    groups, inverse = np.unique(region_groups(nuts_ids, level), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(groups))
+    # (m, n) residuals summed per group, memory linear in the regions
+    per_group = lambda values: np.vstack([np.bincount(inverse, weights=row, minlength=len(groups)) for row in values])
+    absolute, squared, signed = per_group(np.abs(residuals)), per_group(residuals ** 2), per_group(residuals)
+    return pd.DataFrame({
+        "group": np.tile(groups, len(names)),
+        "model": np.repeat(names, len(groups)),
+        "n": np.tile(counts, len(names)),
+        "mae": (absolute / counts).ravel(),
+        "rmse": np.sqrt(squared / counts).ravel(),
+        "bias": (signed / counts).ravel(),
+    })
+
+
+if __name__ == "__main__":
+    import time
+    from utils.loocv import loocv
+    from utils.models import DEFAULT_PARAMETERS, synthetic_dataset
+    models = sys.argv[1].split(",") if len(sys.argv) > 1 else ["RF", "GWR", "LR"]
+    X, y, coords = synthetic_dataset()
+    predictions = {model: loocv(model, DEFAULT_PARAMETERS[model], X, y, coords, "approximate") for model in models}
+
+    start = time.time()
+    table = compare_models(y, predictions)
+    print(f"{N_RESAMPLES} paired bootstrap replicates of {len(models)} models in {time.time() - start:.3f}s")
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.precision", 3):
+        print(table)
+        nuts_ids = [f"{'ABCDE'[i % 5]}{'XY'[i % 2]}{i % 3}{i % 4}{i % 7}" for i in range(len(y))]
+        print(grouped_errors(y, predictions, nuts_ids).pivot(index="group", columns="model", values="mae"))
@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+from filelock import FileLock
+import pandas as pd
+from utils.env_store import LOCK_TIMEOUT, commit_file
+from utils.geometry_cache import CACHE_DIR, file_hash
+from utils.models import format_parameters, parse_parameters
+from utils.predictions import write_predictions
+
+# MODELS.csv is the registry of trained models: one row per model, appended when a training job finishes. It stays
+# the published source of truth; reads go to an SQLite index of it (data/cache/models.sqlite) with the parsed
+# parameters in their own table and indexes on id, creation date and model name. The index records the hash of the
+# MODELS.csv it was built from and is rebuilt when the file changed behind its back (a git pull, a manual edit)
+MODELS_PATH = Path("data") / "MODELS.csv"
+INDEX_PATH = CACHE_DIR / "models.sqlite"
+LOCK_PATH = CACHE_DIR / "models.lock"
+METRIC_COLUMNS = ["mae", "rmse", "r2", "mean_true", "mean_pred", "std_true", "std_pred"]
+COLUMNS = ["model_id", "model_name", "creation_date", "parameters", "env_data_version"] + METRIC_COLUMNS
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS models (
+    model_id INTEGER PRIMARY KEY,
+    model_name TEXT NOT NULL,
+    creation_date TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    env_data_version INTEGER,
+    {", ".join(f"{name} REAL" for name in METRIC_COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS models_creation_date ON models (creation_date);
+CREATE INDEX IF NOT EXISTS models_model_name ON models (model_name, creation_date);
+CREATE TABLE IF NOT EXISTS parameters (
+    model_id INTEGER NOT NULL REFERENCES models (model_id),
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (model_id, name)
+);
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters (name, value);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def registry_lock():
+    LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    return FileLock(LOCK_PATH, timeout=LOCK_TIMEOUT)
+
+
+def registry_key():
+    # changes with every write to MODELS.csv, for caches of anything read from the registry
+    return file_hash(MODELS_PATH) if MODELS_PATH.exists() else ""
+
+
+def _connect():
+    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(INDEX_PATH, timeout=LOCK_TIMEOUT)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _indexed_key(connection):
+    row = connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+    return row[0] if row else None
+
+
+def _insert(connection, rows):
+    columns = ", ".join(COLUMNS)
+    connection.executemany(f"INSERT INTO models ({columns}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                           [tuple(row[name] for name in COLUMNS) for row in rows])
+    connection.executemany("INSERT INTO parameters (model_id, name, value) VALUES (?, ?, ?)",
+                           [(row["model_id"], name, _sql_value(value))
+                            for row in rows for name, value in parse_parameters(row["parameters"]).items()])
+
+
+def _sql_value(value):
+    # ints, floats and strings are stored as they are, anything else (None, tuples) by its repr
+    return value if isinstance(value, (int, float, str)) and not isinstance(value, bool) else repr(value)
+
+
+def _rebuild(connection, key):
+    # round_trip parsing keeps the metrics identical to the text of the file
+    models = pd.read_csv(MODELS_PATH, sep=";", float_precision="round_trip") \
+        if MODELS_PATH.exists() else pd.DataFrame(columns=COLUMNS)
+    models["parameters"] = models["parameters"].fillna("")
+    rows = models[COLUMNS].astype(object).where(models[COLUMNS].notna(), None).to_dict("records")
+    with connection:
+        connection.execute("DELETE FROM parameters")
+        connection.execute("DELETE FROM models")
+        _insert(connection, rows)
+        connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (key,))
+
+
+@contextmanager
+def _index():
+    # a connection to the index of the current MODELS.csv; a stale index is rebuilt under the registry lock
+    connection = _connect()
+    try:
+        if _indexed_key(connection) != registry_key():
+            with registry_lock():
+                key = registry_key()
+                if _indexed_key(connection) != key:
+                    _rebuild(connection, key)
+        yield connection
+    finally:
+        connection.close()
+
+
+def list_models(model_name=None, since=None, until=None, env_data_version=None, parameters=None, limit=None):
+    # models matching every given filter, newest first; since/until are "%Y-%m-%d[ %H:%M:%S]" strings and
+    # parameters a dict of parameter values that have to match exactly
+    conditions, arguments = [], []
+    for column, operator, value in (("model_name", "=", model_name), ("creation_date", ">=", since),
+                                    ("creation_date", "<=", until), ("env_data_version", "=", env_data_version)):
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            arguments.append(value)
+    for name, value in (parameters or {}).items():
+        conditions.append("EXISTS (SELECT 1 FROM parameters p WHERE p.model_id = models.model_id "
+                          "AND p.name = ? AND p.value = ?)")
+        arguments += [name, _sql_value(value)]
+    query = f"SELECT {', '.join(COLUMNS)} FROM models" + (f" WHERE {' AND '.join(conditions)}" if conditions else "") \
+        + " ORDER BY creation_date DESC, model_id DESC" + (" LIMIT ?" if limit is not None else "")
+    with _index() as connection:
+        return pd.read_sql_query(query, connection, params=arguments + ([limit] if limit is not None else []))
+
+
+def read_models():
+    # every registered model in id order, the layout of MODELS.csv
+    with _index() as connection:
+        return pd.read_sql_query(f"SELECT {', '.join(COLUMNS)} FROM models ORDER BY model_id", connection)
+
+
+def model_parameters(model_id):
+    with _index() as connection:
+        return dict(connection.execute("SELECT name, value FROM parameters WHERE model_id = ?", (int(model_id),)))
+
+
+def add_model(model_name, parameters, env_data_version, metrics, nuts_ids, y_pred, artifacts=None):
+    # the id is allocated as max + 1 under the registry lock; the predictions file and whatever artifacts(model_id)
+    # writes are committed first and the registry row last, so a model is only listed once its files exist. Existing
+    # rows are kept byte for byte
+    with _index() as connection, registry_lock():
+        if _indexed_key(connection) != registry_key():
+            _rebuild(connection, registry_key())
+        text = MODELS_PATH.read_text(encoding="utf-8") if MODELS_PATH.exists() else ";".join(COLUMNS) + "\n"
+        model_id = (connection.execute("SELECT MAX(model_id) FROM models").fetchone()[0] or 0) + 1
+
+        write_predictions(model_id, nuts_ids, y_pred)
+        if artifacts is not None:
+            artifacts(model_id)
+        row = {"model_id": model_id, "model_name": model_name,
+               "creation_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "parameters": format_parameters(parameters), "env_data_version": int(env_data_version),
+               **{name: float(metrics[name]) for name in METRIC_COLUMNS}}
+        line = ";".join(repr(row[name]) if name in METRIC_COLUMNS else str(row[name]) for name in COLUMNS) + "\n"
+        if text and not text.endswith("\n"):
+            text += "\n"
+        commit_file(MODELS_PATH, lambda f: f.write((text + line).encode("utf-8")))
+
+        # the index follows the new row instead of being rebuilt from the file it was just appended to
+        with connection:
+            _insert(connection, [row])
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (registry_key(),))
+    return model_id
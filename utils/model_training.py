@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import signal
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.env_store import latest_version, read_dataset, variables
+from utils.fitted_models import write_fitted
+from utils.loocv import evaluate
+from utils.model_registry import add_model, read_models
+from utils.models import MODEL_NAMES, TICKS_PATH, WEIGHTED_MODELS, build_estimator, parse_parameters, \
+    training_data_available, weight_config
+from utils.spatial_weights import WeightCache
+from utils.tracing import BACKGROUND, RUN_FIELDS, TRACER, span, use_run
+
+# training of one model on the tick data joined to an env_data_version of the NUTS3 store, followed by a LOOCV
+# evaluation, predictions for every NUTS3 region and the registration of the model in MODELS.csv
+# python -m utils.model_training refit [model ids] stores the fitted models of the published models
+
+TARGET = "tick_abundance"
+COORDINATES = ["CENTER_X", "CENTER_Y"]
+# the published models were evaluated with an exact LOOCV, the page compares new models against their metrics
+EVALUATION_MODE = "exact"
+# registered before fitted models were stored, see refit()
+PUBLISHED_MODELS = (1, 2, 3, 4)
+# the stage that commits the model; from its start on the training can no longer be cancelled
+COMMIT_STAGE = "Saving the model"
+
+
+def _features(dataset, version):
+    return dataset[variables(version) + COORDINATES]
+
+
+def load_training_data(version=None):
+    # X/y/coords of the sampled regions and X/coords of every region, all with the same feature columns
+    version = latest_version() if version is None else int(version)
+    dataset = read_dataset(version)
+    ticks = pd.read_csv(TICKS_PATH, sep=";", usecols=["NUTS_ID", TARGET])
+    sampled = dataset.merge(ticks, on="NUTS_ID", how="inner")
+    return _training_data(dataset, sampled, sampled[TARGET].to_numpy(dtype=float), version)
+
+
+def synthetic_training_data(version=None, n=551, seed=0):
+    # real regions and environmental variables of the store with a synthetic target, for testing the training
+    # path without the confidential tick data
+    version = latest_version() if version is None else int(version)
+    dataset = read_dataset(version)
+    rng = np.random.default_rng(seed)
+    sampled = dataset.iloc[np.sort(rng.choice(len(dataset), min(n, len(dataset)), replace=False))]
+    features = _features(sampled, version).to_numpy(dtype=float)
+    scaled = (features - np.nanmean(features, axis=0)) / (np.nanstd(features, axis=0) + 1e-9)
+    signal = np.exp(0.5 * np.nan_to_num(scaled[:, 0]) - 0.2 * np.nan_to_num(scaled[:, -1]) ** 2)
+    return _training_data(dataset, sampled, 40 * signal * rng.gamma(2, 0.5, len(sampled)), version)
+
+
+def _training_data(dataset, sampled, y, version):
+    complete = _features(sampled, version).notna().all(axis=1).to_numpy()
+    return {
+        "X": _features(sampled, version).to_numpy(dtype=float)[complete],
+        "y": y[complete],
+        "coords": sampled[COORDINATES].to_numpy(dtype=float)[complete],
+        "nuts_ids": dataset["NUTS_ID"].to_numpy(dtype=str),
+        "X_all": _features(dataset, version).to_numpy(dtype=float),
+        "coords_all": dataset[COORDINATES].to_numpy(dtype=float),
+        "columns": list(_features(dataset, version).columns),
+        "env_data_version": version,
+    }
+
+
+def train_model(model, params, data, n_jobs=-1, progress=None, evaluation=EVALUATION_MODE):
+    # progress(fraction, stage) is called when a stage starts; returns the new model id, its metrics and the
+    # duration of every stage
+    progress = progress or (lambda fraction, stage: None)
+    timings = {}
+
+    @contextmanager
+    def stage(fraction, name):
+        progress(fraction, name)
+        start = time.time()
+        yield
+        timings[name] = time.time() - start
+
+    X, y, coords = data["X"], data["y"], data["coords"]
+    estimator = build_estimator(model, params, n_jobs)
+    # the evaluation reuses the weights of the fit and the neighbour search they were built with
+    weight_cache = WeightCache(coords) if model in WEIGHTED_MODELS else None
+    with stage(0.05, "Weight matrix"):
+        weights = weight_cache.weights(*weight_config(params)) if model in WEIGHTED_MODELS else None
+
+    with stage(0.15, "Evaluation (LOOCV)"):
+        metrics, _ = evaluate(model, params, X, y, coords, evaluation,
+                              processes=n_jobs if evaluation == "approximate" else max(n_jobs, 0) or None,
+                              weight_cache=weight_cache)
+
+    with stage(0.5, "Fitting the model"), span("model.parallel_fit", model=model, n_jobs=n_jobs):
+        if model in WEIGHTED_MODELS:
+            estimator.fit(X, y, coordinate_vector_list=[coords], weight_matrix=weights.copy())
+        else:
+            estimator.fit(X, y)
+
+    with stage(0.7, "Predicting every region"):
+        predictable = ~np.isnan(data["X_all"]).any(axis=1)
+        y_pred = np.full(len(data["nuts_ids"]), np.nan)
+        if model in WEIGHTED_MODELS:
+            local_predictions = estimator.predict_by_fit(data["X_all"][predictable],
+                                                         coordinate_vector_list=[data["coords_all"][predictable]])
+            y_pred[predictable] = np.asarray(local_predictions, dtype=float).ravel()
+        else:
+            y_pred[predictable] = estimator.predict(data["X_all"][predictable])
+
+    with stage(0.95, COMMIT_STAGE):
+        # the inference service (utils/inference.py) predicts scenarios from the stored model
+        fitted = lambda model_id: write_fitted(model_id, model, params, data["env_data_version"], data["columns"], X, y,
+                                               coords, estimator=None if model in WEIGHTED_MODELS else estimator)
+        model_id = add_model(MODEL_NAMES[model], params, data["env_data_version"], metrics, data["nuts_ids"], y_pred,
+                             artifacts=fitted)
+
+    return model_id, metrics, timings
+
+
+def refit(model_ids=PUBLISHED_MODELS, n_jobs=-1):
+    # one-off: writes the fitted model of registered models that have none, from their MODELS.csv row (model,
+    # parameters and env_data_version); their registry row, predictions and metrics are left as they are. Only the
+    # real tick data reproduces them, the inference service serves these files as the published models
+    if not training_data_available():
+        raise FileNotFoundError(f"Refitting the registered models needs the tick data in {TICKS_PATH}")
+    models = read_models().set_index("model_id")
+    codes = {name: code for code, name in MODEL_NAMES.items()}
+    data = {}
+    for model_id in model_ids:
+        if model_id not in models.index:
+            raise ValueError(f"Model {model_id} is not registered")
+        row = models.loc[model_id]
+        model, params = codes[row["model_name"]], parse_parameters(row["parameters"])
+        version = int(row["env_data_version"])
+        if version not in data:
+            data[version] = load_training_data(version)
+        X, y, coords = data[version]["X"], data[version]["y"], data[version]["coords"]
+        estimator = None if model in WEIGHTED_MODELS else build_estimator(model, params, n_jobs).fit(X, y)
+        path = write_fitted(model_id, model, params, version, data[version]["columns"], X, y, coords, estimator)
+        print(f"model {model_id} ({row['model_name']}): {path}")
+
+
+def main(model, params, n_jobs, synthetic):
+    # run by the training job runner in its own process; progress and the result are reported as JSON lines on
+    # stdout, which is reserved for them: anything the libraries print goes to stderr
+    events = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    emit = lambda event, **fields: events.write(json.dumps({"event": event, **fields}) + "\n")
+
+    def progress(fraction, stage):
+        if stage == COMMIT_STAGE:
+            # a cancellation arriving while the model is committed would leave it half registered
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        emit("progress", fraction=fraction, stage=stage, commit=stage == COMMIT_STAGE)
+
+    try:
+        progress(0.0, "Loading the data")
+        start = time.time()
+        data = synthetic_training_data() if synthetic else load_training_data()
+        loaded = time.time() - start
+        # every sub-span of the training (weights, LOOCV folds, fit) is recorded and sent back with the result, the
+        # job runner records them under the rerun that submitted the job
+        with use_run({"session": BACKGROUND, "rerun": None, "page": None, "sampled": True}):
+            model_id, metrics, timings = train_model(model, params, data, n_jobs, progress=progress)
+        spans = [{key: value for key, value in json.loads(line).items() if key not in RUN_FIELDS}
+                 for line in TRACER.export().splitlines()]
+        emit("done", model_id=model_id, metrics={name: float(value) for name, value in metrics.items()},
+             timings={"Loading the data": loaded, **timings}, spans=spans)
+    except Exception as e:
+        emit("failed", message=f"Training failed: {e}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["refit"]:
+        refit(tuple(int(arg) for arg in sys.argv[2:]) or PUBLISHED_MODELS)
+    else:
+        # python -m utils.model_training <model> '<parameters as JSON>' <n_jobs> [synthetic]
+        main(sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3]), sys.argv[4:5] == ["synthetic"])
@@ -0,0 +1,93 @@
+import ast
+from pathlib import Path
+import numpy as np
+
+# the four model families of MODELS.csv; the geographically weighted ones are georegression WeightModels whose
+# neighbour weights come from utils.spatial_weights. sklearn and georegression are imported where an estimator is
+# built, the pages only need the names and parameters
+MODEL_NAMES = {
+    "STRF": "Spatiotemporal Random Forest",
+    "RF": "Random Forest",
+    "GWR": "Geographically Weighted Regression",
+    "LR": "Linear Regression",
+}
+WEIGHTED_MODELS = ("STRF", "GWR")
+# parameters that define the weight matrix, every other parameter only changes the estimator
+WEIGHT_PARAMETERS = ("kernel_type", "neighbour_count", "distance_measure")
+# parameters of the published models 1-4 in MODELS.csv
+DEFAULT_PARAMETERS = {
+    "STRF": {"distance_measure": "euclidean", "kernel_type": "bisquare", "neighbour_count": 0.4, "n_estimators": 50,
+             "min_samples_leaf": 8, "max_features": 4, "criterion": "absolute_error"},
+    "RF": {"n_estimators": 100, "min_samples_leaf": 8, "max_features": 11, "criterion": "absolute_error"},
+    "GWR": {"distance_measure": "euclidean", "kernel_type": "gaussian", "neighbour_count": 0.12},
+    "LR": {},
+}
+CV_FOLDS = 10
+RANDOM_STATE = 0
+# NUTS_ID;tick_abundance, one row per sampled region; confidential, not part of the public repository
+TICKS_PATH = Path("data") / "TICKS.csv"
+
+
+def training_data_available():
+    # the pages check this without importing the training code
+    return TICKS_PATH.exists()
+
+
+def parse_parameters(text):
+    # the parameters column of MODELS.csv is a stringified list of (name, value) pairs
+    if not isinstance(text, str) or not text.strip():
+        return {}
+    return dict(ast.literal_eval(text))
+
+
+def format_parameters(params):
+    return str(list(params.items()))
+
+
+def weight_config(params):
+    return tuple(params[name] for name in WEIGHT_PARAMETERS)
+
+
+def build_estimator(model, params, n_jobs=None):
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.linear_model import LinearRegression
+    estimator_params = {name: value for name, value in params.items() if name not in WEIGHT_PARAMETERS}
+    if model == "LR":
+        return LinearRegression(**estimator_params)
+    if model == "RF":
+        return RandomForestRegressor(**estimator_params, n_jobs=n_jobs, random_state=RANDOM_STATE)
+    if model not in WEIGHTED_MODELS:
+        raise ValueError(f"Unknown model: {model}")
+
+    from georegression.weight_model import WeightModel
+    if model == "STRF":
+        local_estimator = RandomForestRegressor(**estimator_params, random_state=RANDOM_STATE)
+    else:
+        local_estimator = LinearRegression(**estimator_params)
+    return WeightModel(local_estimator, **{name: params[name] for name in WEIGHT_PARAMETERS},
+                       leave_local_out=True, cache_data=True, cache_estimator=True, n_jobs=n_jobs or 1)
+
+
+def held_out_predictions(model, params, X, y, weights=None, n_jobs=None):
+    # out-of-sample predictions used for scoring a parameter combination: the weighted models fit one local model
+    # per point without the point itself (leave-local-out), the global ones are cross-validated in CV_FOLDS folds
+    from sklearn.model_selection import KFold, cross_val_predict
+    estimator = build_estimator(model, params, n_jobs)
+    if model in WEIGHTED_MODELS:
+        # WeightModel zeroes the diagonal of the matrix it gets, so it never receives a shared one
+        estimator.fit(X, y, weight_matrix=weights.copy())
+        return np.asarray(estimator.local_predict_, dtype=float)
+    folds = KFold(CV_FOLDS, shuffle=True, random_state=RANDOM_STATE)
+    return cross_val_predict(estimator, X, y, cv=folds)
+
+
+def synthetic_dataset(n=551, n_features=23, seed=0):
+    # stand-in for the confidential training data: (X, y, coords) with NUTS3-like centroids in ETRS89-LAEA metres
+    # and a non-linear, spatially varying, right-skewed target
+    rng = np.random.default_rng(seed)
+    coords = rng.uniform([2.6e6, 1.4e6], [6.5e6, 5.4e6], (n, 2))
+    X = rng.normal(size=(n, n_features))
+    east = (coords[:, 0] - 2.6e6) / 3.9e6
+    signal = np.exp(0.6 * X[:, 0] - 0.3 * X[:, 1] ** 2 + east * X[:, 2]) * (1 + 2 * east)
+    y = 40 * signal * rng.gamma(2, 0.5, n)
+    return X, y, coords
@@ -0,0 +1,14 @@
+from functools import lru_cache
+from utils.env_store import GEOMETRY_COLUMNS, read_nuts_ids, store_key, variables
+
+
+@lru_cache(maxsize=4)
+def _nuts3_index(key):
+    nuts3 = tuple(read_nuts_ids())
+    return frozenset(nuts3), nuts3, tuple(GEOMETRY_COLUMNS + variables())
+
+
+def load_nuts3_index():
+    # (set of codes, codes in store order, column names) of the current NUTS3 dataset; the codes are read from the
+    # NUTS_ID column of the memory-mapped geometry file and the names from the version table, without geometry I/O
+    return _nuts3_index(store_key())
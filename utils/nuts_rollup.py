@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from utils.env_store import commit_file, geometry_key, read_geometry, read_snapshot
+from utils.geometry_cache import CACHE_DIR, SIMPLIFY_TOLERANCE
+from utils.tracing import span
+
+# NUTS2 and NUTS1 are derived from the NUTS3 store instead of being stored on their own: a parent code is a prefix
+# of its NUTS3 codes, its attributes are the area-weighted means of its NUTS3 regions and its geometry is their
+# union. The NUTS3 areas and the dissolved, simplified parent geometries only depend on the store's geometry and are
+# cached per geometry version; the attributes are rolled up on load, so uploaded variables reach every level at once:
+# python -m utils.nuts_rollup builds the cache
+
+# length of the NUTS code of each level
+NUTS_LEVELS = {"NUTS3": 5, "NUTS2": 4, "NUTS1": 3}
+PARENT_LEVELS = ("NUTS2", "NUTS1")
+# equal-area projection the region areas are measured in
+AREA_CRS = 3035
+
+
+def parent_ids(nuts_ids, level):
+    return np.array([nuts_id[:NUTS_LEVELS[level]] for nuts_id in nuts_ids])
+
+
+def _areas_path(key):
+    return CACHE_DIR / f"nuts3_areas.{key}.feather"
+
+
+def _geometry_path(level, key):
+    return CACHE_DIR / f"{level}.{key}.feather"
+
+
+def build_hierarchy():
+    # NUTS3 areas in km² and the dissolved parent geometries, dissolved at full resolution and simplified afterwards
+    # so neighbouring parents keep a shared border
+    key = geometry_key()
+    gdf = read_geometry()[["NUTS_ID", "geometry"]]
+    areas = gdf.geometry.to_crs(epsg=AREA_CRS).area.to_numpy() / 1e6
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    table = pa.table({"NUTS_ID": pa.array(gdf["NUTS_ID"], pa.string()), "AREA_KM2": pa.array(areas, pa.float64())})
+    commit_file(_areas_path(key), lambda f: feather.write_feather(table, f, compression="uncompressed"))
+
+    for level in PARENT_LEVELS:
+        with span("geometry.dissolve", level=level):
+            parents = gdf.assign(NUTS_ID=parent_ids(gdf["NUTS_ID"], level)).dissolve(by="NUTS_ID", sort=True)
+            parents = parents.reset_index()[["NUTS_ID", "geometry"]]
+            parents["geometry"] = parents["geometry"].simplify(tolerance=SIMPLIFY_TOLERANCE)
+        commit_file(_geometry_path(level, key), lambda f: parents.to_feather(f, compression="uncompressed"))
+
+    # remove artifacts built from older versions of the geometry
+    for name in ["nuts3_areas", *PARENT_LEVELS]:
+        for old in CACHE_DIR.glob(f"{name}.*.feather"):
+            if old.name.split(".")[1] != key:
+                old.unlink(missing_ok=True)
+    return key
+
+
+def _ensure_hierarchy():
+    key = geometry_key()
+    if not all(path.exists() for path in [_areas_path(key)] + [_geometry_path(level, key) for level in PARENT_LEVELS]):
+        build_hierarchy()
+    return key
+
+
+def read_areas():
+    # km² of every NUTS3 region, in store order
+    return feather.read_table(_areas_path(_ensure_hierarchy()), memory_map=True).column("AREA_KM2").to_numpy()
+
+
+def read_parent_geometry(level):
+    import geopandas as gpd
+    return gpd.read_feather(_geometry_path(level, _ensure_hierarchy()), memory_map=True)
+
+
+def weighted_means(membership, values):
+    # (targets x sources) sparse weights times (sources x columns) values, normalized per target and column by the
+    # weights of the sources that have a value; NaN where a target has none
+    present = ~np.isnan(values)
+    weights = membership @ present.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weights > 0, (membership @ np.where(present, values, 0)) / weights, np.nan)
+
+
+def rollup(snapshot, areas, level):
+    # area-weighted mean of every attribute of the NUTS3 snapshot per parent region, with one sparse
+    # (parents x regions) product for all columns
+    ids, inverse = np.unique(parent_ids(snapshot["NUTS_ID"], level), return_inverse=True)
+    columns = [c for c in snapshot.columns if c != "NUTS_ID"]
+    from scipy import sparse
+    membership = sparse.csr_array((areas, (inverse, np.arange(len(areas)))), shape=(len(ids), len(areas)))
+    means = weighted_means(membership, snapshot[columns].to_numpy(dtype=np.float64))
+    return pd.concat([pd.DataFrame({"NUTS_ID": ids}), pd.DataFrame(means, columns=columns)], axis=1)
+
+
+def read_level(level, version=None):
+    # attributes of env_data_version (default latest) on the geometry of a NUTS level, in EPSG:4326
+    if level == "NUTS3":
+        raise ValueError("NUTS3 is read from the store, see utils/env_store.py")
+    attributes = rollup(read_snapshot(version), read_areas(), level)
+    return read_parent_geometry(level).merge(attributes, on="NUTS_ID", how="left")
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.nuts_rollup
+    print(f"geometry {build_hierarchy()}: " + ", ".join(f"{level} {len(read_parent_geometry(level))} regions"
+                                                        for level in PARENT_LEVELS))
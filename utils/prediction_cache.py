@@ -0,0 +1,59 @@
+from collections import OrderedDict
+import os
+import threading
+import streamlit as st
+
+# memory budget of the shared prediction cache, can be overridden with the TICKBOARD_PREDICTION_CACHE_MB variable
+PREDICTION_CACHE_MB = int(os.environ.get("TICKBOARD_PREDICTION_CACHE_MB", 256))
+
+
+class PredictionCache:
+    # one entry per model id, tagged with the version (content hash) of the file it was loaded from;
+    # least recently used entries are evicted when the budget is exceeded
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_id, version, loader):
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None and entry["version"] == version:
+                self._entries.move_to_end(model_id)
+                return entry["value"]
+
+        value, size = loader()
+
+        with self._lock:
+            # a new version replaces only the entry of its own model
+            self._drop(model_id)
+            self._entries[model_id] = {"version": version, "value": value, "size": size}
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+        return value
+
+    def invalidate(self, model_id):
+        with self._lock:
+            self._drop(model_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": {model_id: entry["size"] for model_id, entry in self._entries.items()},
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _drop(self, model_id):
+        entry = self._entries.pop(model_id, None)
+        if entry is not None:
+            self.total_bytes -= entry["size"]
+
+
+@st.cache_resource
+def get_prediction_cache():
+    # shared by all sessions and pages of the server process
+    return PredictionCache(PREDICTION_CACHE_MB * 1024 * 1024)
@@ -0,0 +1,133 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from utils.env_store import commit_file, geometry_key, read_nuts_ids
+from utils.geometry_cache import CACHE_DIR, file_hash
+from utils.model_registry import read_models
+from utils.predictions import prediction_source
+from utils.tracing import span
+
+# the predictions of every registered model as one dense (model, year, region) float32 array in a .npy file that is
+# memory-mapped on read: a year of a model is a view into the file, a model's years are one contiguous block. Regions
+# are in the order of the store's geometry. Predictions without a year column are a single snapshot and have the year
+# None. The cube is rebuilt when a prediction file or the geometry changes (a new model, an upload of new geometry):
+# python -m utils.prediction_cube builds it
+
+
+def _cube_path(key):
+    return CACHE_DIR / f"predictions_cube.{key}.npy"
+
+
+def _index_path(key):
+    return CACHE_DIR / f"predictions_cube.{key}.json"
+
+
+def cube_sources():
+    # (model id, predictions file) of every registered model that has predictions
+    sources = [(int(model_id), prediction_source(int(model_id))) for model_id in read_models()["model_id"]]
+    return [(model_id, path) for model_id, path in sources if path.exists()]
+
+
+def cube_key(sources=None):
+    sources = cube_sources() if sources is None else sources
+    digest = hashlib.sha256(geometry_key().encode())
+    for model_id, path in sources:
+        digest.update(f"{model_id}:{file_hash(path)};".encode())
+    return digest.hexdigest()[:16]
+
+
+def _year_order(year):
+    return (year is not None, year or 0)
+
+
+def build_cube(sources=None):
+    sources = cube_sources() if sources is None else sources
+    key = cube_key(sources)
+    regions = pd.Index(read_nuts_ids())
+    tables = {model_id: feather.read_feather(path, memory_map=True) for model_id, path in sources}
+    years = sorted({year for df in tables.values()
+                    for year in (df["year"].unique().tolist() if "year" in df.columns else [None])}, key=_year_order)
+    year_index = {year: i for i, year in enumerate(years)}
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=_cube_path(key).name + ".", suffix=".tmp")
+    os.close(fd)
+    model_years = []
+    try:
+        with span("cube.build", models=len(tables), years=len(years), regions=len(regions)):
+            cube = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32,
+                                             shape=(len(tables), len(years), len(regions)))
+            cube[:] = np.nan
+            for m, df in enumerate(tables.values()):
+                row = regions.get_indexer(df["NUTS_ID"])
+                year = (df["year"].map(year_index).to_numpy() if "year" in df.columns
+                        else np.full(len(df), year_index[None]))
+                known = row >= 0
+                cube[m, year[known], row[known]] = df["y_pred"].to_numpy(dtype=np.float32)[known]
+                model_years.append([years[i] for i in np.unique(year[known]).tolist()])
+            cube.flush()
+            del cube
+        os.replace(tmp, _cube_path(key))
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+    # the index is written last, a cube is only used once both files exist
+    index = {"models": list(tables), "years": years, "model_years": model_years}
+    commit_file(_index_path(key), lambda f: f.write(json.dumps(index).encode("utf-8")))
+    for old in CACHE_DIR.glob("predictions_cube.*"):
+        if old.name.split(".")[1] != key and not old.name.endswith(".tmp"):
+            old.unlink(missing_ok=True)
+    return key
+
+
+class PredictionCube:
+    # read-only view of the cube shared by every session
+
+    def __init__(self, key):
+        index = json.loads(_index_path(key).read_text(encoding="utf-8"))
+        self.key = key
+        self.values = np.load(_cube_path(key), mmap_mode="r")
+        self.models = index["models"]
+        self.years = index["years"]
+        self._model = {model_id: i for i, model_id in enumerate(self.models)}
+        self._year = {year: i for i, year in enumerate(self.years)}
+        self._model_years = dict(zip(self.models, index["model_years"]))
+        self._ranges = {}
+
+    def model_years(self, model_id):
+        # the years a model has predictions for, oldest first; [None] for a single snapshot
+        return self._model_years.get(model_id, [])
+
+    def slice(self, model_id, year):
+        # a read-only view of one year of a model, no copy
+        return self.values[self._model[model_id], self._year[year]]
+
+    def frames(self, model_id):
+        # every year of a model as a (years x regions) array
+        return self.values[self._model[model_id], [self._year[year] for year in self.model_years(model_id)]]
+
+    def value_range(self, model_id):
+        # over all years of a model, so that the colors of different years are comparable
+        if model_id not in self._ranges:
+            from utils.coloring import value_range
+            self._ranges[model_id] = value_range(self.values[self._model[model_id]])
+        return self._ranges[model_id]
+
+
+def read_cube(key=None):
+    key = cube_key() if key is None else key
+    if not _index_path(key).exists():
+        key = build_cube()
+    return PredictionCube(key)
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.prediction_cube
+    cube = read_cube()
+    print(f"cube {cube.key}: {len(cube.models)} models x {len(cube.years)} years x {cube.values.shape[2]} regions")
@@ -0,0 +1,46 @@
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from utils.env_store import commit_file
+
+# every model's predictions are a compact (NUTS_ID, y_pred) table; geometry is joined at render time from the
+# shared NUTS3 store since all models predict over the same regions. A model that predicts several years stores one
+# row per region and year with an additional year column; the latest year is its default view, every year is in the
+# prediction cube (utils/prediction_cube.py)
+PREDICTIONS_DIR = Path("data") / "predictions"
+
+
+def prediction_source(model_id):
+    target = PREDICTIONS_DIR / f"{model_id}_MODEL_PREDICTIONS.feather"
+    if not target.exists():
+        legacy = PREDICTIONS_DIR / f"{model_id}_MODEL_PREDICTIONS.gpkg"
+        if legacy.exists():
+            # older predictions were full GeoPackages, only their attributes are kept
+            import geopandas as gpd
+            df = gpd.read_file(legacy, columns=["NUTS_ID", "y_pred"], ignore_geometry=True)
+            write_predictions(model_id, df["NUTS_ID"], df["y_pred"])
+    return target
+
+
+def prediction_table(nuts_ids, y_pred, years=None):
+    columns = {"NUTS_ID": pa.array(list(nuts_ids), pa.string()), "y_pred": pa.array(list(y_pred), pa.float64())}
+    if years is not None:
+        columns["year"] = pa.array(list(years), pa.int32())
+    return pa.table(columns)
+
+
+def write_predictions(model_id, nuts_ids, y_pred, years=None):
+    table = prediction_table(nuts_ids, y_pred, years)
+    target = PREDICTIONS_DIR / f"{model_id}_MODEL_PREDICTIONS.feather"
+    commit_file(target, lambda f: feather.write_feather(table, f, compression="uncompressed"))
+    return target
+
+
+def read_predictions(model_id, nuts_ids, year=None):
+    # y_pred aligned to the given region order, NaN where the model has no prediction; of a yearly model the given
+    # year, by default the latest one
+    df = feather.read_feather(prediction_source(model_id), memory_map=True)
+    if "year" in df.columns:
+        df = df[df["year"] == (df["year"].max() if year is None else year)]
+    return df.set_index("NUTS_ID")["y_pred"].reindex(pd.Index(nuts_ids)).to_numpy(dtype=float)
@@ -0,0 +1,164 @@
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+import shapely
+from utils.geometry_cache import SIMPLIFY_TOLERANCE
+from utils.nuts_rollup import NUTS_LEVELS, parent_ids, read_areas, rollup
+
+# finding regions without the map: a latitude/longitude resolves to the region of every NUTS level that contains it
+# through one STRtree per level over the shapes the maps draw, a code or the start of one resolves through a binary
+# search in the sorted codes of all levels. The detail of a region (every environmental variable and every model's
+# prediction) is one row of a (region x variable) and a (region x model) matrix built once per version of the data.
+# Predictions of NUTS2 and NUTS1 regions are the area-weighted means of their NUTS3 predictions, like the variables.
+# python -m utils.region_lookup times the lookups on the current data
+
+# "48.1, 11.6", "48.1 11.6" or "48.1;11.6"
+COORDINATE_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d*)?)\s*[,; ]\s*(-?\d+(?:\.\d*)?)\s*$")
+SEARCH_LIMIT = 50
+
+
+def parse_coordinate(text):
+    # (lat, lon), or None when the text is not a coordinate
+    match = COORDINATE_PATTERN.match(text)
+    if match is None:
+        return None
+    lat, lon = float(match.group(1)), float(match.group(2))
+    return (lat, lon) if -90 <= lat <= 90 and -180 <= lon <= 180 else None
+
+
+class RegionLookup:
+    # read-only, shared by every session
+
+    def __init__(self, levels, cube, model_names):
+        # levels maps NUTS3/NUTS2/NUTS1 to the NutsLevel of load_all_data(); cube is the prediction cube, whose
+        # regions are in the order of the NUTS3 level
+        self.levels = levels
+        self._trees = {name: shapely.STRtree(level.shapes) for name, level in levels.items()}
+        self._rows = {nuts_id: (name, row) for name, level in levels.items()
+                      for row, nuts_id in enumerate(level.ids.tolist())}
+        self._codes = np.sort(np.array(list(self._rows), dtype=str))
+        self._percentiles = {name: _percentiles(level.values) for name, level in levels.items()}
+
+        self.models = list(cube.models)
+        self.model_names = [model_names.get(model_id, "") for model_id in self.models]
+        self.years = [cube.model_years(model_id)[-1] for model_id in self.models]
+        nuts3 = np.column_stack([cube.slice(model_id, year) for model_id, year in zip(self.models, self.years)]
+                                ).astype(np.float64) if self.models else np.empty((len(levels["NUTS3"]), 0))
+        self._predictions = {"NUTS3": nuts3}
+        table = pd.DataFrame(nuts3, columns=[str(model_id) for model_id in self.models])
+        table.insert(0, "NUTS_ID", levels["NUTS3"].ids)
+        areas = read_areas()
+        for name in levels:
+            if name != "NUTS3":
+                means = rollup(table, areas, name).set_index("NUTS_ID").reindex(levels[name].ids)
+                self._predictions[name] = means.to_numpy(dtype=np.float64)
+        for values in self._predictions.values():
+            values.flags.writeable = False
+
+    def locate(self, lat, lon, level="NUTS3"):
+        # the code of the region containing the point, None outside every region
+        row = self.locate_rows([lat], [lon], level)[0]
+        return self.levels[level].ids[row] if row >= 0 else None
+
+    def locate_many(self, lats, lons, level="NUTS3"):
+        # codes of the regions containing the points, "" outside every region
+        rows = self.locate_rows(lats, lons, level)
+        return np.where(rows >= 0, self.levels[level].ids[np.maximum(rows, 0)], "")
+
+    def locate_rows(self, lats, lons, level="NUTS3"):
+        # rows of the level for many points in one query, -1 outside every region; a point in a gap the
+        # simplification opened between two neighbours goes to the nearest of them
+        tree = self._trees[level]
+        points = shapely.points(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        rows = np.full(len(points), -1)
+        point_index, region_index = tree.query(points, predicate="intersects")
+        rows[point_index] = region_index
+        missing = np.flatnonzero(rows < 0)
+        if len(missing):
+            point_index, region_index = tree.query_nearest(points[missing], max_distance=SIMPLIFY_TOLERANCE,
+                                                           all_matches=False)
+            rows[missing[point_index]] = region_index
+        return rows
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        # codes of every level starting with text, a parent before its children
+        prefix = text.strip().upper()
+        if not prefix:
+            return []
+        start = np.searchsorted(self._codes, prefix, side="left")
+        end = np.searchsorted(self._codes, prefix + "\uffff", side="left")
+        return self._codes[start:min(end, start + limit)].tolist()
+
+    def resolve(self, text):
+        # the codes a search text means: the regions containing a coordinate, NUTS3 first, or the codes it starts
+        point = parse_coordinate(text)
+        if point is None:
+            return self.search(text)
+        return [nuts_id for nuts_id in (self.locate(*point, level) for level in NUTS_LEVELS) if nuts_id is not None]
+
+    def detail(self, nuts_id):
+        # None for an unknown code
+        if nuts_id not in self._rows:
+            return None
+        name, row = self._rows[nuts_id]
+        level = self.levels[name]
+        variables = pd.DataFrame({"Variable": level.columns, "Value": level.values[row],
+                                  "Percentile": self._percentiles[name][row]})
+        predictions = pd.DataFrame({"Model": self.models, "Name": self.model_names,
+                                    "Year": [year if year is not None else "" for year in self.years],
+                                    "Prediction": self._predictions[name][row]})
+        parents = [nuts_id[:length] for length in sorted(NUTS_LEVELS.values())
+                   if length < len(nuts_id) and nuts_id[:length] in self._rows]
+        return {"nuts_id": nuts_id, "level": name, "parents": parents,
+                "variables": variables, "predictions": predictions}
+
+
+def _percentiles(values):
+    # per column, the share of the regions with a value that have a lower one; NaN where a region has none
+    percentiles = np.full(values.shape, np.nan)
+    for column in range(values.shape[1]):
+        known = ~np.isnan(values[:, column])
+        ordered = np.sort(values[known, column])
+        percentiles[known, column] = np.searchsorted(ordered, values[known, column], side="left") / len(ordered) * 100
+    percentiles.flags.writeable = False
+    return percentiles
+
+
+def _check():
+    # lookup timings on the data in the working directory: python -m utils.region_lookup [points]
+    import utils.data_loader as data_loader
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    start = time.perf_counter()
+    lookup = data_loader.load_region_lookup()
+    print(f"built in {time.perf_counter() - start:.2f}s: " + ", ".join(
+        f"{name} {len(level)}" for name, level in lookup.levels.items()) + f" regions, {len(lookup.models)} models")
+
+    nuts3 = lookup.levels["NUTS3"]
+    centers = shapely.point_on_surface(nuts3.shapes)
+    lats, lons = shapely.get_y(centers), shapely.get_x(centers)
+    assert (lookup.locate_many(lats, lons) == nuts3.ids).all(), "a region does not contain its own point"
+    for name in NUTS_LEVELS:
+        assert (lookup.locate_many(lats, lons, name) == parent_ids(nuts3.ids, name)).all(), f"wrong {name} parents"
+
+    def timed(label, call, repeats=1000):
+        start = time.perf_counter()
+        for i in range(repeats):
+            call(i)
+        print(f"{label:28} {(time.perf_counter() - start) / repeats * 1e6:10.1f}µs")
+
+    timed("point", lambda i: lookup.locate(lats[i % len(lats)], lons[i % len(lons)]))
+    timed("code prefix", lambda i: lookup.search(nuts3.ids[i % len(nuts3)][:3]))
+    timed("detail", lambda i: lookup.detail(nuts3.ids[i % len(nuts3)]))
+    xmin, ymin, xmax, ymax = shapely.total_bounds(nuts3.shapes)
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    codes = lookup.locate_many(rng.uniform(ymin, ymax, n_points), rng.uniform(xmin, xmax, n_points))
+    elapsed = time.perf_counter() - start
+    print(f"{n_points} points in {elapsed * 1000:.0f}ms ({elapsed / n_points * 1e6:.2f}µs each), "
+          f"{(codes != '').mean():.0%} inside a region")
+
+
+if __name__ == "__main__":
+    _check()
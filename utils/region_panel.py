@@ -0,0 +1,41 @@
+import streamlit as st
+import utils.data_loader as data_loader
+from utils.tracing import span
+
+# detail of one region of any NUTS level, found by its code, the start of one or a "lat, lon" coordinate; shared by
+# the data overview and the prediction page. The panel is a fragment, searching only reruns the panel
+
+
+@st.fragment
+def region_detail_panel(key="region"):
+    lookup = data_loader.load_region_lookup()
+    query = st.text_input("Find a region", key=f"{key}_query",
+                          placeholder="NUTS code (e.g. DE21) or latitude, longitude",
+                          help="A NUTS code of any level or its beginning, or a coordinate such as 48.14, 11.58")
+    if not query.strip():
+        return
+    with span("region.resolve"):
+        matches = lookup.resolve(query)
+    if not matches:
+        st.info("No region matches this code or contains this coordinate.")
+        return
+    nuts_id = matches[0] if len(matches) == 1 else st.selectbox("Region", matches, key=f"{key}_match")
+
+    with span("region.detail", nuts_id=nuts_id):
+        detail = lookup.detail(nuts_id)
+    parents = " · ".join(detail["parents"])
+    st.markdown(f"##### {detail['nuts_id']} ({detail['level']})" + (f" in {parents}" if parents else ""))
+    variables_col, predictions_col = st.columns([1, 1])
+    with variables_col:
+        st.markdown("###### Environmental variables")
+        st.dataframe(detail["variables"], hide_index=True, width="stretch",
+                     column_config={"Value": st.column_config.NumberColumn(format="%.3f"),
+                                    "Percentile": st.column_config.ProgressColumn(
+                                        format="%.0f", min_value=0, max_value=100,
+                                        help=f"Share of the {detail['level']} regions with a lower value")})
+    with predictions_col:
+        st.markdown("###### Predicted tick abundance")
+        st.dataframe(detail["predictions"], hide_index=True, width="stretch",
+                     column_config={"Prediction": st.column_config.NumberColumn(format="%.2f")})
+        if detail["level"] != "NUTS3":
+            st.caption("Area-weighted mean of the NUTS3 predictions, for the latest year of every model.")
@@ -0,0 +1,72 @@
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import sparse
+
+# numpy arrays and CSR matrices in named shared memory blocks: the parent process puts them once, worker processes
+# attach to the blocks by name (SharedArrays.specs is small and picklable) instead of receiving pickled copies
+
+
+class SharedArrays:
+
+    def __init__(self):
+        self.specs = {}
+        self._blocks = []
+
+    def put(self, name, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        self._blocks.append(block)
+        self.specs[name] = ("array", block.name, array.shape, array.dtype.str)
+
+    def put_matrix(self, name, matrix):
+        # dense matrices are stored as one array, sparse ones as their CSR data, indices and indptr arrays
+        if not sparse.issparse(matrix):
+            return self.put(name, matrix)
+        matrix = sparse.csr_array(matrix)
+        for part in ("data", "indices", "indptr"):
+            self.put(f"{name}.{part}", getattr(matrix, part))
+        self.specs[name] = ("csr", matrix.shape)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# blocks attached by this process, kept open for as long as the process uses them
+_attached = {}
+_blocks = {}
+
+
+def attach(specs):
+    # also usable as a process pool initializer; the attached arrays are read-only views of the shared blocks
+    for name, spec in specs.items():
+        if spec[0] != "array" or name in _attached:
+            continue
+        _, block_name, shape, dtype = spec
+        block = _blocks.get(block_name) or shared_memory.SharedMemory(name=block_name)
+        _blocks[block_name] = block
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        _attached[name] = array
+    _attached.update({name: spec for name, spec in specs.items() if spec[0] == "csr"})
+
+
+def array(name):
+    return _attached[name]
+
+
+def matrix(name):
+    spec = _attached[name]
+    if isinstance(spec, np.ndarray):
+        return spec
+    return sparse.csr_array((array(f"{name}.data"), array(f"{name}.indices"), array(f"{name}.indptr")),
+                            shape=spec[1])
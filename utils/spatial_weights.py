@@ -0,0 +1,279 @@
+import math
+import sys
+import time
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from utils.tracing import span
+
+# neighbour weights of the geographically weighted / spatiotemporal models. The dense path mirrors
+# georegression.weight_matrix_from_points (n x n distances, adaptive bandwidth, kernel, row normalization); the
+# sparse path finds the same neighbours with a k-nearest-neighbour search and only stores those, O(n*k) memory.
+# Distances are float64, georegression's dense path rounds them to float32. Both return matrices that can be passed
+# to WeightModel.fit(X, y, weight_matrix=...);
+# python -m utils.spatial_weights [points] [neighbour_count] compares the two on synthetic points
+
+EARTH_RADIUS_KM = 6371.0
+DISTANCE_MEASURES = ("euclidean", "great-circle")
+# kernels that are exactly zero beyond the bandwidth, only these have a sparse weight matrix
+COMPACT_KERNELS = ("linear", "boxcar", "bisquare", "tricube")
+KERNELS = COMPACT_KERNELS + ("uniform", "gaussian", "exponential")
+
+
+def kernel_weights(distance, bandwidth, kernel_type):
+    # the kernel functions of georegression.kernel.kernel_function, distance and bandwidth broadcast row-wise
+    normalized = np.nan_to_num(distance / bandwidth, nan=0.0, posinf=np.inf)
+    if kernel_type in ("uniform", "boxcar"):
+        weight = np.ones_like(normalized)
+    elif kernel_type == "gaussian":
+        weight = np.exp(-0.5 * normalized ** 2)
+    elif kernel_type == "exponential":
+        weight = np.exp(-0.5 * np.abs(normalized))
+    elif kernel_type == "linear":
+        weight = 1 - normalized
+    elif kernel_type == "bisquare":
+        weight = (1 - normalized ** 2) ** 2
+    elif kernel_type == "tricube":
+        weight = (1 - np.abs(normalized) ** 3) ** 3
+    else:
+        raise ValueError(f"Unsupported kernel: {kernel_type}")
+    if kernel_type in COMPACT_KERNELS:
+        weight[distance > bandwidth] = 0
+    return weight
+
+
+def neighbour_rank(n, neighbour_count):
+    # 0-based (possibly fractional) rank of the bandwidth among the sorted distances of a row, the point itself
+    # included: an int is the k-th nearest point, a float the median-unbiased quantile numpy.quantile uses
+    if neighbour_count <= 0:
+        raise ValueError("Invalid neighbour count")
+    if isinstance(neighbour_count, (int, np.integer)):
+        if neighbour_count > n:
+            raise ValueError("Invalid neighbour count")
+        return float(neighbour_count - 1)
+    rank = n * neighbour_count + (1 + neighbour_count) / 3 - 1
+    return min(max(rank, 0.0), n - 1.0)
+
+
+def adaptive_bandwidth(sorted_distances, rank):
+    # sorted_distances only needs the columns up to ceil(rank)
+    lower = math.floor(rank)
+    fraction = rank - lower
+    below = sorted_distances[:, lower]
+    if fraction == 0:
+        return below
+    above = sorted_distances[:, lower + 1]
+    return below + (above - below) * fraction
+
+
+def _normalize_rows(weights):
+    row_sum = np.asarray(weights.sum(axis=1)).ravel()
+    # rows without any weight stay zero
+    row_sum[row_sum == 0] = 1
+    if sparse.issparse(weights):
+        return sparse.csr_array(sparse.diags_array(1 / row_sum) @ weights)
+    return weights / row_sum[:, None]
+
+
+def _check(coords, distance_measure, kernel_type):
+    coords = np.asarray(coords, dtype=np.float64)
+    if distance_measure not in DISTANCE_MEASURES:
+        raise ValueError(f"Unsupported distance measure: {distance_measure}")
+    if kernel_type not in KERNELS:
+        raise ValueError(f"Unsupported kernel: {kernel_type}")
+    if distance_measure == "great-circle" and coords.shape[1] != 2:
+        raise ValueError("Great-circle distance needs (lon, lat) coordinates")
+    return coords
+
+
+def distance_matrix(coords, distance_measure="euclidean"):
+    if distance_measure == "great-circle":
+        lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        a = np.sin((lat[None, :] - lat[:, None]) / 2) ** 2 \
+            + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin((lon[None, :] - lon[:, None]) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    return cdist(coords, coords)
+
+
+def sorted_distances(coords, distance_measure="euclidean"):
+    # the distance matrix and its row-sorted copy, what dense_weight_matrix takes as distances
+    with span("weights.distances", points=len(coords), distance_measure=distance_measure):
+        matrix = distance_matrix(coords, distance_measure)
+        return matrix, np.sort(matrix, axis=1)
+
+
+def dense_weight_matrix(coords, kernel_type="bisquare", neighbour_count=0.8, distance_measure="euclidean",
+                        distances=None, leave_one_out=False):
+    # O(n^2) reference path, also the only one for kernels without compact support; distances is an optional
+    # precomputed (distance matrix, row-sorted distance matrix) pair of the same points. With leave_one_out every
+    # row is computed as if its own point was not in the data: the bandwidth among the n - 1 others, no self-weight
+    coords = _check(coords, distance_measure, kernel_type)
+    matrix, row_sorted = distances if distances is not None else sorted_distances(coords, distance_measure)
+    rank = neighbour_rank(len(coords) - leave_one_out, neighbour_count)
+    with span("weights.kernel", points=len(coords), kernel=kernel_type, sparse=False):
+        # the point itself is one of the zeros at the start of its sorted row
+        bandwidth = adaptive_bandwidth(row_sorted[:, int(leave_one_out):], rank)
+        weights = kernel_weights(matrix, bandwidth[:, None], kernel_type)
+        if leave_one_out:
+            np.fill_diagonal(weights, 0)
+        return _normalize_rows(weights)
+
+
+def _without_self(distances, indices):
+    own = indices == np.arange(len(indices))[:, None]
+    # duplicated coordinates can push a point out of its own nearest neighbours, the farthest one is dropped instead
+    own[~own.any(axis=1), -1] = True
+    return distances[~own].reshape(len(own), -1), indices[~own].reshape(len(own), -1)
+
+
+class NeighbourIndex:
+    # k-nearest-neighbour and radius queries in the units of the distance measure (coordinate units or km)
+
+    def __init__(self, coords, distance_measure):
+        self.coords = coords
+        self.distance_measure = distance_measure
+        if distance_measure == "great-circle":
+            from sklearn.neighbors import BallTree
+            self.points = np.radians(coords[:, ::-1])
+            self.tree = BallTree(self.points, metric="haversine")
+        else:
+            self.points = coords
+            self.tree = cKDTree(coords)
+
+    def nearest(self, k):
+        if self.distance_measure == "great-circle":
+            distances, indices = self.tree.query(self.points, k=k)
+            return distances * EARTH_RADIUS_KM, indices
+        distances, indices = self.tree.query(self.points, k=k)
+        return distances.reshape(len(self.points), k), indices.reshape(len(self.points), k)
+
+    def within(self, rows, radius):
+        # indices of every point within a per-row radius, ties at exactly the radius included
+        if self.distance_measure == "great-circle":
+            return list(self.tree.query_radius(self.points[rows], r=radius / EARTH_RADIUS_KM))
+        return [np.asarray(i, dtype=np.intp) for i in self.tree.query_ball_point(self.points[rows], r=radius)]
+
+
+def sparse_weight_matrix(coords, kernel_type="bisquare", neighbour_count=0.8, distance_measure="euclidean",
+                         index=None, leave_one_out=False):
+    # every point with a non-zero weight is among the k nearest ones, k = the bandwidth rank rounded up + 1,
+    # so one k-nearest-neighbour query gives the bandwidth and all the weights of a row; index is an optional
+    # prebuilt search tree of the same points, leave_one_out as in dense_weight_matrix
+    coords = _check(coords, distance_measure, kernel_type)
+    if kernel_type not in COMPACT_KERNELS:
+        raise ValueError(f"The {kernel_type} kernel is non-zero at every distance, use dense_weight_matrix")
+    n = len(coords)
+    others = n - leave_one_out
+    rank = neighbour_rank(others, neighbour_count)
+    k = min(math.floor(rank) + 2, others)
+
+    with span("weights.neighbours", points=n, k=k, distance_measure=distance_measure):
+        index = index or NeighbourIndex(coords, distance_measure)
+        distances, indices = index.nearest(k + leave_one_out)
+    if leave_one_out:
+        distances, indices = _without_self(distances, indices)
+    with span("weights.kernel", points=n, kernel=kernel_type, sparse=True):
+        return _sparse_kernel_weights(distances, indices, rank, kernel_type, index, leave_one_out)
+
+
+def _sparse_kernel_weights(distances, indices, rank, kernel_type, index, leave_one_out):
+    n, k = indices.shape
+    bandwidth = adaptive_bandwidth(distances, rank)
+    weights = kernel_weights(distances, bandwidth[:, None], kernel_type)
+
+    rows = np.repeat(np.arange(n), k)
+    cols = indices.ravel()
+    data = weights.ravel()
+    if kernel_type == "boxcar":
+        # the boxcar kernel is still 1 at exactly the bandwidth, where ties may fall outside the k nearest points
+        tied = np.flatnonzero(distances[:, -1] <= bandwidth)
+        if len(tied):
+            keep = ~np.isin(rows, tied)
+            tied_indices = index.within(tied, bandwidth[tied])
+            if leave_one_out:
+                tied_indices = [i[i != row] for row, i in zip(tied, tied_indices)]
+            rows = np.concatenate([rows[keep]] + [np.full(len(i), row) for row, i in zip(tied, tied_indices)])
+            cols = np.concatenate([cols[keep]] + tied_indices)
+            data = np.concatenate([data[keep], np.ones(len(cols) - keep.sum())])
+
+    nonzero = data != 0
+    weights = sparse.csr_array((data[nonzero], (rows[nonzero], cols[nonzero])), shape=(n, n))
+    weights.sort_indices()
+    return _normalize_rows(weights)
+
+
+def weight_matrix(coords, kernel_type="bisquare", neighbour_count=0.8, distance_measure="euclidean"):
+    # sparse whenever the kernel allows it
+    build = sparse_weight_matrix if kernel_type in COMPACT_KERNELS else dense_weight_matrix
+    return build(coords, kernel_type, neighbour_count, distance_measure)
+
+
+class WeightCache:
+    # weight matrices of one set of points per (kernel, neighbour count, distance measure), built from distance
+    # matrices and search trees that are shared by every configuration with the same distance measure
+
+    def __init__(self, coords):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.build_times = {}
+        self._distances = {}
+        self._indexes = {}
+        self._weights = {}
+
+    def _dense_distances(self, distance_measure):
+        if distance_measure not in self._distances:
+            self._distances[distance_measure] = sorted_distances(_check(self.coords, distance_measure, "bisquare"),
+                                                                 distance_measure)
+        return self._distances[distance_measure]
+
+    def _index(self, distance_measure):
+        if distance_measure not in self._indexes:
+            with span("weights.index", points=len(self.coords), distance_measure=distance_measure):
+                self._indexes[distance_measure] = NeighbourIndex(_check(self.coords, distance_measure, "bisquare"),
+                                                                 distance_measure)
+        return self._indexes[distance_measure]
+
+    def weights(self, kernel_type, neighbour_count, distance_measure="euclidean", leave_one_out=False):
+        key = (kernel_type, neighbour_count, distance_measure) + (("leave_one_out",) if leave_one_out else ())
+        if key not in self._weights:
+            start = time.time()
+            if kernel_type in COMPACT_KERNELS:
+                weights = sparse_weight_matrix(self.coords, kernel_type, neighbour_count, distance_measure,
+                                               index=self._index(distance_measure), leave_one_out=leave_one_out)
+            else:
+                weights = dense_weight_matrix(self.coords, kernel_type, neighbour_count, distance_measure,
+                                              distances=self._dense_distances(distance_measure),
+                                              leave_one_out=leave_one_out)
+            self._weights[key] = weights
+            self.build_times[key] = time.time() - start
+        return self._weights[key]
+
+
+def compare(points=551, neighbour_count=0.8):
+    rng = np.random.default_rng(0)
+    # NUTS3-like centroids in ETRS89-LAEA metres and in lon/lat degrees
+    cases = {"euclidean": rng.uniform([2.6e6, 1.4e6], [6.5e6, 5.4e6], (points, 2)),
+             "great-circle": rng.uniform([-10, 35], [30, 70], (points, 2))}
+    for distance_measure, coords in cases.items():
+        for kernel_type in COMPACT_KERNELS:
+            start = time.time()
+            dense = dense_weight_matrix(coords, kernel_type, neighbour_count, distance_measure)
+            dense_time = time.time() - start
+            start = time.time()
+            weights = sparse_weight_matrix(coords, kernel_type, neighbour_count, distance_measure)
+            sparse_time = time.time() - start
+            difference = np.abs(weights.toarray() - dense).max()
+            assert difference < 1e-9, f"{distance_measure}/{kernel_type} weights differ by {difference}"
+            loo = sparse_weight_matrix(coords, kernel_type, neighbour_count, distance_measure, leave_one_out=True)
+            loo_dense = dense_weight_matrix(coords, kernel_type, neighbour_count, distance_measure, leave_one_out=True)
+            assert np.abs(loo.toarray() - loo_dense).max() < 1e-9, f"{distance_measure}/{kernel_type} leave-one-out"
+            stored = weights.data.nbytes + weights.indices.nbytes + weights.indptr.nbytes
+            print(f"{distance_measure:>12} {kernel_type:>8}: dense {dense_time:.3f}s {dense.nbytes / 2**20:.1f} MB, "
+                  f"sparse {sparse_time:.3f}s {stored / 2**20:.1f} MB, max difference {difference:.1e}")
+
+
+if __name__ == "__main__":
+    # a neighbour count with a decimal point is a share of the points, otherwise a number of points
+    args = sys.argv[1:3]
+    compare(int(args[0]) if args else 551,
+            (float(args[1]) if "." in args[1] else int(args[1])) if len(args) > 1 else 0.8)
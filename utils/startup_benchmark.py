@@ -0,0 +1,79 @@
+from pathlib import Path
+import json
+import os
+import subprocess
+import sys
+import time
+
+# time to first render of every page, each measured in a fresh interpreter: "cold" is a server process that has
+# imported and loaded nothing yet (warm-up off), "warm" one whose warm-up has finished. On-disk artifacts are used
+# as they are, build them first (python -m utils.warmup) to measure a deployed server:
+# python -m utils.startup_benchmark [--record] [pages...] compares against the baseline of this machine in
+# benchmarks/startup_baseline.json (--record updates it) and exits with 1 when a page got slower than TOLERANCE times
+# its baseline plus SLACK_S
+
+APP_ROOT = Path(__file__).resolve().parent.parent
+PAGES = ["About_TickBoard.py", "pages/1_Data_overview.py", "pages/2_Tick_abundance_prediction.py",
+         "pages/3_Upload_new_environmental_data.py"]
+# recorded per machine and not tracked, like the baseline of utils/benchmark.py
+BASELINE_PATH = APP_ROOT / "benchmarks" / "startup_baseline.json"
+TOLERANCE = 1.5
+SLACK_S = 0.25
+RENDER_TIMEOUT_S = 120
+
+
+def _render(page, warm):
+    # runs in the child process; the test harness is imported before the clock starts
+    from streamlit.testing.v1 import AppTest
+    if warm:
+        from utils.warmup import warm_up
+        warm_up()
+    start = time.perf_counter()
+    app = AppTest.from_file(str(APP_ROOT / page), default_timeout=RENDER_TIMEOUT_S).run()
+    return {"seconds": time.perf_counter() - start, "exceptions": [e.message for e in app.exception]}
+
+
+def measure(page, warm):
+    env = {**os.environ, "TICKBOARD_WARMUP": "0",
+           "PYTHONPATH": os.pathsep.join(filter(None, [str(APP_ROOT), os.environ.get("PYTHONPATH")]))}
+    command = [sys.executable, "-m", "utils.startup_benchmark", "--child", page] + (["--warm"] if warm else [])
+    result = subprocess.run(command, cwd=os.getcwd(), env=env, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        return {"seconds": float("nan"), "exceptions": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(lines[-1])
+
+
+def benchmark(pages=PAGES, record=False):
+    results = {page: {"cold": measure(page, warm=False), "warm": measure(page, warm=True)} for page in pages}
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if not baseline and not record:
+        print(f"no baseline on this machine, record one with --record ({BASELINE_PATH})")
+    regressions = []
+    for page, runs in results.items():
+        errors = runs["cold"]["exceptions"] + runs["warm"]["exceptions"]
+        line = f"{page:45} cold {runs['cold']['seconds']:6.2f}s  warm {runs['warm']['seconds']:6.2f}s"
+        for mode in ("cold", "warm"):
+            limit = baseline.get(page, {}).get(mode)
+            if limit is not None and not runs[mode]["seconds"] <= limit * TOLERANCE + SLACK_S:
+                regressions.append(f"{page} {mode}: {runs[mode]['seconds']:.2f}s, baseline {limit:.2f}s")
+        print(line + (f"  errors: {errors}" if errors else ""))
+        if errors:
+            regressions.append(f"{page}: {errors}")
+
+    if record:
+        BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        baseline.update({page: {mode: run["seconds"] for mode, run in runs.items()} for page, runs in results.items()})
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2))
+        print(f"baseline recorded in {BASELINE_PATH}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return not regressions
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        print(json.dumps(_render(sys.argv[2], warm="--warm" in sys.argv)))
+    else:
+        arguments = [arg for arg in sys.argv[1:] if arg != "--record"]
+        sys.exit(0 if benchmark(arguments or PAGES, record="--record" in sys.argv) else 1)
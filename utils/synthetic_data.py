@@ -0,0 +1,197 @@
+from pathlib import Path
+import sys
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.feather as feather
+import shapely
+from utils.hex_aggregation import hexagon_grid, synthetic_nuts
+from utils.metrics import calculate_metrics
+from utils.model_registry import COLUMNS, METRIC_COLUMNS
+from utils.models import DEFAULT_PARAMETERS, MODEL_NAMES, format_parameters
+from utils.nuts_rollup import AREA_CRS
+from utils.predictions import prediction_table
+
+# a synthetic data directory with the layout and schemas of the real one, for measuring the app without the
+# confidential data: the NUTS3 GeoPackage the store is initialized from (NUTS_ID, the environmental variables, the
+# centroids, the geometry in EPSG:3035), the version table, one legacy prediction GeoPackage per model, the MODELS.csv
+# registry and the coverage image. NUTS2 and NUTS1 are derived from NUTS3 by the app, see utils/nuts_rollup.py; the
+# codes are hierarchical so every level has its usual number of regions. Everything is seeded, the same arguments
+# always give the same files: python -m utils.synthetic_data ROOT [scale] [models] [years]
+
+# the extent of the real data in EPSG:3035 metres
+EUROPE_BOUNDS = (2.6e6, 1.4e6, 6.5e6, 5.4e6)
+# regions of every scale: the real NUTS3 count, ten times that, and one region per cell of the 20 km hexagon grid
+# the environmental data is aggregated from
+SCALES = {"nuts3": {"regions": 1500}, "10x": {"regions": 15000}, "hexagon": {"hexagon_km": 20}}
+# the variables of data/ENV_VARIABLES_VERSIONS.csv
+VARIABLES = ["EEAmedian", "EEAminorit", "EEAmajorit", "EEAvariety", "TCDcount", "TCDsum", "TCDmedian", "TCDvarianc",
+             "TMAX1", "TMAX2", "TMAX3", "TMIN1", "TMIN2", "TMIN3", "VPD1", "VPD2", "VPD3", "BufferFTY", "BufferGras",
+             "BufferImpe", "Impervious"]
+MISSING_FRACTION = 0.005
+# Voronoi borders are straight lines; they get a vertex every BORDER_SPACING_M and are bent by a smooth
+# displacement field, which gives them the vertex count of a 1:1M boundary file
+BORDER_SPACING_M = 2000
+# the real data has about 35 countries, 100 NUTS1 and 300 NUTS2 regions over 1500 NUTS3; children per parent grow
+# with the cube root of the scale
+CHILDREN = {"NUTS3": 5, "NUTS2": 3, "NUTS1": 3}
+CODE_CHARS = "123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# yearly predictions end with this year
+LAST_YEAR = 2024
+
+
+def _morton(x, y, bits=16):
+    # Z-order of the points, consecutive points are close to each other
+    def spread(v):
+        v = v.astype(np.uint64)
+        for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    scale = 2 ** bits - 1
+    qx = np.rint((x - x.min()) / max(np.ptp(x), 1e-9) * scale)
+    qy = np.rint((y - y.min()) / max(np.ptp(y), 1e-9) * scale)
+    return spread(qx) | (spread(qy) << np.uint64(1))
+
+
+def nuts_codes(x, y, real_regions=SCALES["nuts3"]["regions"]):
+    # hierarchical 5 character codes for points: neighbouring regions share their NUTS2, NUTS1 and country prefix
+    growth = max(1.0, len(x) / real_regions) ** (1 / 3)
+    per = {level: min(len(CODE_CHARS), max(1, round(n * growth))) for level, n in CHILDREN.items()}
+    rank = np.empty(len(x), dtype=np.int64)
+    rank[np.argsort(_morton(x, y), kind="stable")] = np.arange(len(x))
+    nuts2, nuts3 = np.divmod(rank, per["NUTS3"])
+    nuts1, nuts2 = np.divmod(nuts2, per["NUTS2"])
+    country, nuts1 = np.divmod(nuts1, per["NUTS1"])
+    if country.max() >= 26 * 26:
+        raise ValueError(f"{len(x)} regions do not fit into two letter country codes")
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return np.array([f"{letters[c // 26]}{letters[c % 26]}{CODE_CHARS[n1]}{CODE_CHARS[n2]}{CODE_CHARS[n3]}"
+                     for c, n1, n2, n3 in zip(country, nuts1, nuts2, nuts3)])
+
+
+def _bend(geometries, spacing, bounds, seed):
+    # three octaves of a sine field; each has a gradient below 1/3, so the map stays one-to-one and shared borders
+    # stay shared, without self-intersections
+    rng = np.random.default_rng(seed)
+    octaves = [(spacing * 8 * 4 ** i, rng.uniform(0, 2 * np.pi, 2)) for i in range(3)]
+
+    def displace(coords):
+        x, y = coords[:, 0], coords[:, 1]
+        dx, dy = np.zeros_like(x), np.zeros_like(y)
+        for wavelength, (px, py) in octaves:
+            k = 2 * np.pi / wavelength
+            amplitude = 0.2 / k
+            dx += amplitude * np.sin(k * y + px)
+            dy += amplitude * np.sin(k * x + py)
+        return np.column_stack([x + dx, y + dy])
+
+    geometries = shapely.segmentize(geometries, spacing)
+    return shapely.intersection(shapely.transform(geometries, displace), shapely.box(*bounds))
+
+
+def regions(scale="nuts3", bounds=EUROPE_BOUNDS, seed=0):
+    # NUTS3 GeoDataFrame in EPSG:3035 with hierarchical codes
+    config = SCALES[scale]
+    if "hexagon_km" in config:
+        gdf = hexagon_grid(bounds, config["hexagon_km"] * 1000, seed)[["geometry"]]
+    else:
+        gdf = synthetic_nuts(bounds, config["regions"], seed)[["geometry"]]
+        gdf["geometry"] = _bend(gdf.geometry.values, BORDER_SPACING_M, bounds, seed)
+        gdf = gdf[~gdf.geometry.is_empty].reset_index(drop=True)
+    centers = gdf.geometry.centroid
+    gdf.insert(0, "NUTS_ID", nuts_codes(centers.x.to_numpy(), centers.y.to_numpy()))
+    return gdf
+
+
+def environmental_data(gdf, bounds=EUROPE_BOUNDS, seed=0):
+    # the NUTS3 GeoPackage layout: NUTS_ID, smooth variables with noise and a few missing values, the centroids in
+    # EPSG:3035 and in lat/lon, the geometry
+    rng = np.random.default_rng(seed)
+    centers = gdf.geometry.centroid
+    x0, y0, x1, y1 = bounds
+    u, v = (centers.x.to_numpy() - x0) / (x1 - x0), (centers.y.to_numpy() - y0) / (y1 - y0)
+    columns = {}
+    for name in VARIABLES:
+        a, b, c, phase = rng.normal(size=4)
+        values = 10 + 3 * (a * u + b * v + c * np.sin(6 * u + 4 * v + phase)) + rng.normal(0, 0.5, len(gdf))
+        values[rng.random(len(gdf)) < MISSING_FRACTION] = np.nan
+        columns[name] = values
+    centers_lonlat = centers.to_crs(epsg=4326)
+    result = pd.DataFrame({"NUTS_ID": gdf["NUTS_ID"], **columns,
+                           "CENTER_X": centers.x, "CENTER_Y": centers.y,
+                           "CENTER_LAT": centers_lonlat.y, "CENTER_LON": centers_lonlat.x})
+    return gpd.GeoDataFrame(result, geometry=gdf.geometry.values, crs=AREA_CRS)
+
+
+def predictions(env, seed=0, years=1):
+    # a tick abundance-like target: skewed, non-negative and driven by the temperature and humidity variables; with
+    # several years a (years x regions) array that drifts with a regional trend and yearly noise
+    rng = np.random.default_rng(seed)
+    signal = np.nan_to_num(0.15 * (env["TMAX1"] - 10) + 0.1 * (env["VPD1"] - 10))
+    y_pred = rng.gamma(2, 35, len(env)) * np.exp(signal)
+    if years > 1:
+        trend = rng.normal(0, 0.05, len(env))
+        y_pred = y_pred * np.exp(np.arange(1 - years, 1)[:, None] * trend + rng.normal(0, 0.1, (years, len(env))))
+    y_pred[rng.random(y_pred.shape) < MISSING_FRACTION] = np.nan
+    return y_pred
+
+
+def registry_row(model_id, model, y_pred, rng):
+    # a MODELS.csv line in the format utils/model_registry.py appends
+    valid = ~np.isnan(y_pred)
+    metrics = calculate_metrics(y_pred[valid] * rng.lognormal(0, 0.5, valid.sum()), y_pred[valid])
+    created = pd.Timestamp("2026-01-01 12:00:00") + pd.Timedelta(days=model_id - 1)
+    row = {"model_id": model_id, "model_name": MODEL_NAMES[model], "creation_date": f"{created:%Y-%m-%d %H:%M:%S}",
+           "parameters": format_parameters(DEFAULT_PARAMETERS[model]), "env_data_version": 1,
+           **{name: float(metrics[name]) for name in METRIC_COLUMNS}}
+    return ";".join(repr(row[name]) if name in METRIC_COLUMNS else str(row[name]) for name in COLUMNS)
+
+
+def coverage_image(env, size=600):
+    # data/images/data_coverage.svg: the regions of the synthetic training data as dots
+    x0, y0, x1, y1 = env.total_bounds
+    scale = size / max(x1 - x0, y1 - y0)
+    dots = "".join(f'<circle cx="{(x - x0) * scale:.1f}" cy="{(y1 - y) * scale:.1f}" r="1"/>'
+                   for x, y in zip(env["CENTER_X"], env["CENTER_Y"]))
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{(x1 - x0) * scale:.0f}" '
+            f'height="{(y1 - y0) * scale:.0f}"><g fill="#2a788e">{dots}</g></svg>')
+
+
+def generate(root, scale="nuts3", n_models=4, seed=0, years=1):
+    # writes ROOT/data; returns the number of regions. With several years the predictions are written in the yearly
+    # format of utils/predictions.py instead of legacy GeoPackages, the last year is the one in MODELS.csv
+    data = Path(root) / "data"
+    (data / "predictions").mkdir(parents=True, exist_ok=True)
+    (data / "images").mkdir(exist_ok=True)
+    env = environmental_data(regions(scale, seed=seed), seed=seed)
+    env.to_file(data / "weighted_aggr_nuts_3.gpkg", driver="GPKG", layer="weighted_aggr_nuts_3")
+    pd.DataFrame({"variable_name": VARIABLES, "version": 1}).to_csv(data / "ENV_VARIABLES_VERSIONS.csv", sep=";",
+                                                                    index=False)
+
+    rng = np.random.default_rng(seed)
+    models = list(MODEL_NAMES)
+    lines = [";".join(COLUMNS)]
+    for model_id in range(1, n_models + 1):
+        y_pred = predictions(env, seed + model_id, years)
+        if years > 1:
+            table = prediction_table(np.tile(env["NUTS_ID"], years), y_pred.ravel(),
+                                     np.repeat(np.arange(LAST_YEAR - years + 1, LAST_YEAR + 1), len(env)))
+            feather.write_feather(table, data / "predictions" / f"{model_id}_MODEL_PREDICTIONS.feather",
+                                  compression="uncompressed")
+            y_pred = y_pred[-1]
+        else:
+            gpd.GeoDataFrame({"NUTS_ID": env["NUTS_ID"], "y_pred": y_pred}, geometry=env.geometry.values,
+                             crs=AREA_CRS).to_file(data / "predictions" / f"{model_id}_MODEL_PREDICTIONS.gpkg",
+                                                   driver="GPKG")
+        lines.append(registry_row(model_id, models[(model_id - 1) % len(models)], y_pred, rng))
+    (data / "MODELS.csv").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    (data / "images" / "data_coverage.svg").write_text(coverage_image(env), encoding="utf-8")
+    return len(env)
+
+
+if __name__ == "__main__":
+    start = time.time()
+    n_regions = generate(sys.argv[1], *sys.argv[2:3], *[int(arg) for arg in sys.argv[3:4]],
+                         **{"years": int(arg) for arg in sys.argv[4:5]})
+    print(f"{n_regions} regions written to {Path(sys.argv[1]) / 'data'} in {time.time() - start:.2f}s")
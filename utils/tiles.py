@@ -0,0 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+import math
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import shapely
+import streamlit as st
+from utils.coloring import color_values, value_range
+from utils.env_store import GEOMETRY_COLUMNS, geometry_key, read_dataset, read_geometry, store_key
+from utils.geometry_cache import file_hash
+from utils.nuts_rollup import NUTS_LEVELS, read_level
+from utils.predictions import prediction_source, read_predictions
+from utils.tracing import traced
+
+# tiles are served by streamlit's static file serving (server.enableStaticServing in .streamlit/config.toml)
+TILES_DIR = Path("static") / "tiles"
+TILES_URL = "app/static/tiles"
+TILE_SIZE = 256
+MIN_ZOOM = 2
+MAX_ZOOM = 8
+PYRAMID_VERSION = 2
+TILE_BUILD_WORKERS = 1
+
+
+def zoom_tolerance(zoom):
+    # about one screen pixel at this zoom level, so no detail is sent that the viewport cannot show
+    return 360 / (TILE_SIZE * 2 ** zoom)
+
+
+def tile_bounds(x, y, zoom):
+    n = 2 ** zoom
+    lon_min = x / n * 360 - 180
+    lon_max = (x + 1) / n * 360 - 180
+    lat_max = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lon_min, lat_min, lon_max, lat_max
+
+
+def tile_index(lon, lat, zoom):
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _feature_collection(properties, geometries):
+    features = ",".join(f'{{"type":"Feature","properties":{p},"geometry":{g}}}'
+                        for p, g in zip(properties, geometries))
+    return f'{{"type":"FeatureCollection","features":[{features}]}}'
+
+
+@traced("tiles.build")
+def build_tileset(gdf, target, columns):
+    # gdf has to be in EPSG:4326; polygons are clipped to every tile, region borders travel as separate
+    # line features so the tile edges are never outlined
+    geometries = gdf.geometry.values
+    records = gdf[columns].round(2).astype(object).where(gdf[columns].notna(), None).to_dict("records")
+    properties = np.array([json.dumps(r) for r in records], dtype=object)
+    border_properties = np.array([json.dumps({"NUTS_ID": r["NUTS_ID"]}) for r in records], dtype=object)
+
+    # every build writes into its own temporary directory, which only replaces the target once it is complete
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=target.parent, prefix=target.name + ".", suffix=".tmp"))
+    try:
+        meta = _write_pyramid(tmp, target, gdf, columns, geometries, properties, border_properties)
+        shutil.rmtree(target, ignore_errors=True)
+        tmp.rename(target)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return meta
+
+
+def _write_pyramid(tmp, target, gdf, columns, geometries, properties, border_properties):
+    lon_min, lat_min, lon_max, lat_max = gdf.total_bounds
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        tolerance = zoom_tolerance(zoom)
+        # the snapping keeps every ring valid: a pointwise snap can collapse a small ring to 3 points
+        simplified = shapely.set_precision(
+            shapely.simplify(geometries, tolerance, preserve_topology=True), tolerance / 4)
+        borders = shapely.boundary(simplified)
+        tree = shapely.STRtree(simplified)
+
+        x_min, y_min = tile_index(lon_min, lat_max, zoom)
+        x_max, y_max = tile_index(lon_max, lat_min, zoom)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                bounds = tile_bounds(x, y, zoom)
+                hits = tree.query(shapely.box(*bounds), predicate="intersects")
+                if len(hits) == 0:
+                    continue
+                polygons = shapely.clip_by_rect(simplified[hits], *bounds)
+                lines = shapely.clip_by_rect(borders[hits], *bounds)
+                keep_polygons = ~shapely.is_empty(polygons)
+                keep_lines = ~shapely.is_empty(lines)
+                if not keep_polygons.any():
+                    continue
+                path = tmp / str(zoom) / str(x) / f"{y}.json"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(_feature_collection(
+                    np.concatenate([properties[hits][keep_polygons], border_properties[hits][keep_lines]]),
+                    shapely.to_geojson(np.concatenate([polygons[keep_polygons], lines[keep_lines]])),
+                ), encoding="utf-8")
+
+    meta = {
+        "url": f"{TILES_URL}/{target.name}/{{z}}/{{x}}/{{y}}.json",
+        "bounds": [float(lon_min), float(lat_min), float(lon_max), float(lat_max)],
+        "min_zoom": MIN_ZOOM,
+        "max_zoom": MAX_ZOOM,
+        "ranges": {c: value_range(gdf[c].to_numpy(dtype=float)) for c in columns
+                   if pd.api.types.is_numeric_dtype(gdf[c])},
+    }
+    (tmp / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+    return meta
+
+
+def _tileset(name, key, load, prepare, build=True):
+    # None when the tileset is not built yet and build is False
+    target = TILES_DIR / f"{name}.{key}.v{PYRAMID_VERSION}"
+    meta_path = target / "meta.json"
+    if meta_path.exists():
+        return json.loads(meta_path.read_text(encoding="utf-8"))
+    if not build:
+        return None
+
+    gdf, columns = prepare(load().to_crs(epsg=4326))
+    meta = build_tileset(gdf, target, columns)
+    # older versions of the same tileset; builds still in progress are left alone
+    for old in TILES_DIR.glob(f"{name}.*"):
+        if old != target and not old.name.endswith(".tmp"):
+            shutil.rmtree(old, ignore_errors=True)
+    return meta
+
+
+def _prepare_nuts(gdf):
+    # colors are precomputed per variable over the whole level, so the map only switches the property it reads
+    variables = [c for c in gdf.columns
+                 if c not in GEOMETRY_COLUMNS and pd.api.types.is_numeric_dtype(gdf[c])]
+    colors = {}
+    for var in variables:
+        values = gdf[var].to_numpy(dtype=float)
+        colors[f"C_{var}"] = color_values(values, *value_range(values)).tolist()
+    gdf = pd.concat([gdf, pd.DataFrame(colors, index=gdf.index)], axis=1)
+    return gdf, ["NUTS_ID"] + variables + list(colors)
+
+
+def _prepare_predictions(gdf):
+    return gdf, ["NUTS_ID", "y_pred"]
+
+
+def nuts_tileset(level, build=True):
+    return _tileset(level, store_key(), read_dataset if level == "NUTS3" else lambda: read_level(level), _prepare_nuts,
+                    build)
+
+
+def prediction_tileset(model_id, build=True):
+    key = f"{file_hash(prediction_source(model_id))}.{geometry_key()}"
+    return _tileset(f"model_{model_id}", key, lambda: _prediction_dataset(model_id), _prepare_predictions, build)
+
+
+def _prediction_dataset(model_id):
+    gdf = read_geometry()
+    gdf["y_pred"] = read_predictions(model_id, gdf["NUTS_ID"])
+    return gdf[gdf["y_pred"].notna()]
+
+
+class TileBuilds:
+    # a pyramid takes too long to build inside a rerun: a tileset that is not on disk yet is built by a background
+    # thread and the pages draw GeoJSON until it is ready. A failed build is not retried before the next server start
+
+    def __init__(self, max_workers=TILE_BUILD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tiles")
+        self._builds = {}
+        self._lock = threading.Lock()
+
+    def get(self, tileset, arg):
+        # the meta of tileset(arg) (nuts_tileset or prediction_tileset) when it is built, otherwise None
+        meta = tileset(arg, build=False)
+        if meta is not None:
+            return meta
+        with self._lock:
+            key = (tileset.__name__, arg)
+            future = self._builds.get(key)
+            if future is None or (future.done() and future.exception() is None):
+                # not started, or built for an older version of the data
+                self._builds[key] = self._executor.submit(tileset, arg)
+        return None
+
+    def error(self, tileset, arg):
+        # the message of a failed build, None while it is queued, running or done
+        with self._lock:
+            future = self._builds.get((tileset.__name__, arg))
+        if future is None or not future.done() or future.exception() is None:
+            return None
+        return str(future.exception())
+
+
+@st.cache_resource
+def get_tile_builds():
+    # shared by all sessions of the server process
+    return TileBuilds()
+
+
+def tile_layer(meta, **props):
+    # deck.gl renders every fetched tile with a GeoJsonLayer that receives these props
+    import pydeck as pdk
+    return pdk.Layer(
+        "TileLayer",
+        data=meta["url"],
+        id=meta["url"],
+        min_zoom=meta["min_zoom"],
+        max_zoom=meta["max_zoom"],
+        extent=meta["bounds"],
+        tile_size=TILE_SIZE,
+        stroked=False,
+        pickable=True,
+        **props,
+    )
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.tiles [model ids...]
+    import sys
+    for level in NUTS_LEVELS:
+        print(level, nuts_tileset(level)["url"])
+    for model_id in sys.argv[1:]:
+        print(model_id, prediction_tileset(model_id)["url"])
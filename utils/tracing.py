@@ -0,0 +1,159 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+
+# per-stage timing spans of every rerun: a page calls begin_rerun() at the top and end_rerun() at the bottom, the code
+# in between wraps its stages in span(). Spans carry the session, the rerun and the page; work done on a job thread
+# is attributed to the rerun that submitted it with use_run(). Spans are kept in a bounded in-memory buffer per
+# server process, shown on the admin page, and also appended as JSON lines to TICKBOARD_TRACE_FILE if that is set.
+# TICKBOARD_TRACE_SAMPLE (0-1) is the fraction of reruns that are traced; every span of a sampled rerun is recorded
+
+TRACE_SAMPLE = float(os.environ.get("TICKBOARD_TRACE_SAMPLE", 1.0))
+TRACE_FILE = os.environ.get("TICKBOARD_TRACE_FILE")
+TRACE_CAPACITY = 50000
+# the performance traces page is only shown with TICKBOARD_ADMIN=1
+ADMIN = os.environ.get("TICKBOARD_ADMIN") == "1"
+# spans outside of a rerun (warm-up, build steps) are attributed to this session
+BACKGROUND = "background"
+# the fields of a span that come from the run and thread it was recorded on
+RUN_FIELDS = ("session", "rerun", "page", "thread")
+
+
+class Tracer:
+
+    def __init__(self, capacity=TRACE_CAPACITY, path=TRACE_FILE):
+        self._spans = deque(maxlen=capacity)
+        self._path = path
+        # opened on the first span and kept open, line-buffered so every span reaches the file as it is recorded
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, start=None, run=None, **attributes):
+        span = {"stage": stage, "start": time.time() - seconds if start is None else start,
+                "ms": seconds * 1000, "session": run["session"] if run else BACKGROUND,
+                "rerun": run["rerun"] if run else None, "page": run["page"] if run else None,
+                "thread": threading.current_thread().name, **attributes}
+        with self._lock:
+            self._spans.append(span)
+            if self._path:
+                if self._file is None:
+                    self._file = open(self._path, "a", encoding="utf-8", buffering=1)
+                self._file.write(json.dumps(span, default=str) + "\n")
+
+    def spans(self):
+        with self._lock:
+            return pd.DataFrame(list(self._spans))
+
+    def export(self):
+        # every buffered span as JSON lines
+        with self._lock:
+            return "".join(json.dumps(span, default=str) + "\n" for span in self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+
+TRACER = Tracer()
+_local = threading.local()
+
+
+def _script_session_state():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    import streamlit as st
+    return st.session_state
+
+
+def current_run():
+    # the run attached to this thread, else the current rerun of the session whose script runs on it
+    run = getattr(_local, "run", None)
+    if run is not None:
+        return run
+    state = _script_session_state()
+    return state.get("trace_run") if state is not None else None
+
+
+def begin_rerun(page):
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    run = {"session": ctx.session_id if ctx else BACKGROUND, "rerun": uuid.uuid4().hex[:12], "page": page,
+           "sampled": random.random() < TRACE_SAMPLE, "start": time.time()}
+    state = _script_session_state()
+    if state is not None:
+        state["trace_run"] = run
+    return run
+
+
+def end_rerun():
+    # the whole script run as one span; not reached when the script stops early (st.rerun, st.stop, an exception)
+    run = current_run()
+    if run is not None and run["sampled"]:
+        TRACER.record("rerun", time.time() - run["start"], start=run["start"], run=run)
+
+
+@contextmanager
+def use_run(run):
+    # attributes the spans of a job thread to the rerun that submitted the job
+    previous = getattr(_local, "run", None)
+    _local.run = run
+    try:
+        yield
+    finally:
+        _local.run = previous
+
+
+def _sampled(run):
+    return run["sampled"] if run is not None else random.random() < TRACE_SAMPLE
+
+
+@contextmanager
+def span(stage, **attributes):
+    run = current_run()
+    if not _sampled(run):
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        TRACER.record(stage, time.time() - start, start=start, run=run, **attributes)
+
+
+def traced(stage):
+    # decorator form of span()
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(stage, seconds, run=None, **attributes):
+    # a stage timed elsewhere, e.g. in the training process
+    if _sampled(run):
+        TRACER.record(stage, seconds, run=run, **attributes)
+
+
+def stage_summary(spans):
+    # count, p50, p95 and max duration in ms per stage
+    if spans.empty:
+        return pd.DataFrame(columns=["stage", "count", "p50_ms", "p95_ms", "max_ms", "total_s"])
+    rows = []
+    for stage, durations in spans.groupby("stage")["ms"]:
+        values = durations.to_numpy()
+        p50, p95 = np.percentile(values, [50, 95])
+        rows.append({"stage": stage, "count": len(values), "p50_ms": p50, "p95_ms": p95,
+                     "max_ms": values.max(), "total_s": values.sum() / 1000})
+    return pd.DataFrame(rows).sort_values("p95_ms", ascending=False, ignore_index=True)
@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+import streamlit as st
+from utils.models import DEFAULT_PARAMETERS
+from utils.tracing import current_run, record
+
+# at most this many trainings run at the same time, each in its own process with TRAINING_N_JOBS workers
+TRAINING_WORKERS = 1
+TRAINING_N_JOBS = int(os.environ.get("TICKBOARD_TRAINING_N_JOBS", -1))
+JOB_RETENTION_S = 3600
+# the training process imports utils from the app, whatever its working directory
+APP_ROOT = Path(__file__).resolve().parent.parent
+POLL_INTERVAL_S = 0.5
+
+
+class TrainingJobs:
+    # training requests are queued on a small thread pool; every thread starts one training process
+    # (python -m utils.model_training) in its own process group, relays the progress it reports into the job state
+    # and terminates the group (the process and its LOOCV workers) on cancellation. Results are committed by the
+    # training process itself, which ignores the termination once the commit has started
+
+    def __init__(self, max_workers=TRAINING_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="training")
+        self._jobs = {}
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model, params=None, n_jobs=TRAINING_N_JOBS, synthetic=False):
+        # synthetic trains on a synthetic target instead of the tick data and registers the model like any other,
+        # it is only for the scratch directory of check()
+        job_id = uuid.uuid4().hex
+        params = DEFAULT_PARAMETERS[model] if params is None else params
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = {"state": "queued", "progress": 0.0, "stage": "Waiting in the queue",
+                                  "timings": {}, "model_id": None, "metrics": None, "message": None,
+                                  "cancelled": False, "committing": False, "finished": None}
+        self._executor.submit(self._run, job_id, model, params, n_jobs, synthetic, current_run())
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {**job, "timings": dict(job["timings"])} if job is not None else None
+
+    def cancel(self, job_id):
+        # nothing is committed before the final atomic writes, a terminated process leaves no partial model. Once the
+        # model is being committed the job finishes; returns whether the job is cancelled
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["committing"] or job["finished"]:
+                return False
+            job["cancelled"] = True
+            process = self._processes.get(job_id)
+            if process is not None:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            return True
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            self._jobs[job_id].update(changes)
+
+    def _run(self, job_id, model, params, n_jobs, synthetic, run=None):
+        command = [sys.executable, "-m", "utils.model_training", model, json.dumps(params), str(n_jobs)] \
+            + (["synthetic"] if synthetic else [])
+        with self._lock:
+            if self._jobs[job_id]["cancelled"]:
+                process = None
+            else:
+                env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+                    filter(None, [str(APP_ROOT), os.environ.get("PYTHONPATH")]))}
+                # the training process sends its spans back with the result instead of writing the trace file
+                env.pop("TICKBOARD_TRACE_FILE", None)
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, env=env,
+                                           start_new_session=True)
+                self._processes[job_id] = process
+                self._jobs[job_id].update(state="running", stage="Starting")
+        if process is None:
+            return self._finish(job_id, "cancelled", "The training was cancelled.")
+
+        stage, stage_start, timings, result = None, time.time(), {}, None
+        for line in process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event["event"] == "progress":
+                if stage is not None:
+                    timings[stage] = time.time() - stage_start
+                stage, stage_start = event["stage"], time.time()
+                with self._lock:
+                    job = self._jobs[job_id]
+                    job.update(progress=event["fraction"], stage=stage, timings=dict(timings))
+                    # a cancellation that got here first has already terminated the process group
+                    job["committing"] = event["commit"] and not job["cancelled"]
+            else:
+                result = event
+        process.wait()
+        with self._lock:
+            del self._processes[job_id]
+
+        # a committed model is reported whether or not a cancellation came in while it was committed
+        if result is not None and result["event"] == "done":
+            self._update(job_id, model_id=result["model_id"], metrics=result["metrics"], timings=result["timings"])
+            # the stages are timed by the training process and attributed to the rerun that submitted the job
+            for stage, seconds in result["timings"].items():
+                record(f"training.{stage.lower().replace(' ', '_')}", seconds, run=run, model=model, n_jobs=n_jobs)
+            for sub_span in result["spans"]:
+                record(f"training.{sub_span.pop('stage')}", sub_span.pop("ms") / 1000, run=run, **sub_span)
+            self._finish(job_id, "done", f"Model {result['model_id']} has been trained.")
+        elif self.status(job_id)["cancelled"]:
+            self._finish(job_id, "cancelled", "The training was cancelled.")
+        elif result is None:
+            self._finish(job_id, "failed", "The training process stopped unexpectedly.")
+        else:
+            self._finish(job_id, "failed", result["message"])
+
+    def _finish(self, job_id, state, message):
+        self._update(job_id, state=state, progress=1.0, stage="Finished", message=message, finished=time.time())
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_S
+        for job_id in [j for j, job in self._jobs.items() if job["finished"] and job["finished"] < cutoff]:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_training_jobs():
+    # one runner per server process, shared by all sessions
+    return TrainingJobs()
+
+
+def check(model="RF", n_regions=300):
+    # end-to-end run in a scratch directory with a synthetic store: python -m utils.training_jobs [model]
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    from utils.ingest_stress import synthetic_store
+    from utils.model_registry import MODELS_PATH, read_models
+    from utils.predictions import prediction_source, read_predictions
+    from utils.tracing import TRACER, stage_summary
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        try:
+            synthetic_store(root, n_regions, n_variables=8)
+            jobs = TrainingJobs(max_workers=2)
+            job_id = jobs.submit(model, n_jobs=2, synthetic=True)
+            cancelled_id = jobs.submit(model, n_jobs=1, synthetic=True)
+            time.sleep(1)
+            jobs.cancel(cancelled_id)
+            while (job := jobs.status(job_id))["state"] in ("queued", "running"):
+                print(f"\r{job['progress']:.0%} {job['stage']:<30}", end="", flush=True)
+                time.sleep(POLL_INTERVAL_S)
+            print(f"\r{job['message']}")
+            assert job["state"] == "done", job["message"]
+            assert jobs.status(cancelled_id)["state"] == "cancelled"
+            assert not jobs.cancel(job_id), "a finished job cannot be cancelled"
+
+            models = read_models()
+            assert list(models["model_id"]) == [job["model_id"]], "exactly one model has to be registered"
+            predictions = read_predictions(job["model_id"], [f"XX{i:03d}" for i in range(n_regions)])
+            assert prediction_source(job["model_id"]).exists() and not np.isnan(predictions).any()
+            assert not list(Path("data").rglob("*.tmp")), "temporary files left behind"
+            print(", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in job["timings"].items()))
+            print(", ".join(f"{name} {value:.3f}" for name, value in job["metrics"].items()))
+            # the sub-spans of the training process are relayed with the result
+            spans = TRACER.spans()
+            spans = spans[spans["stage"].str.startswith("training.")]
+            assert "training.model.parallel_fit" in set(spans["stage"]), "the training spans were not relayed"
+            print(stage_summary(spans).to_string(index=False))
+            print(MODELS_PATH.read_text())
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    check(*sys.argv[1:2])
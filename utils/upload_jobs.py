@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import threading
+import time
+import uuid
+import pandas as pd
+import streamlit as st
+from utils.data_upload_validation import validate_env_data
+from utils.tracing import current_run, span, use_run
+
+UPLOAD_WORKERS = 2
+# finished jobs are kept this long so that their page can still pick up the result
+JOB_RETENTION_S = 3600
+
+
+class UploadJobs:
+    # uploads are validated and committed on a small worker pool; the page only polls the job state
+
+    def __init__(self, max_workers=UPLOAD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, data, variable_name):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = {"state": "queued", "progress": 0.0, "stage": "Waiting in the queue",
+                                  "message": None, "variable_name": variable_name, "finished": None}
+        # the job's spans belong to the rerun that submitted it
+        self._executor.submit(self._run, job_id, data, variable_name, current_run())
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            self._jobs[job_id].update(changes)
+
+    def _run(self, job_id, data, variable_name, run=None):
+        progress = lambda fraction, stage: self._update(job_id, state="running", progress=fraction, stage=stage)
+        with use_run(run), span("upload.job", bytes=len(data)):
+            try:
+                progress(0.05, "Reading the file")
+                with span("upload.read"):
+                    df = pd.read_csv(io.BytesIO(data), header=None, sep=";")
+                passed, message = validate_env_data(df, variable_name, progress)
+            except Exception as e:
+                passed, message = False, f"The file could not be processed: {e}"
+        self._update(job_id, state="done" if passed else "failed", progress=1.0, stage="Finished",
+                     message=message, finished=time.time())
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_S
+        for job_id in [j for j, job in self._jobs.items() if job["finished"] and job["finished"] < cutoff]:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_upload_jobs():
+    # one pool per server process, shared by all sessions
+    return UploadJobs()
@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import time
+import streamlit as st
+import utils.data_loader as data_loader
+from utils.predictions import prediction_source
+from utils.tracing import record
+
+# the shared caches are filled once per server process, in a background thread started by the first page any session
+# opens: the data store with its derived NUTS levels, the model registry, the predictions of every registered model
+# and the region lookup. Pages render right away and find the data loaded, or wait on the same cache entry instead of
+# loading it a second time. TICKBOARD_WARMUP=0 turns it off; python -m utils.warmup builds the on-disk artifacts ahead
+# of a deployment
+WARMUP = os.environ.get("TICKBOARD_WARMUP", "1") == "1"
+
+
+def warm_up(tiles=False):
+    # returns the seconds spent per step
+    timings = {}
+
+    def step(name, load):
+        start = time.time()
+        load()
+        timings[name] = time.time() - start
+        record(f"warmup.{name.replace(' ', '_')}", timings[name])
+
+    step("data store", data_loader.load_all_data)
+    step("model registry", lambda: (data_loader.load_model_options(), data_loader.load_model_results()))
+    model_ids = [1] + [model_id for model_id, _, _ in data_loader.load_model_options()]
+    step("predictions", lambda: [data_loader.load_model_predictions(model_id) for model_id in model_ids
+                                 if prediction_source(model_id).exists()])
+    step("prediction cube", data_loader.load_prediction_cube)
+    step("region lookup", data_loader.load_region_lookup)
+    if tiles:
+        from utils.tiles import NUTS_LEVELS, nuts_tileset
+        step("tiles", lambda: [nuts_tileset(level) for level in NUTS_LEVELS])
+    return timings
+
+
+@st.cache_resource
+def _warm_up_thread():
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_warm_up():
+    if WARMUP:
+        _warm_up_thread()
+
+
+if __name__ == "__main__":
+    # build step: python -m utils.warmup [tiles]
+    timings = warm_up(tiles=sys.argv[1:2] == ["tiles"])
+    print(", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))